@@ -0,0 +1,330 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Cache locale delle feature WFS (CadastralParcel, CadastralZoning).
+
+Le feature sono salvate in un database SQLite con indice spaziale R-tree,
+insieme ai rettangoli di copertura da cui provengono e all'ora del download.
+Una richiesta interamente coperta da coperture ancora valide (TTL) viene
+risolta in locale; altrimenti al WFS si chiede solo la parte scoperta.
+Oltre la dimensione massima vengono eliminate le coperture usate meno di
+recente (LRU) insieme alle feature che restano senza copertura.
+
+Il modulo non dipende da QGIS: le feature sono dizionari
+{'key', 'wkt', 'bbox': (xmin, ymin, xmax, ymax), 'attrs': {...}}.
+
+Dalla console di QGIS:
+
+    from catasto_cache import get_cache
+    print(get_cache().stats())
+    get_cache().clear()
+"""
+
+import json
+import os
+import sqlite3
+import threading
+import time
+
+DEFAULT_PATH = os.path.join(os.path.expanduser('~'), '.catasto_unzip_all', 'cache', 'wfs_cache.sqlite')
+DEFAULT_TTL = 7 * 24 * 3600
+DEFAULT_MAX_BYTES = 512 * 1024 * 1024
+# Oltre questo numero di pezzi scoperti si scarica un unico bbox che li contiene tutti
+MAX_PIECES = 8
+EPSILON = 1e-9
+
+
+def has_area(rect):
+    """False per i rettangoli degeneri (un punto o un segmento)"""
+    return rect[2] - rect[0] > EPSILON and rect[3] - rect[1] > EPSILON
+
+
+def subtract_rect(rect, hole):
+    """Parti di rect non coperte da hole (al massimo 4 rettangoli, senza pezzi degeneri)"""
+    xmin, ymin, xmax, ymax = rect
+    hxmin, hymin, hxmax, hymax = hole
+    if not has_area(hole) or hxmin >= xmax - EPSILON or hxmax <= xmin + EPSILON or hymin >= ymax - EPSILON or hymax <= ymin + EPSILON:
+        return [rect]
+    pieces = []
+    if hxmin > xmin + EPSILON:
+        pieces.append((xmin, ymin, hxmin, ymax))
+    if hxmax < xmax - EPSILON:
+        pieces.append((hxmax, ymin, xmax, ymax))
+    ixmin, ixmax = max(xmin, hxmin), min(xmax, hxmax)
+    if hymin > ymin + EPSILON:
+        pieces.append((ixmin, ymin, ixmax, hymin))
+    if hymax < ymax - EPSILON:
+        pieces.append((ixmin, hymax, ixmax, ymax))
+    return [piece for piece in pieces if has_area(piece)]
+
+
+def uncovered_pieces(rect, covers):
+    """Rettangoli di rect non coperti dall'unione di covers"""
+    pieces = [rect]
+    for cover in covers:
+        pieces = [p for piece in pieces for p in subtract_rect(piece, cover)]
+        if not pieces:
+            break
+    return pieces
+
+
+def union_bbox(rects):
+    return (min(r[0] for r in rects), min(r[1] for r in rects),
+            max(r[2] for r in rects), max(r[3] for r in rects))
+
+
+class FeatureCache:
+    """
+    Cache su disco con R-tree, TTL e limite di dimensione.
+
+    Args:
+        path (str): file SQLite della cache
+        ttl (float): validità in secondi di un download
+        max_bytes (int): dimensione massima dei dati in cache
+    """
+    def __init__(self, path=DEFAULT_PATH, ttl=DEFAULT_TTL, max_bytes=DEFAULT_MAX_BYTES):
+        self.path = path
+        self.ttl = ttl
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        if path != ':memory:':
+            os.makedirs(os.path.dirname(path), exist_ok=True)
+        self._lock = threading.RLock()
+        self._db = sqlite3.connect(path, check_same_thread=False)
+        self._db.execute('PRAGMA journal_mode=WAL')
+        self._create_schema()
+
+    def _create_schema(self):
+        with self._lock, self._db:
+            self._db.executescript('''
+                CREATE TABLE IF NOT EXISTS features (
+                    id INTEGER PRIMARY KEY,
+                    typename TEXT NOT NULL,
+                    fkey TEXT NOT NULL,
+                    wkt TEXT,
+                    attrs TEXT,
+                    fetched REAL NOT NULL,
+                    size INTEGER NOT NULL,
+                    UNIQUE (typename, fkey)
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS features_rtree USING rtree(id, xmin, xmax, ymin, ymax);
+                CREATE TABLE IF NOT EXISTS coverage (
+                    id INTEGER PRIMARY KEY,
+                    typename TEXT NOT NULL,
+                    fetched REAL NOT NULL,
+                    accessed REAL NOT NULL
+                );
+                CREATE VIRTUAL TABLE IF NOT EXISTS coverage_rtree USING rtree(id, xmin, xmax, ymin, ymax);
+            ''')
+
+    # --- coperture -------------------------------------------------------------
+
+    def _fresh_covers(self, typename, bbox, now):
+        xmin, ymin, xmax, ymax = bbox
+        return self._db.execute('''
+            SELECT c.id, r.xmin, r.ymin, r.xmax, r.ymax FROM coverage_rtree r
+            JOIN coverage c ON c.id = r.id
+            WHERE c.typename = ? AND c.fetched >= ?
+              AND r.xmin <= ? AND r.xmax >= ? AND r.ymin <= ? AND r.ymax >= ?
+        ''', (typename, now - self.ttl, xmax, xmin, ymax, ymin)).fetchall()
+
+    def uncovered(self, typename, bbox):
+        """
+        Parti di bbox non coperte da download ancora validi.
+        Returns:
+            list: rettangoli (xmin, ymin, xmax, ymax) da chiedere al WFS; vuota se bbox è tutto in cache
+        """
+        now = time.time()
+        with self._lock:
+            covers = self._fresh_covers(typename, bbox, now)
+            if bbox[0] == bbox[2] or bbox[1] == bbox[3]:
+                # Punto (es. un clic): coperto se una copertura lo contiene, bordi compresi
+                inside = any(c[1] <= bbox[0] and c[3] >= bbox[2] and c[2] <= bbox[1] and c[4] >= bbox[3]
+                             for c in covers)
+                pieces = [] if inside else [tuple(bbox)]
+            else:
+                pieces = uncovered_pieces(tuple(bbox), [c[1:] for c in covers])
+            if covers:
+                with self._db:
+                    self._db.executemany('UPDATE coverage SET accessed = ? WHERE id = ?',
+                                         [(now, c[0]) for c in covers])
+        if len(pieces) > MAX_PIECES:
+            pieces = [union_bbox(pieces)]
+        return pieces
+
+    def covers(self, typename, bbox):
+        """True se bbox è interamente coperto da download ancora validi"""
+        return not self.uncovered(typename, bbox)
+
+    # --- feature -----------------------------------------------------------------
+
+    def store(self, typename, bbox, records, evict=True):
+        """
+        Salva le feature scaricate per bbox e registra bbox come coperto.
+        Le feature in cache interamente contenute in bbox ma assenti dal nuovo
+        download sono state eliminate sul server e vengono tolte.
+        Con bbox None o senza area (es. l'interrogazione di un punto) si salvano
+        solo le feature, senza copertura: il download non dice nulla del resto dell'area.
+        Returns:
+            id della copertura, None se non è stata registrata
+        """
+        now = time.time()
+        covered = bbox is not None and has_area(bbox)
+        with self._lock, self._db:
+            if covered:
+                xmin, ymin, xmax, ymax = bbox
+                stale = [row[0] for row in self._db.execute('''
+                    SELECT r.id FROM features_rtree r JOIN features f ON f.id = r.id
+                    WHERE f.typename = ? AND r.xmin >= ? AND r.xmax <= ? AND r.ymin >= ? AND r.ymax <= ?
+                ''', (typename, xmin, xmax, ymin, ymax))]
+                self._delete_features(stale)
+
+            for record in records:
+                wkt = record.get('wkt')
+                attrs = json.dumps(record.get('attrs', {}), ensure_ascii=False)
+                size = len(wkt or '') + len(attrs)
+                row = self._db.execute('SELECT id FROM features WHERE typename = ? AND fkey = ?',
+                                       (typename, record['key'])).fetchone()
+                if row:
+                    self._db.execute('UPDATE features SET wkt = ?, attrs = ?, fetched = ?, size = ? WHERE id = ?',
+                                     (wkt, attrs, now, size, row[0]))
+                    self._db.execute('DELETE FROM features_rtree WHERE id = ?', (row[0],))
+                    fid = row[0]
+                else:
+                    fid = self._db.execute('''
+                        INSERT INTO features (typename, fkey, wkt, attrs, fetched, size) VALUES (?, ?, ?, ?, ?, ?)
+                    ''', (typename, record['key'], wkt, attrs, now, size)).lastrowid
+                fxmin, fymin, fxmax, fymax = record['bbox']
+                self._db.execute('INSERT INTO features_rtree VALUES (?, ?, ?, ?, ?)',
+                                 (fid, fxmin, fxmax, fymin, fymax))
+
+            cid = None
+            if covered:
+                cid = self._db.execute('INSERT INTO coverage (typename, fetched, accessed) VALUES (?, ?, ?)',
+                                       (typename, now, now)).lastrowid
+                self._db.execute('INSERT INTO coverage_rtree VALUES (?, ?, ?, ?, ?)', (cid, xmin, xmax, ymin, ymax))
+        if evict:
+            self.evict(keep=(cid,) if cid else ())
+        return cid
+
+    def query(self, typename, bbox, fresh=False):
+        """Feature in cache il cui bbox interseca bbox (con fresh solo quelle scaricate entro il TTL)"""
+        xmin, ymin, xmax, ymax = bbox
+        min_fetched = time.time() - self.ttl if fresh else 0
+        with self._lock:
+            rows = self._db.execute('''
+                SELECT f.fkey, f.wkt, f.attrs, r.xmin, r.ymin, r.xmax, r.ymax
+                FROM features_rtree r JOIN features f ON f.id = r.id
+                WHERE f.typename = ? AND r.xmin <= ? AND r.xmax >= ? AND r.ymin <= ? AND r.ymax >= ?
+                  AND f.fetched >= ?
+                ORDER BY f.id
+            ''', (typename, xmax, xmin, ymax, ymin, min_fetched)).fetchall()
+        return [{'key': row[0], 'wkt': row[1], 'attrs': json.loads(row[2]), 'bbox': tuple(row[3:7])}
+                for row in rows]
+
+    def get(self, typename, bbox, fetch):
+        """
+        Feature che intersecano bbox: dalla cache per le parti coperte, dal WFS
+        (fetch(rettangolo) -> lista di record) solo per le parti scoperte.
+        """
+        pieces = self.uncovered(typename, bbox)
+        stored = []
+        if pieces:
+            self.misses += 1
+            for piece in pieces:
+                cid = self.store(typename, piece, fetch(piece), evict=False)
+                if cid:
+                    stored.append(cid)
+        else:
+            self.hits += 1
+        result = self.query(typename, bbox)
+        # La pulizia avviene dopo la lettura: le parti appena scaricate non vengono mai scartate
+        if stored:
+            self.evict(keep=stored)
+        return result
+
+    # --- manutenzione --------------------------------------------------------------
+
+    def _delete_features(self, ids):
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            self._db.execute(f'DELETE FROM features WHERE id IN ({marks})', chunk)
+            self._db.execute(f'DELETE FROM features_rtree WHERE id IN ({marks})', chunk)
+
+    def _delete_coverage(self, ids):
+        for start in range(0, len(ids), 500):
+            chunk = ids[start:start + 500]
+            marks = ','.join('?' * len(chunk))
+            self._db.execute(f'DELETE FROM coverage WHERE id IN ({marks})', chunk)
+            self._db.execute(f'DELETE FROM coverage_rtree WHERE id IN ({marks})', chunk)
+
+    def _drop_uncovered_features(self):
+        # Una feature resta finché interseca almeno una copertura rimasta
+        self._db.execute('''
+            DELETE FROM features WHERE NOT EXISTS (
+                SELECT 1 FROM features_rtree fr, coverage_rtree cr JOIN coverage c ON c.id = cr.id
+                WHERE fr.id = features.id AND c.typename = features.typename
+                  AND cr.xmin <= fr.xmax AND cr.xmax >= fr.xmin AND cr.ymin <= fr.ymax AND cr.ymax >= fr.ymin
+            )
+        ''')
+        self._db.execute('DELETE FROM features_rtree WHERE id NOT IN (SELECT id FROM features)')
+
+    def size(self):
+        with self._lock:
+            return self._db.execute('SELECT COALESCE(SUM(size), 0) FROM features').fetchone()[0]
+
+    def evict(self, keep=()):
+        """
+        Elimina le coperture scadute e, oltre max_bytes, quelle usate meno di recente.
+        Le coperture in keep (appena scaricate) non vengono eliminate per dimensione.
+        """
+        now = time.time()
+        with self._lock, self._db:
+            expired = [row[0] for row in self._db.execute('SELECT id FROM coverage WHERE fetched < ?',
+                                                          (now - self.ttl,))]
+            changed = bool(expired)
+            self._delete_coverage(expired)
+            if changed:
+                self._drop_uncovered_features()
+
+            while self.size() > self.max_bytes:
+                marks = ','.join('?' * len(keep))
+                oldest = [row[0] for row in self._db.execute(
+                    f'SELECT id FROM coverage WHERE id NOT IN ({marks}) ORDER BY accessed LIMIT 4', tuple(keep))]
+                if not oldest:
+                    break
+                self._delete_coverage(oldest)
+                self._drop_uncovered_features()
+
+    def clear(self):
+        """Svuota la cache"""
+        with self._lock, self._db:
+            for table in ('features', 'features_rtree', 'coverage', 'coverage_rtree'):
+                self._db.execute(f'DELETE FROM {table}')
+        self.hits = self.misses = 0
+
+    def stats(self):
+        with self._lock:
+            features = self._db.execute('SELECT COUNT(*) FROM features').fetchone()[0]
+            coverage = self._db.execute('SELECT COUNT(*) FROM coverage').fetchone()[0]
+        return {'features': features, 'coverage': coverage, 'bytes': self.size(),
+                'hits': self.hits, 'misses': self.misses}
+
+    def close(self):
+        with self._lock:
+            self._db.close()
+
+
+_cache = None
+_cache_lock = threading.Lock()
+
+
+def get_cache():
+    """Cache condivisa dagli script"""
+    global _cache
+    with _cache_lock:
+        if _cache is None:
+            _cache = FeatureCache()
+        return _cache
@@ -0,0 +1,295 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Checkpoint dei download WFS su aree grandi.
+
+Ogni pagina completata viene scritta subito in un GeoPackage locale e
+registrata in un journal JSON (typename, bbox, STARTINDEX completati, hash
+delle pagine). Se QGIS si chiude o la rete cade a metà, rilanciando lo stesso
+download sulla stessa area si riparte dall'ultima pagina salvata. Prima di
+riusare le pagine salvate si riscaricano alcune pagine campione e se ne
+confronta l'hash con il journal: se sul server sono cambiate (anche a parità
+di numero di feature) il download riparte da zero.
+
+Un checkpoint completo resta su disco anche dopo che i dati sono passati alla
+cache: scaduta la cache, un nuovo download della stessa area riverifica
+solo alcune pagine invece di riscaricarle tutte. I checkpoint non usati da
+più di RETENTION secondi vengono eliminati (prune_checkpoints), e con
+l'ultimo la cartella.
+"""
+
+import hashlib
+import json
+import os
+import random
+import time
+
+from qgis.core import (QgsVectorLayer, QgsVectorFileWriter, QgsCoordinateReferenceSystem,
+                       QgsCoordinateTransformContext, QgsFeature, QgsFeatureRequest,
+                       QgsField, QgsFields, QgsWkbTypes)
+from PyQt5.QtCore import QVariant
+
+DEFAULT_FOLDER = os.path.join(os.path.expanduser('~'), '.catasto_unzip_all', 'checkpoint')
+LAYER_NAME = 'pagine'
+PAGE_FIELD = '_pagina'
+# Pagine riscaricate per verificare un checkpoint (la prima, l'ultima e altre a caso)
+VERIFY_SAMPLE = 3
+# Un checkpoint non aggiornato né verificato da 30 giorni si elimina
+RETENTION = 30 * 24 * 3600
+
+
+def job_id(typename, bbox):
+    """Identificativo stabile di un download: stesso typename e stesso bbox -> stesso checkpoint"""
+    key = f"{typename}|{bbox[0]:.7f},{bbox[1]:.7f},{bbox[2]:.7f},{bbox[3]:.7f}"
+    return hashlib.sha1(key.encode('utf-8')).hexdigest()[:16]
+
+
+def prune_checkpoints(folder=DEFAULT_FOLDER, max_age=RETENTION):
+    """
+    Elimina i checkpoint (completi o interrotti) non usati da più di max_age
+    secondi, e la cartella se non ne restano.
+    Returns:
+        int: checkpoint eliminati
+    """
+    if not os.path.isdir(folder):
+        return 0
+    limit = time.time() - max_age
+    removed = 0
+    for name in os.listdir(folder):
+        if not name.endswith('.json'):
+            continue
+        journal_path = os.path.join(folder, name)
+        try:
+            with open(journal_path, 'r', encoding='utf-8') as f:
+                updated = json.load(f).get('updated', 0)
+        except (OSError, ValueError):
+            updated = 0
+        if updated >= limit:
+            continue
+        base = os.path.join(folder, name[:-len('.json')])
+        for path in (journal_path, base + '.gpkg', base + '.gpkg-wal', base + '.gpkg-shm'):
+            if os.path.exists(path):
+                os.remove(path)
+        removed += 1
+    try:
+        os.rmdir(folder)
+    except OSError:
+        # Restano checkpoint recenti
+        pass
+    return removed
+
+
+def page_digest(records):
+    """
+    Hash delle feature di una pagina (chiave, geometria e attributi dei record),
+    salvato nel journal. Non si usa il testo della risposta, che contiene l'ora.
+    """
+    digest = hashlib.sha1()
+    for record in records:
+        digest.update(json.dumps([record['key'], record['wkt'], sorted(record['attrs'].items())]).encode('utf-8'))
+    return digest.hexdigest()
+
+
+class DownloadCheckpoint:
+    """
+    Checkpoint di un singolo download (typename + bbox).
+
+    Args:
+        typename (str): es. 'CP:CadastralParcel'
+        bbox (tuple): (xmin, ymin, xmax, ymax) in EPSG:6706
+        fields (QgsFields): campi delle feature salvate
+        folder (str): cartella dei checkpoint
+    """
+    def __init__(self, typename, bbox, fields, folder=DEFAULT_FOLDER, crs='EPSG:6706'):
+        self.typename = typename
+        self.bbox = tuple(bbox)
+        self.fields = fields
+        self.crs = QgsCoordinateReferenceSystem(crs)
+        os.makedirs(folder, exist_ok=True)
+        name = job_id(typename, self.bbox)
+        self.gpkg_path = os.path.join(folder, f"{name}.gpkg")
+        self.journal_path = os.path.join(folder, f"{name}.json")
+        self.journal = self._load_journal()
+        self._layer = None
+
+    # --- journal ---------------------------------------------------------------
+
+    def _new_journal(self):
+        return {
+            'typename': self.typename,
+            'bbox': list(self.bbox),
+            'created': time.time(),
+            'updated': time.time(),
+            'next_start': 0,
+            'pages': [],
+            'complete': False,
+            'total': None,
+            'verified': None
+        }
+
+    def _load_journal(self):
+        if os.path.exists(self.journal_path) and os.path.exists(self.gpkg_path):
+            try:
+                with open(self.journal_path, 'r', encoding='utf-8') as f:
+                    journal = json.load(f)
+                if journal.get('typename') == self.typename:
+                    return journal
+            except (OSError, ValueError) as e:
+                print(f"Journal non leggibile, il download riparte da zero: {str(e)}")
+        return self._new_journal()
+
+    def _save_journal(self):
+        # Scrittura atomica: un crash a metà non lascia un journal corrotto
+        self.journal['updated'] = time.time()
+        tmp_path = self.journal_path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            json.dump(self.journal, f)
+        os.replace(tmp_path, self.journal_path)
+
+    @property
+    def complete(self):
+        return self.journal['complete']
+
+    @property
+    def total(self):
+        return self.journal['total']
+
+    @property
+    def next_start(self):
+        return self.journal['next_start']
+
+    @property
+    def completed_pages(self):
+        return len(self.journal['pages'])
+
+    # --- GeoPackage ------------------------------------------------------------
+
+    def _create_gpkg(self):
+        fields = QgsFields(self.fields)
+        fields.append(QgsField(PAGE_FIELD, QVariant.Int))
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        options.layerName = LAYER_NAME
+        writer = QgsVectorFileWriter.create(self.gpkg_path, fields, QgsWkbTypes.MultiPolygon,
+                                            self.crs, QgsCoordinateTransformContext(), options)
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            raise Exception(f"Impossibile creare il checkpoint {self.gpkg_path}: {writer.errorMessage()}")
+        del writer
+
+    def layer(self):
+        """Layer OGR del GeoPackage del checkpoint (creato se non esiste)"""
+        if self._layer is None:
+            if not os.path.exists(self.gpkg_path):
+                self._create_gpkg()
+            self._layer = QgsVectorLayer(f"{self.gpkg_path}|layername={LAYER_NAME}", "checkpoint", "ogr")
+            if not self._layer.isValid():
+                raise Exception(f"Checkpoint non valido: {self.gpkg_path}")
+        return self._layer
+
+    def resume_from(self):
+        """
+        STARTINDEX da cui riprendere. Elimina le feature di pagine scritte nel
+        GeoPackage ma non ancora registrate nel journal (crash tra le due scritture).
+        """
+        layer = self.layer()
+        request = QgsFeatureRequest().setFilterExpression(f'"{PAGE_FIELD}" >= {self.next_start}')
+        request.setNoAttributes().setFlags(QgsFeatureRequest.NoGeometry)
+        orphans = [f.id() for f in layer.getFeatures(request)]
+        if orphans:
+            layer.dataProvider().deleteFeatures(orphans)
+            print(f"Rimosse {len(orphans)} feature di una pagina non completata")
+        if self.next_start:
+            print(f"Ripresa del download da STARTINDEX {self.next_start} "
+                  f"({self.completed_pages} pagine già salvate)")
+        return self.next_start
+
+    def add_page(self, start_index, count, features, digest=None):
+        """
+        Salva le feature di una pagina completata e aggiorna il journal.
+
+        Args:
+            count (int): feature restituite dal server per la pagina (STARTINDEX successivo = start_index + count)
+            features: feature effettivamente salvate
+        """
+        layer = self.layer()
+        field_index = layer.fields().indexOf(PAGE_FIELD)
+        to_write = []
+        for feat in features:
+            new_feat = QgsFeature(layer.fields())
+            for field in self.fields:
+                new_feat[field.name()] = feat[field.name()]
+            new_feat.setAttribute(field_index, start_index)
+            if feat.hasGeometry():
+                geom = feat.geometry()
+                geom.convertToMultiType()
+                new_feat.setGeometry(geom)
+            to_write.append(new_feat)
+        if to_write and not layer.dataProvider().addFeatures(to_write)[0]:
+            raise Exception(f"Scrittura del checkpoint fallita per la pagina {start_index}")
+
+        self.journal['pages'].append({'start': start_index, 'count': count,
+                                      'saved': len(to_write), 'sha1': digest})
+        self.journal['next_start'] = start_index + count
+        self._save_journal()
+
+    def finish(self):
+        """Segna il download come completo"""
+        self.journal['complete'] = True
+        self.journal['total'] = sum(p['count'] for p in self.journal['pages'])
+        self.journal['verified'] = time.time()
+        self._save_journal()
+
+    def verify_pages(self, fetch_digest, sample=VERIFY_SAMPLE):
+        """
+        Riscarica alcune pagine salvate e ne confronta l'hash con quello del journal.
+
+        Args:
+            fetch_digest: funzione (start_index, count) -> page_digest della pagina sul server
+        Returns:
+            bool: True se tutte le pagine campione sono invariate
+        """
+        pages = self.journal['pages']
+        if len(pages) > sample:
+            pages = [pages[0], pages[-1]] + random.sample(pages[1:-1], sample - 2)
+        for page in pages:
+            if fetch_digest(page['start'], page['count']) != page.get('sha1'):
+                print(f"Pagina STARTINDEX={page['start']} cambiata sul server")
+                return False
+        return True
+
+    def verify(self, matched, fetch_digest=None):
+        """
+        Confronta il numero di feature attuale sul server con quello salvato e,
+        con fetch_digest, l'hash di alcune pagine campione (verify_pages).
+        Returns:
+            bool: True se il checkpoint completo è ancora valido
+        """
+        if not self.complete or matched is None or matched != self.total:
+            return False
+        if fetch_digest is not None and not self.verify_pages(fetch_digest):
+            return False
+        self.journal['verified'] = time.time()
+        self._save_journal()
+        return True
+
+    def reset(self):
+        """Cancella il checkpoint per riscaricare l'area da zero"""
+        self._layer = None
+        for path in (self.gpkg_path, self.gpkg_path + '-wal', self.gpkg_path + '-shm', self.journal_path):
+            if os.path.exists(path):
+                os.remove(path)
+        self.journal = self._new_journal()
+
+    def discard(self):
+        """Elimina il checkpoint di un download concluso, e la cartella se non ne restano altri"""
+        self.reset()
+        try:
+            os.rmdir(os.path.dirname(self.gpkg_path))
+        except OSError:
+            # Altri download in sospeso
+            pass
+
+    def features(self):
+        """Feature salvate, nell'ordine delle pagine"""
+        request = QgsFeatureRequest().addOrderBy(PAGE_FIELD)
+        return self.layer().getFeatures(request)
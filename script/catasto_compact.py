@@ -0,0 +1,388 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Profilo compatto dei file uniti: coordinate quantizzate e anelli codificati a differenze.
+
+Le coordinate dell'Agenzia in EPSG:6706 hanno circa 7 decimali significativi,
+ma nel GeoPackage ogni vertice occupa due double (16 byte). Nel profilo
+compatto ogni coordinata è agganciata a una griglia (COMPACT_GRID, di base
+1e-7 gradi, circa 1 cm) e salvata come intero; in ogni anello il primo
+vertice è assoluto e gli altri sono differenze dal precedente, in varint
+zigzag (1-2 byte per coordinata). Il vertice di chiusura non si salva.
+
+L'aggancio è lo stesso per tutte le particelle, quindi un vertice condiviso
+tra particelle vicine finisce sullo stesso nodo della griglia e i bordi in
+comune restano coincidenti; i vertici consecutivi che dopo l'aggancio
+coincidono vengono tolti.
+
+Il file compatto (*.cpkg, SQLite) tiene gli attributi come sono, i fid
+originali, la geometria codificata e un indice spaziale. La ricerca offline
+(catasto_offline.register_gpkg) lo legge direttamente, come un GeoPackage
+unito; expand_compact lo riporta a un GeoPackage normale con gli stessi fid,
+che si apre con gli stessi strumenti dei file uniti.
+
+Dalla console di QGIS:
+
+    from catasto_compact import write_compact, load_compact
+    print(write_compact('/percorso/82_ple_unito.gpkg'))
+    load_compact('/percorso/82_ple_unito.cpkg')
+"""
+
+import json
+import math
+import os
+import sqlite3
+import struct
+
+from qgis.core import (QgsCoordinateReferenceSystem, QgsCoordinateTransformContext, QgsFeature,
+                       QgsField, QgsFields, QgsGeometry, QgsProject, QgsVectorFileWriter,
+                       QgsVectorLayer, QgsWkbTypes)
+from PyQt5.QtCore import QVariant
+
+from catasto_diff import wkb_polygons
+from catasto_offline import ParcelGeoPackage, gpkg_geometry_wkb
+
+COMPACT_GRID = 0.0000001
+COMPACT_SUFFIX = '.cpkg'
+# Nome predefinito del GeoPackage ricostruito da expand_compact (mai quello del file unito)
+EXPANDED_SUFFIX = '_espanso.gpkg'
+FORMAT_VERSION = 1
+# Cartella dei GeoPackage ricostruiti da load_compact
+EXPAND_FOLDER = os.path.join(os.path.expanduser('~'), '.catasto_unzip_all', 'compact')
+BATCH_SIZE = 10000
+
+# Metri per grado di latitudine (per l'errore di posizione in metri)
+_METERS_PER_DEGREE = 111320.0
+
+
+# --- codifica ------------------------------------------------------------------------------
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _zigzag(value):
+    return (value << 1) ^ (value >> 63)
+
+
+def _read_varint(data, offset):
+    value = shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7F) << shift
+        if byte < 0x80:
+            return value, offset
+        shift += 7
+
+
+def _unzigzag(value):
+    return (value >> 1) ^ -(value & 1)
+
+
+def quantize_ring(ring, grid):
+    """Vertici interi sulla griglia, senza i doppioni consecutivi e senza il vertice di chiusura"""
+    result = []
+    for x, y in ring:
+        point = (round(x / grid), round(y / grid))
+        if not result or point != result[-1]:
+            result.append(point)
+    if len(result) > 1 and result[0] == result[-1]:
+        result.pop()
+    return result
+
+
+def encode_polygons(polygons, grid=COMPACT_GRID):
+    """
+    Codifica compatta dei poligoni (liste di anelli di coppie x, y).
+    Gli anelli che dopo l'aggancio hanno meno di tre vertici si scartano, e con
+    l'anello esterno tutto il poligono.
+    Returns:
+        bytes, o None se non resta nessun poligono
+    """
+    encoded = []
+    for polygon in polygons:
+        rings = [quantize_ring(ring, grid) for ring in polygon]
+        if not rings or len(rings[0]) < 3:
+            continue
+        encoded.append([ring for ring in rings if len(ring) >= 3])
+    if not encoded:
+        return None
+    out = bytearray()
+    _varint(len(encoded), out)
+    for rings in encoded:
+        _varint(len(rings), out)
+        for ring in rings:
+            _varint(len(ring), out)
+            last_x = last_y = 0
+            for x, y in ring:
+                _varint(_zigzag(x - last_x), out)
+                _varint(_zigzag(y - last_y), out)
+                last_x, last_y = x, y
+    return bytes(out)
+
+
+def decode_polygons(data, grid=COMPACT_GRID):
+    """Poligoni (anelli chiusi di coppie x, y) da una geometria codificata"""
+    polygons = []
+    count, offset = _read_varint(data, 0)
+    for _ in range(count):
+        ring_count, offset = _read_varint(data, offset)
+        rings = []
+        for _ in range(ring_count):
+            points, offset = _read_varint(data, offset)
+            x = y = 0
+            ring = []
+            for _ in range(points):
+                dx, offset = _read_varint(data, offset)
+                dy, offset = _read_varint(data, offset)
+                x += _unzigzag(dx)
+                y += _unzigzag(dy)
+                ring.append((x * grid, y * grid))
+            ring.append(ring[0])
+            rings.append(ring)
+        polygons.append(rings)
+    return polygons
+
+
+def polygons_to_wkb(polygons):
+    """WKB MultiPolygon (little endian) dei poligoni"""
+    out = bytearray(struct.pack('<BII', 1, 6, len(polygons)))
+    for rings in polygons:
+        out += struct.pack('<BII', 1, 3, len(rings))
+        for ring in rings:
+            out += struct.pack('<I', len(ring))
+            out += struct.pack(f'<{2 * len(ring)}d', *(v for point in ring for v in point))
+    return bytes(out)
+
+
+def _max_error(polygons, grid):
+    """Massimo spostamento di un vertice dovuto all'aggancio, in metri"""
+    worst = 0.0
+    for polygon in polygons:
+        for ring in polygon:
+            for x, y in ring:
+                dx = (x - round(x / grid) * grid) * _METERS_PER_DEGREE * math.cos(math.radians(y))
+                dy = (y - round(y / grid) * grid) * _METERS_PER_DEGREE
+                worst = max(worst, math.hypot(dx, dy))
+    return worst
+
+
+# --- file compatto --------------------------------------------------------------------------
+
+def _gpkg_source(db):
+    row = db.execute("SELECT c.table_name, g.column_name, c.srs_id FROM gpkg_contents c "
+                     "JOIN gpkg_geometry_columns g ON g.table_name = c.table_name "
+                     "WHERE c.data_type = 'features' ORDER BY c.rowid LIMIT 1").fetchone()
+    if row is None:
+        raise Exception("Nessun layer vettoriale nel GeoPackage")
+    return row
+
+
+def write_compact(gpkg_path, output=None, grid=COMPACT_GRID):
+    """
+    Scrive il profilo compatto del primo layer di un GeoPackage unito.
+    Returns:
+        dict: percorso, dimensioni prima e dopo, riduzione in percentuale,
+        errore massimo di posizione in metri, feature scritte e scartate
+    """
+    output = output or os.path.splitext(gpkg_path)[0] + COMPACT_SUFFIX
+    tmp_path = output + '.tmp'
+    if os.path.exists(tmp_path):
+        os.remove(tmp_path)
+    source = sqlite3.connect(f"file:{gpkg_path}?mode=ro", uri=True)
+    table, geom_column, srs_id = _gpkg_source(source)
+    columns = [(c[1], c[2]) for c in source.execute(f'PRAGMA table_info("{table}")') if c[1] != geom_column]
+    pk = next((c[1] for c in source.execute(f'PRAGMA table_info("{table}")') if c[5]), None)
+    attributes = [(name, kind) for name, kind in columns if name != pk]
+
+    db = sqlite3.connect(tmp_path)
+    db.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+    column_defs = ''.join(f', "{name}" {kind}' for name, kind in attributes)
+    db.execute(f'CREATE TABLE features (fid INTEGER PRIMARY KEY{column_defs}, geom BLOB)')
+    db.execute('CREATE VIRTUAL TABLE features_rtree USING rtree(id, minx, maxx, miny, maxy)')
+    select = ', '.join([f'"{pk}"' if pk else 'rowid'] + [f'"{name}"' for name, _ in attributes] + [f'"{geom_column}"'])
+    insert = f"INSERT INTO features VALUES ({', '.join('?' * (len(attributes) + 2))})"
+    written = dropped = 0
+    max_error = 0.0
+    rows = []
+    boxes = []
+    for row in source.execute(f'SELECT {select} FROM "{table}"'):
+        blob = row[-1]
+        data = None
+        if blob:
+            polygons = wkb_polygons(gpkg_geometry_wkb(blob))
+            data = encode_polygons(polygons, grid)
+            max_error = max(max_error, _max_error(polygons, grid))
+            if data is None:
+                dropped += 1
+                continue
+            xs = [x for polygon in polygons for x, _ in polygon[0]]
+            ys = [y for polygon in polygons for _, y in polygon[0]]
+            boxes.append((row[0], min(xs), max(xs), min(ys), max(ys)))
+        rows.append(row[:-1] + (data,))
+        written += 1
+        if len(rows) >= BATCH_SIZE:
+            db.executemany(insert, rows)
+            db.executemany('INSERT INTO features_rtree VALUES (?, ?, ?, ?, ?)', boxes)
+            rows, boxes = [], []
+    db.executemany(insert, rows)
+    db.executemany('INSERT INTO features_rtree VALUES (?, ?, ?, ?, ?)', boxes)
+    meta = {
+        'version': FORMAT_VERSION,
+        'grid': grid,
+        'table': table,
+        'srs_id': srs_id,
+        'fields': attributes
+    }
+    db.executemany('INSERT INTO meta VALUES (?, ?)', [(key, json.dumps(value)) for key, value in meta.items()])
+    db.commit()
+    db.execute('VACUUM')
+    db.close()
+    source.close()
+    os.replace(tmp_path, output)
+
+    before = os.path.getsize(gpkg_path)
+    after = os.path.getsize(output)
+    return {
+        'path': output,
+        'before': before,
+        'after': after,
+        'reduction': 100.0 * (1 - after / before) if before else 0.0,
+        'max_error_m': max_error,
+        'features': written,
+        'dropped': dropped
+    }
+
+
+def read_meta(path):
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+        return {key: json.loads(value) for key, value in db.execute('SELECT key, value FROM meta')}
+
+
+def read_compact(path, bbox=None):
+    """
+    Feature del file compatto: (fid, attributi, poligoni). Con bbox
+    (xmin, ymin, xmax, ymax) solo quelle che lo intersecano, dall'indice spaziale.
+    """
+    meta = read_meta(path)
+    grid = meta['grid']
+    names = [name for name, _ in meta['fields']]
+    select = ', '.join(['fid'] + [f'"{name}"' for name in names] + ['geom'])
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+        if bbox:
+            rows = db.execute(f'SELECT {select} FROM features WHERE fid IN (SELECT id FROM features_rtree '
+                              'WHERE minx <= ? AND maxx >= ? AND miny <= ? AND maxy >= ?)',
+                              (bbox[2], bbox[0], bbox[3], bbox[1]))
+        else:
+            rows = db.execute(f'SELECT {select} FROM features')
+        for row in rows:
+            polygons = decode_polygons(row[-1], grid) if row[-1] else []
+            yield row[0], dict(zip(names, row[1:-1])), polygons
+
+
+class CompactParcelPackage(ParcelGeoPackage):
+    """
+    Profilo compatto aperto per la ricerca offline senza ricostruire il
+    GeoPackage: ricerche per punto sull'indice spaziale del file, per
+    riferimento sull'indice accanto al file, geometrie decodificate al volo.
+    """
+    def _describe(self, db):
+        self.grid = json.loads(db.execute("SELECT value FROM meta WHERE key = 'grid'").fetchone()[0])
+        return 'features', 'geom', 'features_rtree'
+
+    def _geometry(self, blob):
+        geom = QgsGeometry()
+        geom.fromWkb(polygons_to_wkb(decode_polygons(blob, self.grid)))
+        return geom
+
+
+def _field_type(kind):
+    kind = (kind or '').upper()
+    if kind in ('INTEGER', 'INT', 'BIGINT', 'MEDIUMINT'):
+        return QVariant.LongLong
+    if kind in ('SMALLINT', 'TINYINT'):
+        return QVariant.Int
+    if kind in ('REAL', 'DOUBLE', 'FLOAT'):
+        return QVariant.Double
+    if kind == 'BOOLEAN':
+        return QVariant.Bool
+    return QVariant.String
+
+
+def expand_compact(path, output=None):
+    """
+    Ricostruisce dal file compatto un GeoPackage normale (coordinate agganciate
+    alla griglia) con i fid originali. Di base accanto al file compatto con il
+    suffisso EXPANDED_SUFFIX: il GeoPackage unito originale, a piena precisione,
+    non viene mai sovrascritto; un file già esistente non si sovrascrive.
+    Returns:
+        str: percorso del GeoPackage
+    """
+    meta = read_meta(path)
+    output = output or os.path.splitext(path)[0] + EXPANDED_SUFFIX
+    if os.path.exists(output):
+        raise Exception(f"{output} esiste già: indicare un altro file di uscita")
+    fields = QgsFields()
+    # Un campo con il nome della colonna fid del GeoPackage ne imposta il valore
+    fields.append(QgsField('fid', QVariant.LongLong))
+    for name, kind in meta['fields']:
+        fields.append(QgsField(name, _field_type(kind)))
+    options = QgsVectorFileWriter.SaveVectorOptions()
+    options.driverName = 'GPKG'
+    options.layerName = meta['table']
+    crs = QgsCoordinateReferenceSystem(f"EPSG:{meta['srs_id']}" if meta.get('srs_id', 0) > 0 else 'EPSG:6706')
+    writer = QgsVectorFileWriter.create(output, fields, QgsWkbTypes.MultiPolygon, crs,
+                                        QgsCoordinateTransformContext(), options)
+    if writer.hasError() != QgsVectorFileWriter.NoError:
+        raise Exception(f"Impossibile creare {output}: {writer.errorMessage()}")
+    batch = []
+    for fid, attrs, polygons in read_compact(path):
+        feat = QgsFeature(fields, fid)
+        feat['fid'] = fid
+        for name, value in attrs.items():
+            feat[name] = value
+        if polygons:
+            geom = QgsGeometry()
+            geom.fromWkb(polygons_to_wkb(polygons))
+            feat.setGeometry(geom)
+        batch.append(feat)
+        if len(batch) >= BATCH_SIZE:
+            writer.addFeatures(batch)
+            batch = []
+    writer.addFeatures(batch)
+    del writer
+    return output
+
+
+def load_compact(path, name=None):
+    """
+    Carica in QGIS un file compatto: lo ricostruisce una volta in
+    ~/.catasto_unzip_all/compact/ (di nuovo solo se il file compatto cambia),
+    con gli stessi fid, e apre il GeoPackage come un qualsiasi file unito.
+    Per la sola ricerca offline non serve: register_gpkg legge il .cpkg direttamente.
+    """
+    stat = os.stat(path)
+    base = os.path.splitext(os.path.basename(path))[0]
+    os.makedirs(EXPAND_FOLDER, exist_ok=True)
+    expanded = os.path.join(EXPAND_FOLDER, f"{base}_{stat.st_size}_{stat.st_mtime_ns}.gpkg")
+    if not os.path.exists(expanded):
+        for file in os.listdir(EXPAND_FOLDER):
+            if file.startswith(base + '_') and file.endswith('.gpkg'):
+                os.remove(os.path.join(EXPAND_FOLDER, file))
+        expand_compact(path, expanded)
+    layer = QgsVectorLayer(expanded, name or base, 'ogr')
+    if not layer.isValid():
+        raise Exception(f"Layer non valido: {expanded}")
+    QgsProject.instance().addMapLayer(layer)
+    return layer
+
+
+def compact_summary(result):
+    return (f"Profilo compatto {os.path.basename(result['path'])}: "
+            f"{result['before'] / 1048576:.1f} MB -> {result['after'] / 1048576:.1f} MB "
+            f"(-{result['reduction']:.1f}%), errore massimo {result['max_error_m'] * 100:.2f} cm, "
+            f"{result['features']} feature" + (f", {result['dropped']} scartate" if result['dropped'] else ''))
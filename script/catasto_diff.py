@@ -0,0 +1,507 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Variazioni a livello di particella tra due rilasci dell'Agenzia delle Entrate.
+
+Le due versioni possono essere file uniti (GeoPackage di
+catasto_unzip_merge_prov o console_qgis_download, o un altro formato letto
+da OGR) oppure due zip regionali così come si scaricano. Ogni particella è
+ridotta a un'impronta: riferimento catastale (da INSPIREID_LOCALID,
+NATIONALCADASTRALREFERENCE o gml_id), hash della geometria (coordinate
+quantizzate a 1e-7 gradi, quindi uguale tra GML e GeoPackage) e hash degli
+attributi.
+
+Le impronte vengono divise in partizioni secondo l'hash del riferimento e
+scritte su disco in corse ordinate di al massimo RUN_SIZE impronte; il
+confronto procede una partizione alla volta fondendo le corse, quindi la
+memoria non dipende dal numero di particelle.
+
+Dalla console di QGIS:
+
+    from catasto_diff import write_change_feed
+    write_change_feed('/percorso/vecchio/82_ple_unito.gpkg', '/percorso/82_ple_unito.gpkg',
+                      '/percorso/82_ple_variazioni.jsonl')
+"""
+
+import hashlib
+import heapq
+import io
+import json
+import os
+import sqlite3
+import struct
+import tempfile
+import xml.etree.ElementTree as ET
+import zlib
+from array import array
+from collections import namedtuple
+from zipfile import ZipFile
+
+from qgis.core import QgsFeatureRequest, QgsVectorLayer
+
+from catasto_offline import gpkg_geometry_wkb
+from catasto_refindex import KEY_WIDTH, reference_from_id, reference_key
+from catasto_wfs import NAMESPACES, PARCEL_ATTRIBUTES
+
+PARTITIONS = 64
+# Impronte tenute in memoria prima di scrivere una corsa ordinata
+RUN_SIZE = 200000
+# Variazioni scritte insieme nella tabella temporanea di write_change_feed
+PENDING_BATCH = 10000
+# Gli zip annidati fino a questa dimensione si leggono in memoria, i più grandi da un file temporaneo
+IN_MEMORY_ZIP = 64 * 1024 * 1024
+# Quantizzazione delle coordinate per l'hash della geometria (1e-7 gradi, circa 1 cm)
+COORD_SCALE = 10000000
+
+# Campi da cui si ricava il riferimento, in ordine di preferenza
+KEY_FIELDS = ('NATIONALCADASTRALREFERENCE', 'INSPIREID_LOCALID', 'gml_id')
+# Attributi confrontati (il riferimento è la chiave, non un attributo)
+DIFF_ATTRIBUTES = [name for name in PARCEL_ATTRIBUTES
+                   if name not in ('INSPIREID_LOCALID', 'INSPIREID_NAMESPACE', 'NATIONALCADASTRALREFERENCE')]
+
+ADDED = 'added'
+REMOVED = 'removed'
+MODIFIED = 'modified'
+
+Variazione = namedtuple('Variazione', 'op ref geometry attributes')
+
+_GML = '{' + NAMESPACES['gml'] + '}'
+_RECORD = struct.Struct(f'<{KEY_WIDTH}s16s16s')
+_EMPTY_HASH = b'\0' * 16
+
+
+# --- geometrie ------------------------------------------------------------------------
+
+def wkb_polygons(wkb):
+    """
+    Poligoni (liste di anelli di coppie x, y) di una geometria WKB: Polygon,
+    MultiPolygon, poligoni curvi e collezioni (degli archi si tengono i vertici).
+    """
+    polygons = []
+    _read_wkb(memoryview(wkb), 0, polygons)
+    return polygons
+
+
+def _read_wkb(wkb, offset, polygons, rings=None):
+    order = '<' if wkb[offset] == 1 else '>'
+    geom_type, = struct.unpack_from(order + 'I', wkb, offset + 1)
+    offset += 5
+    # Dimensioni Z/M sia ISO (1000, 2000, 3000) sia EWKB (bit alti)
+    has_z = bool(geom_type & 0x80000000) or (geom_type % 10000) // 1000 in (1, 3)
+    has_m = bool(geom_type & 0x40000000) or (geom_type % 10000) // 1000 in (2, 3)
+    base = (geom_type & 0x0FFFFFFF) % 1000
+    dims = 2 + has_z + has_m
+
+    def points(offset):
+        count, = struct.unpack_from(order + 'I', wkb, offset)
+        values = struct.unpack_from(order + 'd' * (count * dims), wkb, offset + 4)
+        return [(values[i], values[i + 1]) for i in range(0, len(values), dims)], offset + 4 + 8 * dims * count
+
+    if base in (2, 8):  # LineString, CircularString: un anello di un poligono curvo
+        coords, offset = points(offset)
+        if rings is not None:
+            rings.append(coords)
+        return offset
+    if base == 9:  # CompoundCurve: i tratti formano un solo anello
+        count, = struct.unpack_from(order + 'I', wkb, offset)
+        offset += 4
+        parts = []
+        for _ in range(count):
+            offset = _read_wkb(wkb, offset, polygons, parts)
+        if rings is not None:
+            rings.append([p for part in parts for p in part])
+        return offset
+    if base == 3:
+        count, = struct.unpack_from(order + 'I', wkb, offset)
+        offset += 4
+        polygon = []
+        for _ in range(count):
+            coords, offset = points(offset)
+            polygon.append(coords)
+        polygons.append(polygon)
+        return offset
+    if base == 10:  # CurvePolygon
+        count, = struct.unpack_from(order + 'I', wkb, offset)
+        offset += 4
+        polygon = []
+        for _ in range(count):
+            offset = _read_wkb(wkb, offset, polygons, polygon)
+        polygons.append(polygon)
+        return offset
+    if base in (6, 7, 12):  # MultiPolygon, GeometryCollection, MultiSurface
+        count, = struct.unpack_from(order + 'I', wkb, offset)
+        offset += 4
+        for _ in range(count):
+            offset = _read_wkb(wkb, offset, polygons)
+        return offset
+    raise ValueError(f"Tipo di geometria WKB non gestito: {geom_type}")
+
+
+def geometry_hash(polygons):
+    """Hash della geometria sulle coordinate quantizzate, indipendente dal formato di origine"""
+    h = hashlib.blake2b(digest_size=16)
+    for polygon in polygons:
+        h.update(struct.pack('<I', len(polygon)))
+        for ring in polygon:
+            values = array('q', (round(v * COORD_SCALE) for point in ring for v in point))
+            h.update(struct.pack('<I', len(ring)))
+            h.update(values.tobytes())
+    return h.digest()
+
+
+def polygons_to_wkt(polygons):
+    if not polygons:
+        return None
+    parts = ['(' + ', '.join('(' + ', '.join(f"{x} {y}" for x, y in ring) + ')' for ring in polygon) + ')'
+             for polygon in polygons]
+    if len(parts) == 1:
+        return f"POLYGON{parts[0]}"
+    return f"MULTIPOLYGON({', '.join(parts)})"
+
+
+# --- attributi ------------------------------------------------------------------------
+
+def _value(value):
+    """Valore in forma confrontabile tra GML (testo) e GeoPackage (tipizzato)"""
+    if isinstance(value, float) and value.is_integer():
+        return str(int(value))
+    return str(value).strip()
+
+
+def attributes_hash(attrs, names):
+    h = hashlib.blake2b(digest_size=16)
+    for name in names:
+        value = attrs.get(name)
+        if value is not None:
+            h.update(f"{name}={_value(value)}\n".encode('utf-8'))
+    return h.digest()
+
+
+# --- sorgenti: (riferimento, poligoni, attributi) -------------------------------------------
+
+def _key_field(names):
+    return next((name for name in KEY_FIELDS if name in names), None)
+
+
+def source_attributes(path):
+    """Attributi confrontabili presenti nella sorgente; None per gli zip (si conoscono solo leggendo)"""
+    if path.lower().endswith('.zip'):
+        return None
+    if path.lower().endswith('.gpkg'):
+        table, _, columns = _gpkg_table(path)
+        return [name for name in DIFF_ATTRIBUTES if name in columns]
+    layer = QgsVectorLayer(path, 'diff', 'ogr')
+    return [name for name in DIFF_ATTRIBUTES if name in layer.fields().names()]
+
+
+def _gpkg_table(path):
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+        row = db.execute("SELECT c.table_name, g.column_name FROM gpkg_contents c "
+                         "JOIN gpkg_geometry_columns g ON g.table_name = c.table_name "
+                         "WHERE c.data_type = 'features' ORDER BY c.rowid LIMIT 1").fetchone()
+        if row is None:
+            raise Exception(f"Nessun layer vettoriale in {path}")
+        columns = [c[1] for c in db.execute(f'PRAGMA table_info("{row[0]}")')]
+    return row[0], row[1], columns
+
+
+def gpkg_parcels(path):
+    """Particelle del primo layer di un GeoPackage unito, lette direttamente con sqlite3"""
+    table, geom_column, columns = _gpkg_table(path)
+    key = _key_field(columns)
+    if key is None:
+        raise Exception(f"{path}: manca il riferimento catastale (NATIONALCADASTRALREFERENCE o gml_id)")
+    names = [name for name in DIFF_ATTRIBUTES if name in columns]
+    select = ', '.join(f'"{name}"' for name in [key, geom_column] + names)
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+        for row in db.execute(f'SELECT {select} FROM "{table}"'):
+            if row[1] is None:
+                continue
+            yield reference_from_id(row[0]), wkb_polygons(gpkg_geometry_wkb(row[1])), dict(zip(names, row[2:]))
+
+
+def layer_parcels(path):
+    """Particelle di un file unito in un altro formato (GML, Shapefile, GeoJSON...), lette da OGR"""
+    layer = QgsVectorLayer(path, 'diff', 'ogr')
+    if not layer.isValid():
+        raise Exception(f"Layer non valido: {path}")
+    field_names = layer.fields().names()
+    key = _key_field(field_names)
+    if key is None:
+        raise Exception(f"{path}: manca il riferimento catastale (NATIONALCADASTRALREFERENCE o gml_id)")
+    names = [name for name in DIFF_ATTRIBUTES if name in field_names]
+    request = QgsFeatureRequest().setSubsetOfAttributes([key] + names, layer.fields())
+    for feat in layer.getFeatures(request):
+        geom = feat.geometry()
+        if geom.isEmpty():
+            continue
+        attrs = {}
+        for name in names:
+            value = feat[name]
+            if value is not None and not (hasattr(value, 'isNull') and value.isNull()):
+                attrs[name] = value
+        yield reference_from_id(str(feat[key])), wkb_polygons(bytes(geom.asWkb())), attrs
+
+
+def _gml_parcels(stream):
+    """Particelle di un file *_ple.gml, lette in streaming una feature alla volta"""
+    for _, element in ET.iterparse(stream):
+        if element.tag.rsplit('}', 1)[-1] not in ('featureMember', 'member'):
+            continue
+        if len(element):
+            feature = element[0]
+            polygons = []
+            for polygon in feature.iter(_GML + 'Polygon'):
+                rings = []
+                for ring_tag in ('exterior', 'interior'):
+                    for ring in polygon.findall(_GML + ring_tag):
+                        pos_list = ring.find('.//' + _GML + 'posList')
+                        if pos_list is not None and pos_list.text:
+                            # posList in ordine lat/lon
+                            values = pos_list.text.split()
+                            rings.append([(float(values[i + 1]), float(values[i]))
+                                          for i in range(0, len(values) - 1, 2)])
+                if rings:
+                    polygons.append(rings)
+            attrs = {child.tag.rsplit('}', 1)[-1]: child.text.strip()
+                     for child in feature if len(child) == 0 and child.text is not None}
+            ref = attrs.get('NATIONALCADASTRALREFERENCE') or reference_from_id(
+                attrs.get('INSPIREID_LOCALID') or feature.get(_GML + 'id'))
+            if polygons and ref:
+                yield ref, polygons, attrs
+        element.clear()
+
+
+def _zip_gml_streams(zip_ref, folder):
+    for info in zip_ref.infolist():
+        name = info.filename.lower()
+        if name.endswith('_ple.gml'):
+            with zip_ref.open(info) as stream:
+                yield stream
+        elif name.endswith('.zip'):
+            if info.file_size <= IN_MEMORY_ZIP:
+                with ZipFile(io.BytesIO(zip_ref.read(info))) as inner:
+                    yield from _zip_gml_streams(inner, folder)
+            else:
+                path = zip_ref.extract(info, folder)
+                try:
+                    with ZipFile(path) as inner:
+                        yield from _zip_gml_streams(inner, folder)
+                finally:
+                    os.remove(path)
+
+
+def zip_parcels(path):
+    """Particelle di uno zip regionale (o provinciale) dell'Agenzia, senza estrarlo su disco"""
+    folder = tempfile.mkdtemp()
+    try:
+        with ZipFile(path) as zip_ref:
+            for stream in _zip_gml_streams(zip_ref, folder):
+                yield from _gml_parcels(stream)
+    finally:
+        os.rmdir(folder)
+
+
+def read_parcels(path):
+    """(riferimento, poligoni, attributi) delle particelle di un file unito o di uno zip dell'Agenzia"""
+    lower = path.lower()
+    if lower.endswith('.zip'):
+        return zip_parcels(path)
+    if lower.endswith('.gpkg'):
+        return gpkg_parcels(path)
+    return layer_parcels(path)
+
+
+# --- impronte in corse ordinate -----------------------------------------------------------
+
+class _SortedRuns:
+    """
+    Impronte (chiave, hash geometria, hash attributi) di una versione, in un file
+    temporaneo: ogni corsa contiene, per ogni partizione, un blocco ordinato.
+    """
+    def __init__(self, folder, name, partitions=PARTITIONS, run_size=RUN_SIZE):
+        self.partitions = partitions
+        self.run_size = run_size
+        self.file = open(os.path.join(folder, f"{name}.runs"), 'w+b')
+        # Per ogni partizione: (offset, numero di impronte) dei blocchi
+        self.blocks = [[] for _ in range(partitions)]
+        self.buffers = [[] for _ in range(partitions)]
+        self.buffered = 0
+        self.count = 0
+
+    def add(self, ref, geom_hash, attr_hash):
+        key = reference_key(ref)
+        self.buffers[zlib.crc32(key) % self.partitions].append(_RECORD.pack(key, geom_hash, attr_hash))
+        self.buffered += 1
+        self.count += 1
+        if self.buffered >= self.run_size:
+            self.flush()
+
+    def flush(self):
+        self.file.seek(0, os.SEEK_END)
+        for partition, buffer in enumerate(self.buffers):
+            if buffer:
+                buffer.sort()
+                self.blocks[partition].append((self.file.tell(), len(buffer)))
+                self.file.write(b''.join(buffer))
+                buffer.clear()
+        self.buffered = 0
+
+    def _block(self, offset, count, chunk=4096):
+        while count:
+            n = min(chunk, count)
+            self.file.seek(offset)
+            data = self.file.read(n * _RECORD.size)
+            for i in range(n):
+                yield data[i * _RECORD.size:(i + 1) * _RECORD.size]
+            offset += n * _RECORD.size
+            count -= n
+
+    def partition(self, index):
+        """Impronte della partizione in ordine di chiave, con le chiavi ripetute riunite in una"""
+        merged = heapq.merge(*(self._block(offset, count) for offset, count in self.blocks[index]))
+        last_key = None
+        geoms = attrs = None
+        for record in merged:
+            key, geom_hash, attr_hash = _RECORD.unpack(record)
+            if key == last_key:
+                # Stesso riferimento più volte nella versione (es. in due comuni): conta l'insieme
+                geoms.append(geom_hash)
+                attrs.append(attr_hash)
+                continue
+            if last_key is not None:
+                yield last_key, _combine(geoms), _combine(attrs)
+            last_key, geoms, attrs = key, [geom_hash], [attr_hash]
+        if last_key is not None:
+            yield last_key, _combine(geoms), _combine(attrs)
+
+    def close(self):
+        self.file.close()
+
+
+def _combine(hashes):
+    if len(hashes) == 1:
+        return hashes[0]
+    return hashlib.blake2b(b''.join(sorted(hashes)), digest_size=16).digest()
+
+
+def _fingerprints(path, folder, name, attributes, partitions, run_size):
+    runs = _SortedRuns(folder, name, partitions, run_size)
+    for ref, polygons, attrs in read_parcels(path):
+        if ref:
+            runs.add(ref, geometry_hash(polygons), attributes_hash(attrs, attributes) if attributes else _EMPTY_HASH)
+    runs.flush()
+    return runs
+
+
+def diff_parcels(old_path, new_path, attributes=None, partitions=PARTITIONS, run_size=RUN_SIZE):
+    """
+    Variazioni tra due versioni, una partizione alla volta (l'ordine è per
+    partizione e, al suo interno, per riferimento).
+    Args:
+        attributes (list): attributi da confrontare; di base quelli presenti in entrambe le versioni
+    Yields:
+        Variazione: op (added, removed, modified), riferimento e, per le modificate,
+        se sono cambiati geometria e attributi
+    """
+    if attributes is None:
+        old_names, new_names = source_attributes(old_path), source_attributes(new_path)
+        known = [names for names in (old_names, new_names) if names is not None]
+        attributes = [name for name in DIFF_ATTRIBUTES if all(name in names for names in known)]
+    folder = tempfile.mkdtemp()
+    old = new = None
+    try:
+        old = _fingerprints(old_path, folder, 'old', attributes, partitions, run_size)
+        new = _fingerprints(new_path, folder, 'new', attributes, partitions, run_size)
+        for index in range(partitions):
+            yield from _merge_join(old.partition(index), new.partition(index))
+    finally:
+        for runs in (old, new):
+            if runs:
+                runs.close()
+        for file in os.listdir(folder):
+            os.remove(os.path.join(folder, file))
+        os.rmdir(folder)
+
+
+def _merge_join(old, new):
+    o = next(old, None)
+    n = next(new, None)
+    while o is not None or n is not None:
+        if n is None or (o is not None and o[0] < n[0]):
+            yield Variazione(REMOVED, _ref(o[0]), True, True)
+            o = next(old, None)
+        elif o is None or n[0] < o[0]:
+            yield Variazione(ADDED, _ref(n[0]), True, True)
+            n = next(new, None)
+        else:
+            if o[1] != n[1] or o[2] != n[2]:
+                yield Variazione(MODIFIED, _ref(n[0]), o[1] != n[1], o[2] != n[2])
+            o = next(old, None)
+            n = next(new, None)
+
+
+def _ref(key):
+    return key.rstrip(b' ').decode('ascii')
+
+
+def write_change_feed(old_path, new_path, output, attributes=None):
+    """
+    Scrive le variazioni in JSON Lines, una riga per particella:
+    {"op": "removed", "ref": ...} oppure, per aggiunte e modificate, anche
+    "changed" (geometry/attributes), "geometry" (WKT) e "attributes" della
+    nuova versione, da applicare a valle senza ricaricare tutto.
+    Returns:
+        dict: numero di particelle aggiunte, rimosse e modificate
+    """
+    counts = {ADDED: 0, REMOVED: 0, MODIFIED: 0}
+    # Aggiunte e modificate, da completare con la lettura della nuova versione, in una
+    # tabella SQLite temporanea su disco: la memoria non dipende dal numero di variazioni
+    pending = sqlite3.connect('')
+    pending.execute('CREATE TABLE pending (ref TEXT PRIMARY KEY, op TEXT, geometry INTEGER, attributes INTEGER) '
+                    'WITHOUT ROWID')
+    remaining = 0
+    batch = []
+    try:
+        with open(output, 'w', encoding='utf-8') as f:
+            for change in diff_parcels(old_path, new_path, attributes):
+                counts[change.op] += 1
+                if change.op == REMOVED:
+                    f.write(json.dumps({'op': REMOVED, 'ref': change.ref}) + '\n')
+                    continue
+                batch.append(change)
+                if len(batch) >= PENDING_BATCH:
+                    remaining += _store_pending(pending, batch)
+            remaining += _store_pending(pending, batch)
+            if remaining:
+                for ref, polygons, attrs in read_parcels(new_path):
+                    row = pending.execute('SELECT op, geometry, attributes FROM pending WHERE ref = ?',
+                                          (ref,)).fetchone()
+                    if row is None:
+                        continue
+                    # Un riferimento ripetuto nella nuova versione si scrive una volta sola
+                    pending.execute('DELETE FROM pending WHERE ref = ?', (ref,))
+                    remaining -= 1
+                    op, geometry, attributes_changed = row
+                    line = {'op': op, 'ref': ref}
+                    if op == MODIFIED:
+                        line['changed'] = [name for name, flag in (('geometry', geometry),
+                                                                   ('attributes', attributes_changed)) if flag]
+                    line['geometry'] = polygons_to_wkt(polygons)
+                    line['attributes'] = {name: _value(value) for name, value in attrs.items()}
+                    f.write(json.dumps(line, ensure_ascii=False) + '\n')
+                    if not remaining:
+                        break
+    finally:
+        pending.close()
+    return counts
+
+
+def _store_pending(db, batch):
+    """Scrive un gruppo di variazioni nella tabella temporanea e lo svuota; restituisce quante erano"""
+    count = len(batch)
+    db.executemany('INSERT OR REPLACE INTO pending VALUES (?, ?, ?, ?)',
+                   [(change.ref, change.op, int(change.geometry), int(change.attributes)) for change in batch])
+    db.commit()
+    batch.clear()
+    return count
@@ -0,0 +1,174 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Funzioni geometriche comuni agli script del catasto.
+"""
+
+import re
+
+from qgis.core import QgsGeometry, QgsPointXY, QgsRectangle
+
+GRID_SIZE = 32
+
+# Stato delle celle della griglia di pre-controllo
+OUTSIDE = 0
+INSIDE = 1
+BOUNDARY = 2
+
+# Forme della geometria restituite dalle funzioni di espressione
+GEOMETRY_MODES = ('wkt', 'geom', 'wkb', 'simplified')
+WKT_DECIMALS = 6
+# Tolleranza della semplificazione in gradi (circa 1 m)
+SIMPLIFY_TOLERANCE = 0.00001
+
+
+def records_at_point(records, x, y):
+    """
+    Record (vedi catasto_wfs) il cui poligono contiene il punto, bordi compresi.
+    Il punto viene preparato una volta e confrontato con i soli candidati il cui bbox lo contiene.
+    """
+    point = QgsGeometry.fromPointXY(QgsPointXY(x, y))
+    engine = QgsGeometry.createGeometryEngine(point.constGet())
+    engine.prepareGeometry()
+    found = []
+    for record in records:
+        xmin, ymin, xmax, ymax = record['bbox']
+        if xmin <= x <= xmax and ymin <= y <= ymax:
+            if engine.intersects(QgsGeometry.fromWkt(record['wkt']).constGet()):
+                found.append(record)
+    return found
+
+
+def format_wkt(wkt, decimals=WKT_DECIMALS):
+    """
+    Formatta una stringa WKT con il numero specificato di decimali.
+    """
+    def format_number(match):
+        num = float(match.group(0))
+        return f"{num:.{decimals}f}"
+    
+    formatted = re.sub(r'\d+\.\d+', format_number, wkt)
+    formatted = formatted.replace(",", ", ")
+    formatted = formatted.replace("), ", "),\n")
+    
+    return formatted
+
+
+def geometry_output(geom, mode='wkt', decimals=WKT_DECIMALS, tolerance=SIMPLIFY_TOLERANCE):
+    """
+    Geometria di una particella nella forma richiesta da una funzione di espressione:
+    'wkt' (il testo di sempre, formattato da format_wkt), 'geom' (QgsGeometry),
+    'wkb' (QByteArray) o 'simplified' (WKT del contorno semplificato entro tolerance).
+    """
+    if mode == 'geom':
+        return QgsGeometry(geom)
+    if mode == 'wkb':
+        return geom.asWkb()
+    if mode == 'simplified':
+        geom = geom.simplify(tolerance)
+    elif mode != 'wkt':
+        raise ValueError(f"Forma della geometria non valida: {mode} (ammesse: {', '.join(GEOMETRY_MODES)})")
+    return format_wkt(geom.asWkt(), decimals)
+
+
+class PolygonClipper:
+    """
+    Filtro esatto "interseca il poligono disegnato" per le feature scaricate per bbox.
+
+    Il bbox del poligono è diviso in una griglia GRID_SIZE x GRID_SIZE; ogni cella è
+    classificata una volta sola come interna, esterna o di bordo. Una feature il cui
+    bbox cade solo in celle interne è tenuta, una che cade solo in celle esterne è
+    scartata; solo le altre passano dal test GEOS sulla geometria preparata.
+
+    Args:
+        polygon (QgsGeometry): area disegnata (stesso CRS delle feature)
+    """
+    def __init__(self, polygon, grid_size=GRID_SIZE):
+        self.polygon = QgsGeometry(polygon)
+        self.engine = QgsGeometry.createGeometryEngine(self.polygon.constGet())
+        self.engine.prepareGeometry()
+        self.extent = self.polygon.boundingBox()
+        self.grid_size = grid_size
+        self.cell_w = self.extent.width() / grid_size or 1.0
+        self.cell_h = self.extent.height() / grid_size or 1.0
+        self.cells = [self._classify(i, j) for j in range(grid_size) for i in range(grid_size)]
+        self.kept = 0
+        self.discarded = 0
+        self.exact_tests = 0
+
+    def _cell_rect(self, i, j):
+        x = self.extent.xMinimum() + i * self.cell_w
+        y = self.extent.yMinimum() + j * self.cell_h
+        return QgsRectangle(x, y, x + self.cell_w, y + self.cell_h)
+
+    def _classify(self, i, j):
+        cell = QgsGeometry.fromRect(self._cell_rect(i, j))
+        if self.engine.contains(cell.constGet()):
+            return INSIDE
+        if self.engine.intersects(cell.constGet()):
+            return BOUNDARY
+        return OUTSIDE
+
+    def _cell_range(self, low, high, origin, size):
+        first = int((low - origin) // size)
+        last = int((high - origin) // size)
+        return max(0, first), min(self.grid_size - 1, last)
+
+    def classify_bbox(self, xmin, ymin, xmax, ymax):
+        """INSIDE / OUTSIDE se decidibile dalla griglia, BOUNDARY se serve il test esatto"""
+        ext = self.extent
+        if xmax < ext.xMinimum() or xmin > ext.xMaximum() or ymax < ext.yMinimum() or ymin > ext.yMaximum():
+            return OUTSIDE
+        # Un bbox che sborda dall'estensione del poligono non può essere tutto interno
+        overflow = xmin < ext.xMinimum() or xmax > ext.xMaximum() or ymin < ext.yMinimum() or ymax > ext.yMaximum()
+        i0, i1 = self._cell_range(xmin, xmax, ext.xMinimum(), self.cell_w)
+        j0, j1 = self._cell_range(ymin, ymax, ext.yMinimum(), self.cell_h)
+        states = set()
+        for j in range(j0, j1 + 1):
+            row = j * self.grid_size
+            for i in range(i0, i1 + 1):
+                states.add(self.cells[row + i])
+                if BOUNDARY in states or len(states) > 1:
+                    return BOUNDARY
+        state = states.pop()
+        if state == INSIDE and overflow:
+            return BOUNDARY
+        return state
+
+    def intersects(self, geom, bbox=None):
+        """True se la geometria interseca il poligono"""
+        if bbox is None:
+            rect = geom.boundingBox()
+            bbox = (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
+        state = self.classify_bbox(*bbox)
+        if state == BOUNDARY:
+            self.exact_tests += 1
+            result = self.engine.intersects(geom.constGet())
+        else:
+            result = state == INSIDE
+        if result:
+            self.kept += 1
+        else:
+            self.discarded += 1
+        return result
+
+    def filter_records(self, records):
+        """Record (vedi catasto_wfs) che intersecano il poligono"""
+        kept = []
+        for record in records:
+            state = self.classify_bbox(*record['bbox'])
+            if state == BOUNDARY:
+                self.exact_tests += 1
+                inside = self.engine.intersects(QgsGeometry.fromWkt(record['wkt']).constGet())
+            else:
+                inside = state == INSIDE
+            if inside:
+                self.kept += 1
+                kept.append(record)
+            else:
+                self.discarded += 1
+        return kept
+
+    def summary(self):
+        return (f"Ritaglio sul poligono: {self.kept} feature tenute, {self.discarded} scartate "
+                f"({self.exact_tests} test geometrici esatti)")
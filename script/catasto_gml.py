@@ -0,0 +1,402 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Lettura dei GML catastali: conversione degli elementi delle feature in record
+e lettura in parallelo dei file GML molto grandi.
+
+Un GML di un comune grande viene diviso in intervalli di byte che iniziano
+sempre all'apertura di un featureMember. Ogni intervallo, con l'intestazione
+del file (dichiarazione XML e tag radice con i namespace) davanti e la
+chiusura della radice in coda, è un documento XML completo: lo legge un
+processo separato e i record tornano nell'ordine degli intervalli, quindi il
+risultato è identico alla lettura dell'intero file in un solo processo.
+
+Il modulo non importa QGIS a livello di modulo perché lo caricano anche i
+processi di lettura: interpreti Python nuovi (spawn) su tutte le
+piattaforme, perché un fork del processo di QGIS non è sicuro.
+"""
+
+import io
+import multiprocessing
+import os
+import pickle
+import re
+import shutil
+import sys
+import tempfile
+import xml.etree.ElementTree as ET
+from collections import deque, namedtuple
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+
+GML_NAMESPACE = 'http://www.opengis.net/gml/3.2'
+
+PARSE_WORKERS = max(1, min(8, (os.cpu_count() or 2) - 1))
+# Dimensione indicativa di ogni intervallo letto da un processo
+RANGE_SIZE = 32 * 1024 * 1024
+# Sopra questa dimensione i GML vengono letti in parallelo prima del merge
+PARALLEL_GML_SIZE = 256 * 1024 * 1024
+# Byte letti per cercare l'intestazione, la chiusura della radice e i confini
+SCAN_SIZE = 1024 * 1024
+# Record per blocco nel file temporaneo della conversione
+SPOOL_BATCH = 5000
+
+GmlLayout = namedtuple('GmlLayout', 'header root member gml start end')
+
+_ROOT_TAG = re.compile(rb'<([A-Za-z_][\w.\-]*(?::[\w.\-]+)?)[^>]*>')
+_MEMBER_TAG = re.compile(rb'<((?:[\w.\-]+:)?(?:featureMember|member))[\s>]')
+_GML_XMLNS = re.compile(rb'xmlns:gml\s*=\s*["\']([^"\']+)["\']')
+
+
+def _ring_coords(pos_list):
+    """Coppie (lon, lat) di un gml:posList in ordine lat/lon"""
+    values = pos_list.split()
+    return [(float(values[i + 1]), float(values[i])) for i in range(0, len(values) - 1, 2)]
+
+
+def _ring_text(ring, tag):
+    """Coordinate di un anello: gml:posList oppure una sequenza di gml:pos"""
+    pos_list = ring.find('.//' + tag + 'posList')
+    if pos_list is not None:
+        return pos_list.text
+    return ' '.join(pos.text for pos in ring.iter(tag + 'pos') if pos.text) or None
+
+
+def _attributes(element, tag, attrs, prefix=''):
+    """
+    Valori delle proprietà della feature: le proprietà annidate diventano
+    campi con i nomi uniti da '_', come li appiattisce GDAL; le proprietà
+    geometriche (con elementi GML dentro) non sono attributi.
+    """
+    for child in element:
+        name = prefix + child.tag.rsplit('}', 1)[-1]
+        if len(child) == 0:
+            if child.text is not None:
+                attrs[name] = child.text.strip()
+        elif not any(node.tag.startswith(tag) for node in child.iter() if node is not child):
+            _attributes(child, tag, attrs, name + '_')
+
+
+def parse_feature_element(element, gml=GML_NAMESPACE):
+    """
+    Converte un elemento GML di una feature in record:
+    {'key', 'id', 'wkt', 'bbox': (xmin, ymin, xmax, ymax), 'attrs': {...}}
+    Legge gml:Polygon e le gml:PolygonPatch di gml:Surface.
+    Restituisce None se la feature non ha una geometria leggibile.
+    """
+    tag = '{' + gml + '}'
+    surfaces = (tag + 'Polygon', tag + 'PolygonPatch')
+    polygons = []
+    xs = []
+    ys = []
+    for polygon in element.iter():
+        if polygon.tag not in surfaces:
+            continue
+        rings = []
+        for ring_tag in ('exterior', 'interior'):
+            for ring in polygon.findall(tag + ring_tag):
+                text = _ring_text(ring, tag)
+                if not text:
+                    continue
+                coords = _ring_coords(text)
+                xs.extend(c[0] for c in coords)
+                ys.extend(c[1] for c in coords)
+                rings.append('(' + ', '.join(f"{x} {y}" for x, y in coords) + ')')
+        if rings:
+            polygons.append('(' + ', '.join(rings) + ')')
+    if not polygons:
+        return None
+
+    if len(polygons) == 1:
+        wkt = f"POLYGON{polygons[0]}"
+    else:
+        wkt = f"MULTIPOLYGON({', '.join(polygons)})"
+
+    attrs = {}
+    _attributes(element, tag, attrs)
+    gml_id = element.get(tag + 'id')
+    key = attrs.get('INSPIREID_LOCALID') or gml_id
+    return {'key': key, 'id': gml_id, 'wkt': wkt, 'bbox': (min(xs), min(ys), max(xs), max(ys)), 'attrs': attrs}
+
+
+def parse_members(stream, gml=GML_NAMESPACE, skipped=None):
+    """
+    Record delle feature dei figli della radice (featureMember/member), letti in streaming.
+    Args:
+        skipped (list): se indicata, vi si aggiungono i gml:id delle feature senza geometria leggibile
+    """
+    depth = 0
+    for event, element in ET.iterparse(stream, events=('start', 'end')):
+        if event == 'start':
+            depth += 1
+            continue
+        depth -= 1
+        if depth == 1:
+            for feature in element:
+                record = parse_feature_element(feature, gml)
+                if record:
+                    yield record
+                elif skipped is not None:
+                    skipped.append(feature.get('{' + gml + '}id') or feature.tag.rsplit('}', 1)[-1])
+            element.clear()
+
+
+def parse_gml(path, skipped=None):
+    """Record di un file GML, in un solo processo"""
+    layout = gml_layout(path)
+    with open(path, 'rb') as stream:
+        yield from parse_members(stream, layout.gml if layout else GML_NAMESPACE, skipped)
+
+
+# --- divisione in intervalli ---------------------------------------------------------------
+
+def gml_layout(path):
+    """
+    Struttura del file per la divisione: intestazione fino al tag radice, nome
+    della radice, tag dei membri, namespace GML, inizio del primo membro e
+    posizione della chiusura della radice. None se il file non si può dividere
+    (es. feature dentro un unico gml:featureMembers).
+    """
+    size = os.path.getsize(path)
+    with open(path, 'rb') as f:
+        head = f.read(SCAN_SIZE)
+        f.seek(max(0, size - SCAN_SIZE))
+        tail = f.read()
+    position = 0
+    while True:
+        match = _ROOT_TAG.search(head, position)
+        if match is None:
+            return None
+        # Salta dichiarazione XML, commenti e DOCTYPE
+        if head[match.start() + 1:match.start() + 2] in (b'?', b'!'):
+            position = match.end()
+            continue
+        break
+    header = head[:match.end()]
+    root = match.group(1)
+    member = _MEMBER_TAG.search(head, match.end())
+    closing = tail.rfind(b'</' + root)
+    if member is None or closing < 0 or header.endswith(b'/>'):
+        return None
+    xmlns = _GML_XMLNS.search(header)
+    gml = xmlns.group(1).decode('ascii') if xmlns else GML_NAMESPACE
+    return GmlLayout(header, root, member.group(1), gml, member.start(), max(0, size - SCAN_SIZE) + closing)
+
+
+def _next_member(f, layout, offset):
+    """Posizione della prima apertura di un membro a partire da offset (o la fine dei membri)"""
+    pattern = re.compile(b'<' + re.escape(layout.member) + rb'[\s>]')
+    overlap = len(layout.member) + 2
+    while offset < layout.end:
+        f.seek(offset)
+        block = f.read(SCAN_SIZE + overlap)
+        match = pattern.search(block)
+        if match:
+            return min(offset + match.start(), layout.end)
+        if len(block) <= overlap:
+            break
+        offset += SCAN_SIZE
+    return layout.end
+
+
+def split_ranges(path, layout, parts):
+    """Intervalli (inizio, fine) di circa la stessa dimensione, allineati ai featureMember"""
+    length = layout.end - layout.start
+    bounds = [layout.start]
+    with open(path, 'rb') as f:
+        for i in range(1, parts):
+            bound = _next_member(f, layout, layout.start + length * i // parts)
+            if bound > bounds[-1] and bound < layout.end:
+                bounds.append(bound)
+    bounds.append(layout.end)
+    return list(zip(bounds[:-1], bounds[1:]))
+
+
+def parse_range(path, start, end, header, root, gml):
+    """
+    Record di un intervallo del file (eseguita nei processi di lettura)
+    Returns:
+        (record, gml:id delle feature senza geometria leggibile)
+    """
+    with open(path, 'rb') as f:
+        f.seek(start)
+        chunk = f.read(end - start)
+    document = io.BytesIO(header + chunk + b'</' + root + b'>')
+    skipped = []
+    return list(parse_members(document, gml, skipped)), skipped
+
+
+def _python_executable():
+    """Interprete Python dell'installazione (dentro QGIS sys.executable è l'eseguibile di QGIS)"""
+    if sys.platform == 'win32':
+        return os.path.join(sys.exec_prefix, 'pythonw.exe')
+    version = f"python{sys.version_info.major}.{sys.version_info.minor}"
+    for name in (version, f"python{sys.version_info.major}"):
+        path = os.path.join(sys.exec_prefix, 'bin', name)
+        if os.path.exists(path):
+            return path
+    return shutil.which(version) or shutil.which(f"python{sys.version_info.major}") or sys.executable
+
+
+def _mp_context():
+    """Contesto spawn su tutte le piattaforme: il fork di un processo con Qt e thread attivi non è sicuro"""
+    if not os.path.basename(sys.executable).lower().startswith('python'):
+        # I processi devono partire con l'interprete Python, non con un nuovo QGIS
+        multiprocessing.set_executable(_python_executable())
+    return multiprocessing.get_context('spawn')
+
+
+def parse_gml_parallel(path, workers=PARSE_WORKERS, range_size=RANGE_SIZE, skipped=None):
+    """
+    Record di un file GML letto in parallelo, nello stesso ordine di parse_gml.
+    Al più workers * 2 intervalli letti restano in memoria. Se i processi non
+    partono si continua nel processo corrente dall'intervallo a cui si era arrivati.
+    Args:
+        skipped (list): se indicata, vi si aggiungono i gml:id delle feature senza geometria leggibile
+    """
+    if skipped is None:
+        skipped = []
+    layout = gml_layout(path)
+    if layout is None or workers < 2 or layout.end - layout.start < 2 * range_size:
+        yield from parse_gml(path, skipped)
+        return
+    ranges = split_ranges(path, layout, max(workers, (layout.end - layout.start) // range_size))
+    done = 0
+    try:
+        with ProcessPoolExecutor(max_workers=workers, mp_context=_mp_context()) as executor:
+            pending = deque()
+            queued = iter(ranges)
+            for start, end in queued:
+                pending.append(executor.submit(parse_range, path, start, end, layout.header, layout.root, layout.gml))
+                if len(pending) >= workers * 2:
+                    break
+            while pending:
+                records, missing = pending.popleft().result()
+                skipped.extend(missing)
+                following = next(queued, None)
+                if following:
+                    pending.append(executor.submit(parse_range, path, following[0], following[1],
+                                                   layout.header, layout.root, layout.gml))
+                done += 1
+                yield from records
+    except (BrokenProcessPool, OSError) as e:
+        print(f"Lettura parallela non disponibile ({str(e)}), si continua in un solo processo")
+        for start, end in ranges[done:]:
+            records, missing = parse_range(path, start, end, layout.header, layout.root, layout.gml)
+            skipped.extend(missing)
+            yield from records
+
+
+# --- conversione dei GML grandi per il merge -------------------------------------------------
+
+# Tipi dei campi come li ricava il driver GML di GDAL: intero, intero a 64 bit, reale, testo
+_INT, _INT64, _REAL, _STRING = range(4)
+
+
+def _value_type(value):
+    try:
+        number = int(value)
+        return _INT if -2 ** 31 <= number < 2 ** 31 else _INT64
+    except ValueError:
+        pass
+    try:
+        float(value)
+        return _REAL
+    except ValueError:
+        return _STRING
+
+
+def gml_to_gpkg(path, output, workers=PARSE_WORKERS, log=print):
+    """
+    Converte un GML in GeoPackage leggendolo in parallelo. I record passano da un
+    file temporaneo: i tipi dei campi (come li darebbe GDAL) si conoscono solo a
+    lettura finita; un campo sempre vuoto resta di testo. Le feature senza
+    geometria leggibile vengono segnalate con log.
+    Returns:
+        int: feature scritte
+    """
+    # QGIS solo qui: i processi di lettura importano questo modulo senza QGIS
+    from qgis.core import (QgsCoordinateReferenceSystem, QgsCoordinateTransformContext, QgsFeature,
+                           QgsField, QgsFields, QgsGeometry, QgsVectorFileWriter, QgsWkbTypes)
+    from PyQt5.QtCore import QVariant
+
+    names = []
+    # Tipo di ogni campo, None finché non si è visto un valore
+    types = {}
+    skipped = []
+    count = 0
+    with tempfile.TemporaryFile() as spool:
+        batch = []
+        for record in parse_gml_parallel(path, workers, skipped=skipped):
+            for name, value in record['attrs'].items():
+                if name not in types:
+                    names.append(name)
+                    types[name] = None
+                if types[name] != _STRING and value:
+                    value_type = _value_type(value)
+                    types[name] = value_type if types[name] is None else max(types[name], value_type)
+            batch.append(record)
+            if len(batch) >= SPOOL_BATCH:
+                pickle.dump(batch, spool, pickle.HIGHEST_PROTOCOL)
+                batch = []
+        if batch:
+            pickle.dump(batch, spool, pickle.HIGHEST_PROTOCOL)
+        if skipped:
+            log(f"{os.path.basename(path)}: {len(skipped)} feature senza geometria leggibile non convertite "
+                f"({', '.join(skipped[:5])}{'...' if len(skipped) > 5 else ''})")
+        for name in names:
+            if types[name] is None:
+                types[name] = _STRING
+
+        variant = {_INT: QVariant.Int, _INT64: QVariant.LongLong, _REAL: QVariant.Double, _STRING: QVariant.String}
+        converters = {_INT: int, _INT64: int, _REAL: float, _STRING: str}
+        fields = QgsFields()
+        fields.append(QgsField('gml_id', QVariant.String))
+        for name in names:
+            fields.append(QgsField(name, variant[types[name]]))
+        options = QgsVectorFileWriter.SaveVectorOptions()
+        options.driverName = 'GPKG'
+        options.layerName = os.path.splitext(os.path.basename(path))[0]
+        writer = QgsVectorFileWriter.create(output, fields, QgsWkbTypes.MultiPolygon,
+                                            QgsCoordinateReferenceSystem('EPSG:6706'),
+                                            QgsCoordinateTransformContext(), options)
+        if writer.hasError() != QgsVectorFileWriter.NoError:
+            raise Exception(f"Impossibile creare {output}: {writer.errorMessage()}")
+
+        spool.seek(0)
+        while True:
+            try:
+                batch = pickle.load(spool)
+            except EOFError:
+                break
+            features = []
+            for record in batch:
+                feat = QgsFeature(fields)
+                feat['gml_id'] = record['id']
+                for name, value in record['attrs'].items():
+                    feat[name] = converters[types[name]](value) if value else None
+                geom = QgsGeometry.fromWkt(record['wkt'])
+                geom.convertToMultiType()
+                feat.setGeometry(geom)
+                features.append(feat)
+            writer.addFeatures(features)
+            count += len(features)
+        del writer
+    return count
+
+
+def convert_large_gml(gml_files, folder, min_size=PARALLEL_GML_SIZE, workers=PARSE_WORKERS, log=print):
+    """
+    Lista dei file da unire, con i GML più grandi di min_size sostituiti da un
+    GeoPackage nella cartella indicata, letto in parallelo.
+    """
+    result = []
+    for path in gml_files:
+        if workers > 1 and os.path.getsize(path) >= min_size:
+            output = os.path.join(folder, os.path.splitext(os.path.basename(path))[0] + '.gpkg')
+            count = gml_to_gpkg(path, output, workers, log)
+            log(f"{os.path.basename(path)} letto in parallelo ({workers} processi): {count} feature")
+            result.append(output)
+        else:
+            result.append(path)
+    return result
@@ -0,0 +1,363 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Client HTTP condiviso dagli script del catasto.
+
+Mantiene un pool di connessioni keep-alive per host (una stessa connessione
+TLS viene riutilizzata per tutte le pagine WFS), negozia la compressione gzip
+e applica a tutte le richieste gli stessi header e timeout.
+
+Uso tipico dagli script da console:
+
+    from catasto_http import get_session
+    data = get_session().get(url)
+"""
+
+import gzip
+import http.client
+import threading
+import urllib.parse
+import urllib.request
+import zlib
+
+USER_AGENT = 'Mozilla/5.0 QGIS/33415/Windows 11 Version 2009'
+DEFAULT_TIMEOUT = 60
+MAX_CONNECTIONS_PER_HOST = 4
+MAX_REDIRECTS = 5
+
+DEFAULT_HEADERS = {
+    'User-Agent': USER_AGENT,
+    'Accept': '*/*',
+    'Accept-Encoding': 'gzip',
+    'Connection': 'keep-alive'
+}
+
+# Errori tipici di una connessione keep-alive chiusa dal server mentre era inattiva
+_STALE_ERRORS = (http.client.RemoteDisconnected, http.client.BadStatusLine,
+                 ConnectionResetError, BrokenPipeError, ConnectionAbortedError)
+
+
+class HttpError(Exception):
+    """Risposta HTTP con codice di errore (>= 400)"""
+    def __init__(self, status, reason, url, retry_after=None):
+        super().__init__(f"HTTP {status} {reason} - {url}")
+        self.status = status
+        self.reason = reason
+        self.url = url
+        self.retry_after = retry_after
+
+
+class HttpResponse:
+    """Risposta già letta e decompressa"""
+    def __init__(self, status, headers, data, url):
+        self.status = status
+        self.headers = headers
+        self.data = data
+        self.url = url
+
+    def text(self, encoding='utf-8'):
+        return self.data.decode(encoding)
+
+
+class StreamResponse:
+    """
+    Risposta letta a blocchi (download di file grandi).
+    Alla chiusura la connessione torna nel pool se il corpo è stato letto tutto.
+    """
+    def __init__(self, session, key, conn, response, url):
+        self._session = session
+        self._key = key
+        self._conn = conn
+        self._response = response
+        self.url = url
+        self.status = response.status
+        self.headers = response.headers
+        self.length = int(response.getheader('Content-Length') or 0)
+
+    def read(self, size=-1):
+        # http.client legge fino alla chiusura del socket con -1: serve None per fermarsi a Content-Length
+        return self._response.read(None if size is None or size < 0 else size)
+
+    def close(self):
+        if self._conn is None:
+            return
+        reusable = self._response.isclosed() and not self._response.will_close
+        self._session._release(self._key, self._conn, reusable)
+        self._conn = None
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+
+class HttpSession:
+    """
+    Sessione HTTP con pool di connessioni persistenti per host.
+
+    Args:
+        timeout (float): timeout in secondi per connessione e lettura
+        max_per_host (int): numero massimo di connessioni inattive tenute per host
+        headers (dict): header aggiuntivi applicati a tutte le richieste
+    """
+    def __init__(self, timeout=DEFAULT_TIMEOUT, max_per_host=MAX_CONNECTIONS_PER_HOST, headers=None):
+        self.timeout = timeout
+        self.max_per_host = max_per_host
+        self.headers = dict(DEFAULT_HEADERS)
+        if headers:
+            self.headers.update(headers)
+        self._idle = {}
+        self._lock = threading.Lock()
+        self.connections_opened = 0
+        self.requests_sent = 0
+
+    # --- gestione del pool -------------------------------------------------
+
+    def _new_connection(self, scheme, host, port):
+        proxy = urllib.request.getproxies().get(scheme)
+        if proxy and not urllib.request.proxy_bypass(host):
+            proxy_url = urllib.parse.urlsplit(proxy if '://' in proxy else f"http://{proxy}")
+            if scheme == 'https':
+                # Tunnel CONNECT: il TLS resta end-to-end con il server WFS
+                conn = http.client.HTTPSConnection(proxy_url.hostname, proxy_url.port or 80,
+                                                   timeout=self.timeout)
+                conn.set_tunnel(host, port)
+            else:
+                conn = http.client.HTTPConnection(proxy_url.hostname, proxy_url.port or 80,
+                                                  timeout=self.timeout)
+                conn.via_proxy = True
+        elif scheme == 'https':
+            conn = http.client.HTTPSConnection(host, port, timeout=self.timeout)
+        else:
+            conn = http.client.HTTPConnection(host, port, timeout=self.timeout)
+        with self._lock:
+            self.connections_opened += 1
+        return conn
+
+    def _acquire(self, key):
+        with self._lock:
+            idle = self._idle.get(key)
+            if idle:
+                return idle.pop(), True
+        return self._new_connection(*key), False
+
+    def _release(self, key, conn, reusable):
+        if reusable:
+            with self._lock:
+                idle = self._idle.setdefault(key, [])
+                if len(idle) < self.max_per_host:
+                    idle.append(conn)
+                    return
+        conn.close()
+
+    def close(self):
+        """Chiude tutte le connessioni inattive"""
+        with self._lock:
+            pools = list(self._idle.values())
+            self._idle = {}
+        for idle in pools:
+            for conn in idle:
+                conn.close()
+
+    def prewarm(self, url):
+        """
+        Apre in anticipo una connessione (TCP + TLS) verso l'host di url e la
+        lascia nel pool: la prima richiesta vera non paga l'handshake.
+        """
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        key = (scheme, parts.hostname, parts.port or (443 if scheme == 'https' else 80))
+        with self._lock:
+            if self._idle.get(key):
+                return
+        conn = self._new_connection(*key)
+        conn.connect()
+        self._release(key, conn, True)
+
+    # --- richieste -----------------------------------------------------------
+
+    def _send(self, method, url, headers, body, timeout):
+        """Invia la richiesta e restituisce (chiave, connessione, risposta) senza leggere il corpo"""
+        parts = urllib.parse.urlsplit(url)
+        scheme = parts.scheme.lower()
+        port = parts.port or (443 if scheme == 'https' else 80)
+        key = (scheme, parts.hostname, port)
+        path = parts.path or '/'
+        if parts.query:
+            path = f"{path}?{parts.query}"
+
+        all_headers = dict(self.headers)
+        if headers:
+            all_headers.update(headers)
+
+        while True:
+            conn, reused = self._acquire(key)
+            conn.timeout = timeout if timeout is not None else self.timeout
+            if conn.sock is not None:
+                conn.sock.settimeout(conn.timeout)
+            target = url if getattr(conn, 'via_proxy', False) else path
+            try:
+                conn.request(method, target, body=body, headers=all_headers)
+                response = conn.getresponse()
+            except _STALE_ERRORS:
+                conn.close()
+                if reused:
+                    # Connessione chiusa dal server mentre era nel pool: riprova con una nuova
+                    continue
+                raise
+            except Exception:
+                conn.close()
+                raise
+            with self._lock:
+                self.requests_sent += 1
+            return key, conn, response
+
+    def _open(self, method, url, headers, body, timeout):
+        """Segue i redirect e solleva HttpError per i codici di errore"""
+        for _ in range(MAX_REDIRECTS + 1):
+            key, conn, response = self._send(method, url, headers, body, timeout)
+            if response.status in (301, 302, 303, 307, 308):
+                location = response.getheader('Location')
+                response.read()
+                self._release(key, conn, not response.will_close)
+                url = urllib.parse.urljoin(url, location)
+                if response.status == 303:
+                    method, body = 'GET', None
+                continue
+            if response.status >= 400:
+                response.read()
+                self._release(key, conn, not response.will_close)
+                raise HttpError(response.status, response.reason, url,
+                                response.getheader('Retry-After'))
+            return key, conn, response, url
+        raise HttpError(310, 'Troppi redirect', url)
+
+    def request(self, method, url, headers=None, body=None, timeout=None):
+        """Esegue una richiesta e restituisce una HttpResponse con il corpo decompresso"""
+        key, conn, response, url = self._open(method, url, headers, body, timeout)
+        try:
+            data = response.read()
+        except Exception:
+            conn.close()
+            raise
+        self._release(key, conn, not response.will_close)
+
+        encoding = (response.getheader('Content-Encoding') or '').lower()
+        if encoding == 'gzip':
+            data = gzip.decompress(data)
+        elif encoding == 'deflate':
+            data = zlib.decompress(data)
+        return HttpResponse(response.status, response.headers, data, url)
+
+    def get(self, url, headers=None, timeout=None):
+        """GET e restituisce il corpo della risposta (bytes)"""
+        return self.request('GET', url, headers=headers, timeout=timeout).data
+
+    def get_text(self, url, headers=None, timeout=None, encoding='utf-8'):
+        """GET e restituisce il corpo della risposta come testo"""
+        return self.get(url, headers=headers, timeout=timeout).decode(encoding)
+
+    def stream(self, url, headers=None, timeout=None):
+        """
+        GET da leggere a blocchi, per i download grandi (es. GetDataset.php).
+        Non chiede la compressione: gli zip sono già compressi.
+        """
+        stream_headers = {'Accept-Encoding': 'identity'}
+        if headers:
+            stream_headers.update(headers)
+        key, conn, response, url = self._open('GET', url, stream_headers, None, timeout)
+        return StreamResponse(self, key, conn, response, url)
+
+
+_session = None
+_session_lock = threading.Lock()
+
+
+def get_session():
+    """Sessione condivisa dal processo: le connessioni restano calde tra un'esecuzione e l'altra"""
+    global _session
+    with _session_lock:
+        if _session is None:
+            _session = HttpSession()
+        return _session
+
+
+def download_to_file(url, dest_path, progress_callback=None, block_size=65536, session=None):
+    """
+    Scarica un file riutilizzando le connessioni della sessione.
+
+    Args:
+        progress_callback: funzione (scaricati, totale) -> bool; se restituisce False
+            il download viene interrotto
+    Returns:
+        bool: True se il download è stato completato
+    """
+    session = session or get_session()
+    with session.stream(url) as response:
+        total_size = response.length
+        downloaded_size = 0
+        with open(dest_path, 'wb') as f:
+            while True:
+                buffer = response.read(block_size)
+                if not buffer:
+                    break
+                f.write(buffer)
+                downloaded_size += len(buffer)
+                if progress_callback and progress_callback(downloaded_size, total_size) is False:
+                    return False
+    return True
+
+
+def check_connection_reuse(pages=50, workers=MAX_CONNECTIONS_PER_HOST):
+    """
+    Verifica del riuso delle connessioni contro un server locale (http.server)
+    che conta le connessioni accettate: scarica pages pagine compresse in
+    sequenza e poi in parallelo con workers thread, con una sessione nuova.
+    Returns:
+        dict: richieste inviate, connessioni aperte dalla sessione e accettate dal server;
+        con il keep-alive le connessioni sono al più workers, non una per pagina
+    """
+    from concurrent.futures import ThreadPoolExecutor
+    from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+    class CountingServer(ThreadingHTTPServer):
+        daemon_threads = True
+        accepted = 0
+
+        def get_request(self):
+            request = super().get_request()
+            self.accepted += 1
+            return request
+
+    class PageHandler(BaseHTTPRequestHandler):
+        protocol_version = 'HTTP/1.1'
+
+        def do_GET(self):
+            body = gzip.compress(f"<pagina>{self.path}</pagina>".encode('utf-8') * 100)
+            self.send_response(200)
+            self.send_header('Content-Type', 'text/xml')
+            self.send_header('Content-Encoding', 'gzip')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+        def log_message(self, *args):
+            pass
+
+    server = CountingServer(('127.0.0.1', 0), PageHandler)
+    thread = threading.Thread(target=server.serve_forever, daemon=True)
+    thread.start()
+    session = HttpSession(timeout=10, max_per_host=workers)
+    base = f"http://127.0.0.1:{server.server_address[1]}"
+    try:
+        for i in range(pages):
+            session.get(f"{base}/pagina/{i}")
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            list(executor.map(lambda i: session.get(f"{base}/parallela/{i}"), range(pages)))
+    finally:
+        session.close()
+        server.shutdown()
+        server.server_close()
+    return {'requests': session.requests_sent, 'connections': session.connections_opened,
+            'accepted': server.accepted}
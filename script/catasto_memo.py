@@ -0,0 +1,119 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Memoizzazione delle funzioni di espressione del catasto.
+
+Campi virtuali, tabella attributi ed etichette rivalutano le stesse
+espressioni di continuo: i risultati restano in una cache LRU con scadenza
+(TTL), condivisa da tutto il processo QGIS, così una nuova valutazione sullo
+stesso punto o sugli stessi codici non passa dalla rete.
+
+Dalla console di QGIS:
+
+    from catasto_memo import memo_stats, clear_memo
+    print(memo_stats())
+    clear_memo()
+"""
+
+import threading
+import time
+from collections import OrderedDict
+
+DEFAULT_MAX_ENTRIES = 20000
+DEFAULT_TTL = 24 * 3600
+# Le coordinate sono arrotondate a 1e-7 gradi (circa 1 cm): lo stesso punto
+# ridigitalizzato o riproiettato dà la stessa chiave
+SNAP_DECIMALS = 7
+
+
+def snap_point(x, y, decimals=SNAP_DECIMALS):
+    """Chiave di cache per un punto"""
+    return (round(x, decimals), round(y, decimals))
+
+
+class LruCache:
+    """
+    Cache LRU con scadenza delle voci.
+
+    Args:
+        max_entries (int): numero massimo di voci; oltre si scartano le meno usate
+        ttl (float): durata in secondi di una voce
+    """
+    def __init__(self, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+        self.max_entries = max_entries
+        self.ttl = ttl
+        self._data = OrderedDict()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    def get(self, key, default=None):
+        with self._lock:
+            entry = self._data.get(key)
+            if entry is not None:
+                value, expires = entry
+                if expires > time.monotonic():
+                    self._data.move_to_end(key)
+                    self.hits += 1
+                    return value
+                del self._data[key]
+            self.misses += 1
+            return default
+
+    def __contains__(self, key):
+        """True se la voce c'è ed è valida (senza contare hit o miss)"""
+        with self._lock:
+            entry = self._data.get(key)
+            return entry is not None and entry[1] > time.monotonic()
+
+    def put(self, key, value):
+        with self._lock:
+            self._data[key] = (value, time.monotonic() + self.ttl)
+            self._data.move_to_end(key)
+            while len(self._data) > self.max_entries:
+                self._data.popitem(last=False)
+
+    def clear(self):
+        with self._lock:
+            self._data.clear()
+            self.hits = 0
+            self.misses = 0
+
+    def __len__(self):
+        return len(self._data)
+
+    def stats(self):
+        total = self.hits + self.misses
+        return {
+            'entries': len(self._data),
+            'hits': self.hits,
+            'misses': self.misses,
+            'hit_rate': self.hits / total if total else 0.0
+        }
+
+
+_memos = {}
+_memos_lock = threading.Lock()
+
+
+def get_memo(name, max_entries=DEFAULT_MAX_ENTRIES, ttl=DEFAULT_TTL):
+    """Cache con nome, unica per il processo (una per funzione di espressione)"""
+    with _memos_lock:
+        memo = _memos.get(name)
+        if memo is None:
+            memo = _memos[name] = LruCache(max_entries, ttl)
+        return memo
+
+
+def clear_memo(name=None):
+    """Svuota la cache indicata, o tutte"""
+    with _memos_lock:
+        memos = [_memos[name]] if name in _memos else ([] if name else list(_memos.values()))
+    for memo in memos:
+        memo.clear()
+
+
+def memo_stats():
+    """Statistiche di tutte le cache: {nome: {'entries', 'hits', 'misses', 'hit_rate'}}"""
+    with _memos_lock:
+        return {name: memo.stats() for name, memo in _memos.items()}
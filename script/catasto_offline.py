@@ -0,0 +1,430 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Ricerca delle particelle sui GeoPackage uniti prodotti dagli script di merge
+(`{prov_code}_ple_unito.gpkg` di catasto_unzip_merge_prov, file PLE di
+console_qgis_download), senza passare dal WFS.
+
+Il GeoPackage è letto direttamente con sqlite3: la ricerca per punto usa il
+suo indice spaziale R-tree, la ricerca per riferimento catastale un indice
+costruito una volta sola in un file accanto al GeoPackage
+(`*.gpkg.catasto_idx`), ricostruito se il GeoPackage cambia. L'indice si crea
+alla registrazione (gli script di merge la fanno da soli); se manca o non è
+aggiornato all'apertura si crea in background, e fino ad allora il
+GeoPackage non risponde alle ricerche per riferimento. Anche i profili
+compatti (*.cpkg di catasto_compact) si registrano e si leggono direttamente.
+
+ParcelBackend sceglie la sorgente secondo la configurazione in
+`~/.catasto_unzip_all/offline.json`:
+
+    'wfs'      solo il WFS
+    'offline'  solo i GeoPackage registrati
+    'auto'     il WFS, ma se non risponde o è lento si passa ai GeoPackage
+               per OFFLINE_COOLDOWN secondi
+
+Dalla console di QGIS:
+
+    from catasto_offline import register_gpkg, set_mode
+    register_gpkg('/percorso/82_ple_unito.gpkg')
+    set_mode('auto')
+"""
+
+import json
+import os
+import sqlite3
+import struct
+import threading
+import time
+
+from qgis.core import QgsGeometry
+
+from catasto_geom import records_at_point
+from catasto_refindex import reference_from_id
+from catasto_wfs import PARCEL_ATTRIBUTES
+
+CONFIG_PATH = os.path.join(os.path.expanduser('~'), '.catasto_unzip_all', 'offline.json')
+MODES = ('wfs', 'offline', 'auto')
+DEFAULT_MODE = 'auto'
+INDEX_SUFFIX = '.catasto_idx'
+# Oltre questa latenza (secondi) il WFS è considerato lento
+SLOW_LATENCY = 5.0
+# Dopo un errore o una risposta lenta si resta sui GeoPackage per questo tempo
+OFFLINE_COOLDOWN = 120
+
+# Dimensione dell'envelope nell'header delle geometrie GeoPackage, per indicatore
+_ENVELOPE_SIZES = {0: 0, 1: 32, 2: 48, 3: 48, 4: 64}
+
+
+# --- configurazione ------------------------------------------------------------------
+
+def load_config():
+    """Configurazione {'mode', 'paths'}; valori predefiniti se il file non esiste"""
+    config = {'mode': DEFAULT_MODE, 'paths': []}
+    if os.path.exists(CONFIG_PATH):
+        try:
+            with open(CONFIG_PATH, 'r', encoding='utf-8') as f:
+                config.update(json.load(f))
+        except (OSError, ValueError):
+            pass
+    return config
+
+
+def save_config(config):
+    os.makedirs(os.path.dirname(CONFIG_PATH), exist_ok=True)
+    tmp_path = CONFIG_PATH + '.tmp'
+    with open(tmp_path, 'w', encoding='utf-8') as f:
+        json.dump(config, f, indent=2)
+    os.replace(tmp_path, CONFIG_PATH)
+
+
+def register_gpkg(path, build_index=True):
+    """
+    Aggiunge un GeoPackage di particelle unite (o il suo profilo compatto .cpkg)
+    a quelli usati per la ricerca offline.
+    Con build_index crea subito l'indice dei riferimenti, così gli strumenti che
+    usano il GeoPackage non devono costruirlo all'avvio.
+    """
+    config = load_config()
+    path = os.path.abspath(path)
+    if build_index:
+        open_package(path, build_index=True)
+    if path not in config['paths']:
+        config['paths'].append(path)
+        save_config(config)
+
+
+def set_mode(mode):
+    """Imposta la sorgente: 'wfs', 'offline' o 'auto'"""
+    if mode not in MODES:
+        raise ValueError(f"Modalità non valida: {mode} (usare {', '.join(MODES)})")
+    config = load_config()
+    config['mode'] = mode
+    save_config(config)
+
+
+# --- lettura dei GeoPackage ------------------------------------------------------------
+
+def gpkg_geometry_wkb(blob):
+    """WKB di una geometria GeoPackage (senza header)"""
+    flags = blob[3]
+    return bytes(blob[8 + _ENVELOPE_SIZES.get((flags >> 1) & 7, 0):])
+
+
+def gpkg_envelope(blob):
+    """(xmin, ymin, xmax, ymax) dall'header della geometria, None se l'header non lo contiene"""
+    flags = blob[3]
+    if not (flags >> 1) & 7:
+        return None
+    order = '<' if flags & 1 else '>'
+    xmin, xmax, ymin, ymax = struct.unpack(order + 'dddd', bytes(blob[8:40]))
+    return xmin, ymin, xmax, ymax
+
+
+class ParcelGeoPackage:
+    """
+    Un GeoPackage di particelle unite, aperto in sola lettura.
+
+    Args:
+        path (str): percorso del file .gpkg
+        build_index (bool): se l'indice dei riferimenti manca lo crea subito;
+            altrimenti lo crea in un thread in background (ready diventa True alla fine)
+    """
+    def __init__(self, path, build_index=False):
+        self.path = path
+        self._local = threading.local()
+        self._builder = None
+        db = self._db()
+        self.table, self.geom_column, rtree = self._describe(db)
+        columns = db.execute(f'PRAGMA table_info("{self.table}")').fetchall()
+        self.pk = next((c[1] for c in columns if c[5]), 'fid')
+        self.columns = [c[1] for c in columns]
+        self.attributes = [name for name in self.columns if name in PARCEL_ATTRIBUTES]
+        # Colonna da cui si ricava il riferimento catastale
+        for name in ('NATIONALCADASTRALREFERENCE', 'INSPIREID_LOCALID', 'gml_id'):
+            if name in self.columns:
+                self.ref_column = name
+                break
+        else:
+            raise Exception(f"{path}: manca il riferimento catastale (NATIONALCADASTRALREFERENCE o gml_id)")
+        self.has_rtree = db.execute("SELECT 1 FROM sqlite_master WHERE name = ?", (rtree,)).fetchone() is not None
+        self.index_path = path + INDEX_SUFFIX
+        self.rtree = f'"{rtree}"' if self.has_rtree else 'idx.bboxes'
+        self.ready = self._index_is_current()
+        if not self.ready and build_index:
+            self.build_index()
+        self.extent = self._extent() if self.ready or self.has_rtree else None
+        if not self.ready:
+            # Su un GeoPackage regionale richiede minuti: non si blocca QGIS
+            self._builder = threading.Thread(target=self._build_in_background, daemon=True)
+            self._builder.start()
+
+    def _describe(self, db):
+        """Tabella delle particelle, colonna della geometria e nome dell'indice spaziale"""
+        row = db.execute("SELECT c.table_name, g.column_name FROM gpkg_contents c "
+                         "JOIN gpkg_geometry_columns g ON g.table_name = c.table_name "
+                         "WHERE c.data_type = 'features' LIMIT 1").fetchone()
+        if row is None:
+            raise Exception(f"Nessun layer vettoriale in {self.path}")
+        return row[0], row[1], f"rtree_{row[0]}_{row[1]}"
+
+    def _geometry(self, blob):
+        """QgsGeometry dal valore della colonna della geometria"""
+        geom = QgsGeometry()
+        geom.fromWkb(gpkg_geometry_wkb(blob))
+        return geom
+
+    def _db(self):
+        # Una connessione per thread: le ricerche arrivano anche dai QgsTask
+        db = getattr(self._local, 'db', None)
+        if db is None:
+            db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+            if os.path.exists(self.path + INDEX_SUFFIX):
+                db.execute('ATTACH DATABASE ? AS idx', (self.path + INDEX_SUFFIX,))
+            self._local.db = db
+        return db
+
+    def _index_is_current(self):
+        if not os.path.exists(self.index_path):
+            return False
+        with sqlite3.connect(self.index_path) as idx:
+            try:
+                row = idx.execute("SELECT value FROM meta WHERE key = 'source'").fetchone()
+            except sqlite3.DatabaseError:
+                return False
+        stat = os.stat(self.path)
+        return row is not None and row[0] == f"{stat.st_size}:{stat.st_mtime_ns}"
+
+    def _build_in_background(self):
+        try:
+            self.build_index()
+        except Exception as e:
+            print(f"Indice dei riferimenti non creato per {os.path.basename(self.path)}: {str(e)}")
+
+    def build_index(self):
+        """Crea (o ricrea se il GeoPackage è cambiato) l'indice dei riferimenti"""
+        if self._index_is_current():
+            self.ready = True
+            return
+        with_bboxes = not self.has_rtree
+        print(f"Creazione dell'indice dei riferimenti per {os.path.basename(self.path)}...")
+        tmp_path = self.index_path + '.tmp'
+        if os.path.exists(tmp_path):
+            os.remove(tmp_path)
+        idx = sqlite3.connect(tmp_path)
+        idx.execute('CREATE TABLE meta (key TEXT PRIMARY KEY, value TEXT)')
+        idx.execute('CREATE TABLE refs (ref TEXT, fid INTEGER, PRIMARY KEY (ref, fid)) WITHOUT ROWID')
+        if with_bboxes:
+            idx.execute('CREATE VIRTUAL TABLE bboxes USING rtree(id, minx, maxx, miny, maxy)')
+        db = sqlite3.connect(f"file:{self.path}?mode=ro", uri=True)
+        query = f'SELECT "{self.pk}", "{self.ref_column}", "{self.geom_column}" FROM "{self.table}"'
+        refs = []
+        bboxes = []
+        for fid, value, blob in db.execute(query):
+            ref = reference_from_id(value)
+            if ref:
+                refs.append((ref, fid))
+            if with_bboxes and blob:
+                envelope = gpkg_envelope(blob)
+                if envelope is None:
+                    geom = QgsGeometry()
+                    geom.fromWkb(gpkg_geometry_wkb(blob))
+                    rect = geom.boundingBox()
+                    envelope = (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum())
+                bboxes.append((fid, envelope[0], envelope[2], envelope[1], envelope[3]))
+            if len(refs) >= 50000 or len(bboxes) >= 50000:
+                self._flush_index(idx, refs, bboxes)
+        self._flush_index(idx, refs, bboxes)
+        db.close()
+        stat = os.stat(self.path)
+        idx.execute("INSERT INTO meta VALUES ('source', ?)", (f"{stat.st_size}:{stat.st_mtime_ns}",))
+        idx.commit()
+        idx.close()
+        os.replace(tmp_path, self.index_path)
+        # Le connessioni già aperte non vedono il nuovo indice
+        self._local = threading.local()
+        self.ready = True
+        if with_bboxes:
+            self.extent = self._extent()
+
+    def _flush_index(self, idx, refs, bboxes):
+        idx.executemany('INSERT OR IGNORE INTO refs VALUES (?, ?)', refs)
+        if bboxes:
+            idx.executemany('INSERT INTO bboxes VALUES (?, ?, ?, ?, ?)', bboxes)
+        refs.clear()
+        bboxes.clear()
+
+    def _extent(self):
+        row = self._db().execute(f'SELECT min(minx), min(miny), max(maxx), max(maxy) FROM {self.rtree}').fetchone()
+        return tuple(row) if row and row[0] is not None else None
+
+    def contains_point(self, x, y):
+        """True se il punto cade nell'estensione del GeoPackage"""
+        e = self.extent
+        return e is not None and e[0] <= x <= e[2] and e[1] <= y <= e[3]
+
+    def _records(self, rows):
+        records = []
+        for row in rows:
+            fid, blob, values = row[0], row[1], row[2:]
+            if not blob:
+                continue
+            geom = self._geometry(blob)
+            rect = geom.boundingBox()
+            attrs = {name: str(value) for name, value in zip(self.attributes, values) if value is not None}
+            ref = reference_from_id(attrs.get(self.ref_column) or str(values[-1] or ''))
+            if ref:
+                # Attributi ricavabili dal riferimento se il merge non li ha conservati
+                attrs.setdefault('NATIONALCADASTRALREFERENCE', ref)
+                attrs.setdefault('ADMINISTRATIVEUNIT', ref[:4])
+                attrs.setdefault('LABEL', ref.split('.')[-1])
+            records.append({
+                'key': attrs.get('INSPIREID_LOCALID') or ref or str(fid),
+                'wkt': geom.asWkt(),
+                'bbox': (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()),
+                'attrs': attrs
+            })
+        return records
+
+    def _select(self):
+        columns = ', '.join(f't."{name}"' for name in self.attributes + [self.ref_column])
+        return f't."{self.pk}", t."{self.geom_column}", {columns} FROM "{self.table}" t'
+
+    def records_at(self, x, y):
+        """Record delle particelle che contengono il punto"""
+        rows = self._db().execute(
+            f'SELECT {self._select()} JOIN {self.rtree} r ON r.id = t."{self.pk}" '
+            f'WHERE r.minx <= ? AND r.maxx >= ? AND r.miny <= ? AND r.maxy >= ?',
+            (x, x, y, y)).fetchall()
+        return records_at_point(self._records(rows), x, y)
+
+    def records_by_refs(self, refs):
+        """Record delle particelle con i riferimenti catastali indicati (nessuno finché l'indice non è pronto)"""
+        if not self.ready:
+            return []
+        records = []
+        refs = list(refs)
+        for i in range(0, len(refs), 500):
+            chunk = refs[i:i + 500]
+            marks = ', '.join('?' * len(chunk))
+            rows = self._db().execute(
+                f'SELECT {self._select()} JOIN idx.refs i ON i.fid = t."{self.pk}" '
+                f'WHERE i.ref IN ({marks})', chunk).fetchall()
+            records.extend(self._records(rows))
+        return records
+
+
+def open_package(path, build_index=False):
+    """ParcelGeoPackage del file: GeoPackage unito o profilo compatto (*.cpkg) letto direttamente"""
+    if path.lower().endswith('.cpkg'):
+        # catasto_compact importa questo modulo: si importa solo quando serve
+        from catasto_compact import CompactParcelPackage
+        return CompactParcelPackage(path, build_index)
+    return ParcelGeoPackage(path, build_index)
+
+
+class OfflineParcels:
+    """Insieme dei GeoPackage registrati"""
+    def __init__(self, paths):
+        self.packages = []
+        for path in paths:
+            if not os.path.exists(path):
+                print(f"GeoPackage offline non trovato: {path}")
+                continue
+            try:
+                self.packages.append(open_package(path))
+            except Exception as e:
+                print(f"GeoPackage offline non utilizzabile {path}: {str(e)}")
+
+    def covers(self, x, y):
+        return any(package.contains_point(x, y) for package in self.packages)
+
+    def records_at(self, x, y):
+        for package in self.packages:
+            if package.contains_point(x, y):
+                records = package.records_at(x, y)
+                if records:
+                    return records
+        return []
+
+    def records_by_refs(self, refs):
+        refs = set(refs)
+        records = []
+        for package in self.packages:
+            if not refs:
+                break
+            found = package.records_by_refs(refs)
+            records.extend(found)
+            refs -= set(record['attrs'].get('NATIONALCADASTRALREFERENCE') for record in found)
+        return records
+
+
+_offline = None
+_offline_paths = None
+_offline_lock = threading.Lock()
+
+
+def get_offline():
+    """GeoPackage registrati nella configurazione (riaperti se la lista cambia)"""
+    global _offline, _offline_paths
+    paths = tuple(load_config()['paths'])
+    with _offline_lock:
+        if _offline is None or paths != _offline_paths:
+            _offline = OfflineParcels(paths)
+            _offline_paths = paths
+        return _offline
+
+
+class ParcelBackend:
+    """
+    Sorgente delle particelle per punto: WFS, GeoPackage offline o automatica.
+
+    Args:
+        mode (str): 'wfs', 'offline' o 'auto'; se None si legge la configurazione
+    """
+    def __init__(self, mode=None):
+        self.mode = mode or load_config()['mode']
+        self.offline = get_offline() if self.mode != 'wfs' else None
+        self._offline_until = 0.0
+
+    def records_at(self, x, y, online):
+        """
+        Args:
+            online: funzione (x, y) -> record, la ricerca sul WFS
+        Returns:
+            (records, sorgente): sorgente è 'wfs' oppure 'offline'
+        """
+        if self.mode == 'offline':
+            return self.offline.records_at(x, y), 'offline'
+        if self.mode == 'wfs' or not self.offline.covers(x, y):
+            return online(x, y), 'wfs'
+        if time.monotonic() < self._offline_until:
+            return self.offline.records_at(x, y), 'offline'
+        started = time.monotonic()
+        try:
+            records = online(x, y)
+        except Exception:
+            # WFS non raggiungibile: si resta sui GeoPackage per un po'
+            self._offline_until = time.monotonic() + OFFLINE_COOLDOWN
+            return self.offline.records_at(x, y), 'offline'
+        if time.monotonic() - started > SLOW_LATENCY:
+            self._offline_until = time.monotonic() + OFFLINE_COOLDOWN
+        return records, 'wfs'
+
+    def records_by_refs(self, refs, online):
+        """
+        Record delle particelle con i riferimenti indicati, con la stessa scelta
+        della sorgente di records_at.
+        Args:
+            online: funzione (refs) -> record, la ricerca sul WFS
+        """
+        if self.mode == 'offline':
+            return self.offline.records_by_refs(refs), 'offline'
+        if self.mode == 'wfs' or not self.offline.packages:
+            return online(refs), 'wfs'
+        if time.monotonic() < self._offline_until:
+            return self.offline.records_by_refs(refs), 'offline'
+        try:
+            return online(refs), 'wfs'
+        except Exception:
+            self._offline_until = time.monotonic() + OFFLINE_COOLDOWN
+            return self.offline.records_by_refs(refs), 'offline'
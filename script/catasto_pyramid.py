@@ -0,0 +1,228 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Livelli semplificati delle particelle unite per la visualizzazione a piccola scala.
+
+Nel GeoPackage unito (es. 82_ple_unito.gpkg) vengono aggiunti, accanto al
+layer originale, un layer semplificato per ogni fascia di scala e un layer
+di punti per le etichette. La semplificazione è di copertura
+(native:coveragesimplify): i bordi in comune tra particelle vicine sono
+semplificati una volta sola e restano coincidenti. Se l'algoritmo non c'è
+(QGIS < 3.36) o la copertura non è pulita si aggancia ogni vertice a una
+griglia della tolleranza del livello: i vertici condivisi finiscono sullo
+stesso nodo e i bordi restano coerenti; le particelle più piccole della
+griglia, che collassano in geometrie vuote o non valide, vengono riparate o
+tolte.
+
+Sopra tutti i livelli c'è quello dei fogli (SHEET_LEVEL): le particelle
+unite per foglio, una feature per foglio invece di una per particella, così
+a scala regionale o nazionale il tempo di disegno resta limitato.
+
+Dalla console di QGIS:
+
+    from catasto_pyramid import build_pyramid, load_pyramid
+    build_pyramid('/percorso/82_ple_unito.gpkg')
+    load_pyramid('/percorso/82_ple_unito.gpkg')
+"""
+
+import os
+import sqlite3
+
+import processing
+from qgis.core import (QgsApplication, QgsPalLayerSettings, QgsProject,
+                       QgsVectorLayer, QgsVectorLayerSimpleLabeling)
+
+# Livelli: (nome del layer, tolleranza in gradi, scala minima, scala massima).
+# Il layer originale si vede sotto 1:10.000, le etichette sotto 1:5.000
+PYRAMID_LEVELS = [
+    ('ple_l1', 0.00001, 50000, 10000),
+    ('ple_l2', 0.00005, 250000, 50000),
+    ('ple_l3', 0.0002, 1000000, 250000),
+]
+# Oltre 1:1.000.000 solo i fogli: particelle unite per foglio e semplificate
+SHEET_LEVEL = ('ple_fogli', 0.0005, 0, 1000000)
+SHEET_FIELD = 'foglio'
+FULL_DETAIL_SCALE = 10000
+LABEL_LAYER = 'ple_label'
+LABEL_SCALE = 5000
+# Il numero di particella: LABEL se il campo c'è, altrimenti la coda del gml_id
+LABEL_FIELD = 'LABEL'
+LABEL_EXPRESSION = """regexp_substr("gml_id", '([^.]+)$')"""
+
+
+def gpkg_layers(path):
+    """Layer vettoriali presenti nel GeoPackage"""
+    with sqlite3.connect(f"file:{path}?mode=ro", uri=True) as db:
+        return [row[0] for row in db.execute(
+            "SELECT table_name FROM gpkg_contents WHERE data_type = 'features' ORDER BY rowid")]
+
+
+def _layer_uri(path, table):
+    return f"{path}|layername={table}"
+
+
+def _destination(path, table):
+    # Uscita di Processing come nuovo layer dentro lo stesso GeoPackage
+    return f"ogr:dbname='{path}' table=\"{table}\" (geom)"
+
+
+def _sheet_expression(source):
+    """Espressione del foglio di una particella: il riferimento senza il numero di particella"""
+    names = QgsVectorLayer(source, 'fogli', 'ogr').fields().names()
+    field = next((name for name in ('NATIONALCADASTRALREFERENCE', 'INSPIREID_LOCALID', 'gml_id')
+                  if name in names), None)
+    if field is None:
+        raise Exception("Manca il riferimento catastale per raggruppare le particelle per foglio")
+    return f"regexp_replace(\"{field}\", '\\\\.[^.]*$', '')"
+
+
+def _sheets(source, path, table, tolerance, feedback=None):
+    """Particelle unite per foglio (una feature per foglio), poi semplificate come gli altri livelli"""
+    with_sheet = processing.run('native:fieldcalculator', {
+        'INPUT': source,
+        'FIELD_NAME': SHEET_FIELD,
+        'FIELD_TYPE': 2,
+        'FIELD_LENGTH': 40,
+        'FIELD_PRECISION': 0,
+        'FORMULA': _sheet_expression(source),
+        'OUTPUT': 'TEMPORARY_OUTPUT'
+    }, feedback=feedback)['OUTPUT']
+    dissolved = processing.run('native:dissolve', {
+        'INPUT': with_sheet,
+        'FIELD': [SHEET_FIELD],
+        'OUTPUT': 'TEMPORARY_OUTPUT'
+    }, feedback=feedback)['OUTPUT']
+    return _simplify(dissolved, path, table, tolerance, feedback)
+
+
+def _simplify(source, path, table, tolerance, feedback=None):
+    """
+    Semplificazione di copertura, con aggancio alla griglia se non disponibile:
+    dopo l'aggancio le geometrie non valide si riparano e quelle collassate si tolgono
+    """
+    if QgsApplication.processingRegistry().algorithmById('native:coveragesimplify'):
+        try:
+            processing.run('native:coveragesimplify', {
+                'INPUT': source,
+                'TOLERANCE': tolerance,
+                'PRESERVE_BOUNDARY': False,
+                'OUTPUT': _destination(path, table)
+            }, feedback=feedback)
+            return 'copertura'
+        except Exception as e:
+            print(f"Semplificazione di copertura non riuscita per {table}: {str(e)}")
+    snapped = processing.run('native:snappointstogrid', {
+        'INPUT': source,
+        'HSPACING': tolerance,
+        'VSPACING': tolerance,
+        'ZSPACING': 0,
+        'MSPACING': 0,
+        'OUTPUT': 'TEMPORARY_OUTPUT'
+    }, feedback=feedback)['OUTPUT']
+    fixed = processing.run('native:fixgeometries', {
+        'INPUT': snapped,
+        'OUTPUT': 'TEMPORARY_OUTPUT'
+    }, feedback=feedback)['OUTPUT']
+    processing.run('native:extractbyexpression', {
+        'INPUT': fixed,
+        'EXPRESSION': 'NOT is_empty_or_null($geometry) AND area($geometry) > 0',
+        'OUTPUT': _destination(path, table)
+    }, feedback=feedback)
+    kept = QgsVectorLayer(_layer_uri(path, table), table, 'ogr').featureCount()
+    if kept < snapped.featureCount():
+        print(f"{table}: {snapped.featureCount() - kept} particelle più piccole della griglia tolte")
+    return 'griglia'
+
+
+def build_pyramid(path, levels=PYRAMID_LEVELS, feedback=None):
+    """
+    Crea (o ricrea) nel GeoPackage i livelli semplificati, il livello dei fogli e i
+    punti etichetta. Ogni livello parte dal precedente, già alleggerito.
+    Returns:
+        list: nomi dei layer creati
+    """
+    tables = gpkg_layers(path)
+    if not tables:
+        raise Exception(f"Nessun layer vettoriale in {path}")
+    derived = [name for name, _, _, _ in levels] + [SHEET_LEVEL[0], LABEL_LAYER]
+    base = next(name for name in tables if name not in derived)
+    existing = [name for name in tables if name in derived]
+    if existing:
+        # Processing non sovrascrive un layer di un GeoPackage esistente
+        with sqlite3.connect(path) as db:
+            for name in existing:
+                db.execute(f'DROP TABLE IF EXISTS "{name}"')
+                db.execute(f'DROP TABLE IF EXISTS "rtree_{name}_geom"')
+                for meta in ('gpkg_contents', 'gpkg_geometry_columns', 'gpkg_extensions', 'gpkg_ogr_contents'):
+                    try:
+                        db.execute(f'DELETE FROM {meta} WHERE lower(table_name) = lower(?)', (name,))
+                    except sqlite3.OperationalError:
+                        pass
+
+    created = []
+    source = _layer_uri(path, base)
+    for name, tolerance, _, _ in levels:
+        method = _simplify(source, path, name, tolerance, feedback)
+        print(f"Livello {name} (tolleranza {tolerance}°, semplificazione di {method}) creato")
+        source = _layer_uri(path, name)
+        created.append(name)
+
+    name, tolerance, _, _ = SHEET_LEVEL
+    method = _sheets(source, path, name, tolerance, feedback)
+    print(f"Livello {name} (particelle unite per foglio, semplificazione di {method}) creato")
+    created.append(name)
+
+    processing.run('native:pointonsurface', {
+        'INPUT': _layer_uri(path, base),
+        'ALL_PARTS': False,
+        'OUTPUT': _destination(path, LABEL_LAYER)
+    }, feedback=feedback)
+    created.append(LABEL_LAYER)
+    print(f"Punti etichetta creati in {LABEL_LAYER}")
+    return created
+
+
+def load_pyramid(path, name=None, levels=PYRAMID_LEVELS):
+    """
+    Carica in un gruppo il layer originale e i livelli, ognuno visibile solo nella
+    sua fascia di scala, più le etichette: a ogni zoom si disegna un solo livello.
+    Returns:
+        QgsLayerTreeGroup: il gruppo aggiunto al progetto
+    """
+    tables = gpkg_layers(path)
+    derived = [level[0] for level in levels] + [SHEET_LEVEL[0], LABEL_LAYER]
+    base = next(table for table in tables if table not in derived)
+    project = QgsProject.instance()
+    group = project.layerTreeRoot().insertGroup(0, name or os.path.splitext(os.path.basename(path))[0])
+
+    def add(table, min_scale, max_scale):
+        layer = QgsVectorLayer(_layer_uri(path, table), table, 'ogr')
+        if not layer.isValid():
+            print(f"Layer {table} non valido in {path}")
+            return None
+        layer.setScaleBasedVisibility(True)
+        # In QGIS la scala minima è quella più piccola (denominatore più grande, 0 = nessun limite)
+        layer.setMinimumScale(min_scale)
+        layer.setMaximumScale(max_scale)
+        project.addMapLayer(layer, False)
+        group.addLayer(layer)
+        return layer
+
+    if LABEL_LAYER in tables:
+        labels = add(LABEL_LAYER, LABEL_SCALE, 0)
+        if labels:
+            settings = QgsPalLayerSettings()
+            if LABEL_FIELD in labels.fields().names():
+                settings.fieldName = LABEL_FIELD
+            else:
+                settings.fieldName = LABEL_EXPRESSION
+                settings.isExpression = True
+            labels.setLabeling(QgsVectorLayerSimpleLabeling(settings))
+            labels.setLabelsEnabled(True)
+            # Solo le etichette: il simbolo del punto non si disegna
+            labels.renderer().symbol().setOpacity(0)
+    add(base, FULL_DETAIL_SCALE, 0)
+    for table, _, min_scale, max_scale in levels + [SHEET_LEVEL]:
+        if table in tables:
+            add(table, min_scale, max_scale)
+    return group
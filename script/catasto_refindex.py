@@ -0,0 +1,319 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Indice compatto dei riferimenti catastali (comune -> foglio -> particella).
+
+I riferimenti (NATIONALCADASTRALREFERENCE, es. M011_0019C0.131) sono chiavi
+a larghezza fissa ordinate: l'ordine alfabetico coincide con la gerarchia
+belfiore, sezione, foglio, allegato, sviluppo, particella, quindi "tutte le
+particelle del foglio 19 di M011" è un intervallo trovato con due ricerche
+binarie. Per ogni chiave l'indice tiene la sorgente (GeoPackage unito, layer
+o WFS), l'id della feature nella sorgente e il bbox.
+
+Le colonne sono file binari su disco letti con mmap: anche a scala nazionale
+in memoria restano solo le pagine effettivamente consultate. Le aggiunte si
+accumulano in memoria e con save() vengono fuse nei file ordinati.
+
+Dalla console di QGIS:
+
+    from catasto_refindex import get_refindex
+    index = get_refindex()
+    for entry in index.prefix('M011', foglio='0019'):
+        print(entry)
+"""
+
+import bisect
+import json
+import mmap
+import os
+import struct
+import threading
+from collections import namedtuple
+
+DEFAULT_FOLDER = os.path.join(os.path.expanduser('~'), '.catasto_unzip_all', 'refindex')
+KEY_WIDTH = 24
+INSPIRE_PREFIX = '.PLA.'
+# Sorgente delle voci che vengono dal WFS (non hanno un id di feature locale)
+WFS_SOURCE = 'wfs'
+
+Riferimento = namedtuple('Riferimento', 'belfiore sezione foglio allegato sviluppo particella')
+Voce = namedtuple('Voce', 'ref source fid bbox')
+
+# Per ogni chiave: id della feature, indice della sorgente e bbox (float32, circa 10 cm)
+_ENTRY = struct.Struct('<qH4f')
+
+
+def reference_from_id(value):
+    """Riferimento catastale da un INSPIREID_LOCALID o gml_id (IT.AGE.PLA.C342_004000.101 -> C342_004000.101)"""
+    if not value:
+        return None
+    return value.split(INSPIRE_PREFIX, 1)[-1]
+
+
+def parse_reference(ref):
+    """
+    Componenti di un riferimento catastale, così come compaiono nel codice
+    (la sezione assente resta '_'). None se il riferimento non è nel formato atteso.
+    """
+    if not ref or len(ref) < 13 or ref[11] != '.':
+        return None
+    return Riferimento(ref[:4], ref[4], ref[5:9], ref[9], ref[10], ref[12:])
+
+
+def parse_inspire_id(value):
+    """Componenti da un INSPIREID_LOCALID (IT.AGE.PLA.C342_004000.101)"""
+    return parse_reference(reference_from_id(value))
+
+
+def reference_key(ref):
+    """Chiave a larghezza fissa dell'indice"""
+    key = ref.encode('ascii', 'replace')[:KEY_WIDTH]
+    return key.ljust(KEY_WIDTH, b' ')
+
+
+class _Keys:
+    """Vista in sola lettura delle chiavi ordinate, per bisect"""
+    def __init__(self, data, count):
+        self.data = data
+        self.count = count
+
+    def __len__(self):
+        return self.count
+
+    def __getitem__(self, i):
+        return self.data[i * KEY_WIDTH:(i + 1) * KEY_WIDTH]
+
+
+class ReferenceIndex:
+    """
+    Indice dei riferimenti persistito in una cartella.
+
+    Args:
+        folder (str): cartella con keys.bin, entries.bin e meta.json
+    """
+    def __init__(self, folder=DEFAULT_FOLDER):
+        self.folder = folder
+        self._lock = threading.RLock()
+        self._pending = {}
+        self._open()
+
+    # --- file su disco ------------------------------------------------------
+
+    def _path(self, name):
+        return os.path.join(self.folder, name)
+
+    def _open(self):
+        self.meta = {'count': 0, 'sources': [WFS_SOURCE], 'comuni': {}}
+        self._files = []
+        self._keys_map = self._entries_map = None
+        if os.path.exists(self._path('meta.json')):
+            with open(self._path('meta.json'), 'r', encoding='utf-8') as f:
+                self.meta = json.load(f)
+        count = self.meta['count']
+        if count:
+            for name in ('keys.bin', 'entries.bin'):
+                f = open(self._path(name), 'rb')
+                self._files.append(f)
+            self._keys_map = mmap.mmap(self._files[0].fileno(), 0, access=mmap.ACCESS_READ)
+            self._entries_map = mmap.mmap(self._files[1].fileno(), 0, access=mmap.ACCESS_READ)
+        self.keys = _Keys(self._keys_map, count)
+
+    def close(self):
+        with self._lock:
+            for m in (self._keys_map, self._entries_map):
+                if m is not None:
+                    m.close()
+            for f in self._files:
+                f.close()
+            self._files = []
+            self._keys_map = self._entries_map = None
+            self.keys = _Keys(None, 0)
+
+    def __len__(self):
+        return self.meta['count'] + len(self._pending)
+
+    def _source_id(self, source):
+        sources = self.meta['sources']
+        if source not in sources:
+            sources.append(source)
+        return sources.index(source)
+
+    # --- aggiunte -------------------------------------------------------------
+
+    def add(self, ref, source=WFS_SOURCE, fid=-1, bbox=(0.0, 0.0, 0.0, 0.0)):
+        """Aggiunge (o sostituisce) un riferimento; diventa persistente con save()"""
+        if not parse_reference(ref):
+            return
+        with self._lock:
+            self._pending[reference_key(ref)] = (fid, self._source_id(source), tuple(bbox))
+
+    def add_records(self, records, source=WFS_SOURCE):
+        """Aggiunge i record scaricati dal WFS (vedi catasto_wfs)"""
+        for record in records:
+            attrs = record['attrs']
+            ref = attrs.get('NATIONALCADASTRALREFERENCE') or reference_from_id(attrs.get('INSPIREID_LOCALID'))
+            if ref:
+                self.add(ref, source, -1, record['bbox'])
+
+    def add_features(self, features, ref_field, source):
+        """Aggiunge le feature di un layer QGIS (id e bbox dalla feature)"""
+        for feat in features:
+            ref = reference_from_id(feat[ref_field])
+            if ref and feat.hasGeometry():
+                rect = feat.geometry().boundingBox()
+                self.add(ref, source, feat.id(),
+                         (rect.xMinimum(), rect.yMinimum(), rect.xMaximum(), rect.yMaximum()))
+
+    def add_layer(self, layer, ref_field='NATIONALCADASTRALREFERENCE'):
+        """Aggiunge tutte le particelle di un layer vettoriale scaricato"""
+        self.add_features(layer.getFeatures(), ref_field, layer.source())
+
+    def add_gpkg(self, path):
+        """
+        Aggiunge un GeoPackage di particelle unite (catasto_unzip_merge_prov,
+        console_qgis_download), letto direttamente con sqlite3.
+        """
+        from catasto_offline import ParcelGeoPackage
+        package = ParcelGeoPackage(path)
+        source = os.path.abspath(path)
+        query = (f'SELECT t."{package.pk}", t."{package.ref_column}", r.minx, r.miny, r.maxx, r.maxy '
+                 f'FROM "{package.table}" t JOIN {package.rtree} r ON r.id = t."{package.pk}"')
+        for fid, value, xmin, ymin, xmax, ymax in package._db().execute(query):
+            ref = reference_from_id(value)
+            if ref:
+                self.add(ref, source, fid, (xmin, ymin, xmax, ymax))
+
+    def save(self):
+        """Fonde le aggiunte con l'indice su disco (scrittura atomica dei file)"""
+        with self._lock:
+            if not self._pending:
+                return
+            os.makedirs(self.folder, exist_ok=True)
+            pending = sorted(self._pending.items())
+            keys_tmp = self._path('keys.bin.tmp')
+            entries_tmp = self._path('entries.bin.tmp')
+            comuni = {}
+            count = 0
+            with open(keys_tmp, 'wb') as keys_out, open(entries_tmp, 'wb') as entries_out:
+                for key, entry in self._merge(pending):
+                    comune = key[:4].decode('ascii')
+                    first, _ = comuni.get(comune, (count, count))
+                    comuni[comune] = (first, count + 1)
+                    keys_out.write(key)
+                    entries_out.write(entry)
+                    count += 1
+            self.meta['count'] = count
+            self.meta['comuni'] = comuni
+            self.close()
+            os.replace(keys_tmp, self._path('keys.bin'))
+            os.replace(entries_tmp, self._path('entries.bin'))
+            meta_tmp = self._path('meta.json.tmp')
+            with open(meta_tmp, 'w', encoding='utf-8') as f:
+                json.dump(self.meta, f)
+            os.replace(meta_tmp, self._path('meta.json'))
+            self._pending = {}
+            self._open()
+
+    def _merge(self, pending):
+        """Fusione ordinata di chiavi su disco e aggiunte; a parità di chiave vince l'aggiunta"""
+        i = 0
+        count = self.meta['count']
+        for key, (fid, source_id, bbox) in pending:
+            while i < count and self.keys[i] < key:
+                yield self.keys[i], self._entries_map[i * _ENTRY.size:(i + 1) * _ENTRY.size]
+                i += 1
+            if i < count and self.keys[i] == key:
+                i += 1
+            yield key, _ENTRY.pack(fid, source_id, *bbox)
+        while i < count:
+            yield self.keys[i], self._entries_map[i * _ENTRY.size:(i + 1) * _ENTRY.size]
+            i += 1
+
+    # --- ricerche -------------------------------------------------------------
+
+    def _entry(self, i):
+        fid, source_id, *bbox = _ENTRY.unpack_from(self._entries_map, i * _ENTRY.size)
+        return Voce(self.keys[i].decode('ascii').rstrip(), self.meta['sources'][source_id], fid, tuple(bbox))
+
+    def _pending_entry(self, key):
+        fid, source_id, bbox = self._pending[key]
+        return Voce(key.decode('ascii').rstrip(), self.meta['sources'][source_id], fid, bbox)
+
+    def get(self, ref):
+        """Voce del riferimento, None se non c'è"""
+        key = reference_key(ref)
+        with self._lock:
+            if key in self._pending:
+                return self._pending_entry(key)
+            i = bisect.bisect_left(self.keys, key)
+            if i < len(self.keys) and self.keys[i] == key:
+                return self._entry(i)
+        return None
+
+    def _range(self, prefix):
+        prefix = prefix.encode('ascii')
+        start = bisect.bisect_left(self.keys, prefix)
+        end = bisect.bisect_left(self.keys, prefix + b'\xff')
+        return start, end
+
+    def prefix(self, belfiore, foglio=None, sezione=None, particella=None):
+        """
+        Voci ordinate che iniziano con i codici indicati. Senza sezione si
+        cercano tutte le sezioni del comune; il foglio si può dare senza zeri.
+        """
+        belfiore = belfiore.upper()
+        if foglio is not None:
+            foglio = str(foglio).zfill(4)
+        with self._lock:
+            if sezione is not None or foglio is None:
+                prefix = belfiore + (sezione or '') + (foglio or '')
+                ranges = [self._range(prefix)]
+            else:
+                # Una ricerca per ogni sezione presente nel comune
+                first, last = self.meta['comuni'].get(belfiore, (0, 0))
+                sezioni = set()
+                i = first
+                while i < last:
+                    sezione_i = chr(self.keys[i][4])
+                    sezioni.add(sezione_i)
+                    i = self._range(belfiore + sezione_i)[1]
+                ranges = [self._range(belfiore + s + foglio) for s in sorted(sezioni)]
+            entries = [self._entry(i) for start, end in ranges for i in range(start, end)]
+            pending = [self._pending_entry(key) for key in self._pending
+                       if key.startswith(belfiore.encode('ascii'))]
+        if pending:
+            merged = {entry.ref: entry for entry in entries}
+            merged.update((entry.ref, entry) for entry in pending)
+            entries = [merged[ref] for ref in sorted(merged)]
+        if foglio is not None or sezione is not None or particella is not None:
+            entries = [entry for entry in entries if self._matches(entry.ref, foglio, sezione, particella)]
+        return entries
+
+    @staticmethod
+    def _matches(ref, foglio, sezione, particella):
+        parts = parse_reference(ref)
+        return (parts is not None
+                and (foglio is None or parts.foglio == foglio)
+                and (sezione is None or parts.sezione == sezione)
+                and (particella is None or parts.particella == str(particella)))
+
+    def fogli(self, belfiore):
+        """Fogli (con sezione) presenti per un comune"""
+        return sorted(set(entry.ref[4:9] for entry in self.prefix(belfiore)))
+
+    def stats(self):
+        return {'riferimenti': len(self), 'comuni': len(self.meta['comuni']),
+                'sorgenti': len(self.meta['sources'])}
+
+
+_refindex = None
+_refindex_lock = threading.Lock()
+
+
+def get_refindex():
+    """Indice condiviso dal processo"""
+    global _refindex
+    with _refindex_lock:
+        if _refindex is None:
+            _refindex = ReferenceIndex()
+        return _refindex
@@ -0,0 +1,319 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Lettura parziale degli zip regionali dell'Agenzia con richieste HTTP Range.
+
+Lo zip di una regione contiene uno zip per provincia, che a sua volta
+contiene gli zip dei comuni. RangeFile presenta un URL come un file in sola
+lettura su cui ci si può spostare: zipfile ne legge solo la directory
+centrale in coda, quindi l'elenco delle province (con le dimensioni) costa
+poche decine di KB. Se lo zip di una provincia è salvato senza compressione
+(STORED) anche la sua directory centrale si legge a distanza, e si elencano
+e scaricano i singoli comuni; altrimenti si scarica solo lo zip della
+provincia.
+
+Se il server non gestisce le richieste Range (risponde 200 con il file
+intero) open_remote_zip restituisce None e gli script scaricano tutto come prima.
+
+Dalla console di QGIS:
+
+    from catasto_remotezip import open_remote_zip
+    remote = open_remote_zip('https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/GetDataset.php?dataset=umbria.zip')
+    print(remote.provinces())
+"""
+
+import io
+import os
+import re
+import struct
+from zipfile import ZIP_STORED, ZipFile
+
+from catasto_http import HttpError, get_session
+
+# Byte letti in anticipo a ogni richiesta (zipfile fa molte letture piccole);
+# nelle letture sequenziali la quantità raddoppia fino a MAX_READ_AHEAD
+READ_AHEAD = 64 * 1024
+MAX_READ_AHEAD = 8 * 1024 * 1024
+COPY_BLOCK = 1024 * 1024
+
+_CONTENT_RANGE = re.compile(r'bytes\s+(\d+)-(\d+)/(\d+|\*)')
+_LOCAL_HEADER = struct.Struct('<4s2B4HL2L2H')
+
+
+class RangeNotSupported(Exception):
+    """Il server non risponde alle richieste Range con contenuto parziale"""
+
+
+class RangeFile(io.RawIOBase):
+    """
+    File remoto in sola lettura: ogni lettura è una richiesta Range, con
+    lettura anticipata che cresce finché si legge in sequenza e non supera
+    limit (la fine del membro che si sta copiando).
+
+    Args:
+        url (str): indirizzo del file
+        session (HttpSession): sessione HTTP (di base quella condivisa)
+    """
+    def __init__(self, url, session=None, read_ahead=READ_AHEAD):
+        super().__init__()
+        self.url = url
+        self.session = session or get_session()
+        self.base_read_ahead = read_ahead
+        self.read_ahead = read_ahead
+        self.limit = None
+        self.transferred = 0
+        self.requests = 0
+        self._pos = 0
+        self._buffer = b''
+        self._buffer_start = 0
+        self.size = self._probe()
+
+    def _check(self, response, start):
+        if response.status != 206:
+            raise RangeNotSupported(f"Il server ha risposto {response.status} a una richiesta Range: {self.url}")
+        match = _CONTENT_RANGE.match(response.headers.get('Content-Range') or '')
+        if match is None or int(match.group(1)) != start:
+            raise RangeNotSupported(f"Content-Range non valido: {response.headers.get('Content-Range')}")
+        return match
+
+    def _probe(self):
+        """
+        Prima richiesta (un byte): dice se il server gestisce Range e quanto è
+        grande il file. In streaming, così un server senza Range non manda il file intero.
+        """
+        with self.session.stream(self.url, headers={'Range': 'bytes=0-0'}) as response:
+            match = self._check(response, 0)
+            self.transferred += len(response.read())
+            self.requests += 1
+            # Le redirect (GetDataset.php -> file statico) si seguono una volta sola
+            self.url = response.url
+        if match.group(3) == '*':
+            raise RangeNotSupported(f"Dimensione del file non indicata: {self.url}")
+        return int(match.group(3))
+
+    def _fetch(self, start, end):
+        """Byte da start a end compresi"""
+        response = self.session.request('GET', self.url, headers={
+            'Range': f"bytes={start}-{end}",
+            'Accept-Encoding': 'identity'
+        })
+        self.requests += 1
+        self.transferred += len(response.data)
+        self._check(response, start)
+        return response.data
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def _refill(self, size):
+        """Nuova lettura dalla posizione corrente: almeno size byte più la lettura anticipata"""
+        sequential = self._pos == self._buffer_start + len(self._buffer)
+        self.read_ahead = min(self.read_ahead * 2, MAX_READ_AHEAD) if sequential else self.base_read_ahead
+        end = min(self.size, self._pos + max(size, self.read_ahead))
+        if self.limit is not None and self._pos < self.limit:
+            end = min(end, max(self.limit, self._pos + size))
+        self._buffer = self._fetch(self._pos, end - 1)
+        self._buffer_start = self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        size = min(size, self.size - self._pos)
+        parts = []
+        while size > 0:
+            offset = self._pos - self._buffer_start
+            if not 0 <= offset < len(self._buffer):
+                self._refill(size)
+                continue
+            # Quello che è già nel buffer si usa, si scarica solo il resto
+            part = self._buffer[offset:offset + size]
+            parts.append(part)
+            self._pos += len(part)
+            size -= len(part)
+        return b''.join(parts)
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+class FileSlice(io.RawIOBase):
+    """Vista in sola lettura di un intervallo di un altro file (es. un membro STORED di uno zip)"""
+    def __init__(self, fileobj, start, size):
+        super().__init__()
+        self.fileobj = fileobj
+        self.start = start
+        self.size = size
+        self._pos = 0
+
+    def readable(self):
+        return True
+
+    def seekable(self):
+        return True
+
+    def tell(self):
+        return self._pos
+
+    def seek(self, offset, whence=io.SEEK_SET):
+        if whence == io.SEEK_SET:
+            self._pos = offset
+        elif whence == io.SEEK_CUR:
+            self._pos += offset
+        elif whence == io.SEEK_END:
+            self._pos = self.size + offset
+        self._pos = max(0, self._pos)
+        return self._pos
+
+    def read(self, size=-1):
+        if size is None or size < 0:
+            size = self.size - self._pos
+        size = min(size, self.size - self._pos)
+        if size <= 0:
+            return b''
+        self.fileobj.seek(self.start + self._pos)
+        data = self.fileobj.read(size)
+        self._pos += len(data)
+        return data
+
+    def readinto(self, b):
+        data = self.read(len(b))
+        b[:len(data)] = data
+        return len(data)
+
+
+def _member_data_offset(fileobj, info):
+    """Inizio dei dati di un membro: dopo l'header locale, i cui campi variabili possono differire dalla directory centrale"""
+    fileobj.seek(info.header_offset)
+    header = _LOCAL_HEADER.unpack(fileobj.read(_LOCAL_HEADER.size))
+    if header[0] != b'PK\x03\x04':
+        raise Exception(f"Header locale non valido per {info.filename}")
+    return info.header_offset + _LOCAL_HEADER.size + header[10] + header[11]
+
+
+def _copy_member(zip_ref, info, dest_path, range_file, base=0, progress_callback=None):
+    """
+    Copia un membro; le letture anticipate si fermano alla fine dei suoi dati (base: inizio dello zip nel file remoto)
+    Args:
+        progress_callback: funzione (copiati, totale) -> bool; se restituisce False
+            la copia viene interrotta e il file parziale eliminato
+    Returns:
+        str: percorso del file copiato, None se la copia è stata annullata
+    """
+    range_file.limit = base + _member_data_offset(zip_ref.fp, info) + info.compress_size
+    cancelled = False
+    try:
+        with zip_ref.open(info) as source, open(dest_path, 'wb') as dest:
+            copied = 0
+            while True:
+                buffer = source.read(COPY_BLOCK)
+                if not buffer:
+                    break
+                dest.write(buffer)
+                copied += len(buffer)
+                if progress_callback and progress_callback(copied, info.file_size) is False:
+                    cancelled = True
+                    break
+    finally:
+        range_file.limit = None
+    if cancelled:
+        os.remove(dest_path)
+        return None
+    return dest_path
+
+
+class RemoteZip:
+    """
+    Zip regionale remoto: elenco di province e comuni e download dei soli membri scelti.
+
+    Args:
+        url (str): indirizzo dello zip (es. GetDataset.php?dataset=umbria.zip)
+    """
+    def __init__(self, url, session=None):
+        self.file = RangeFile(url, session)
+        self.zip = ZipFile(self.file)
+        self._inner = {}
+
+    @property
+    def size(self):
+        return self.file.size
+
+    @property
+    def transferred(self):
+        """Byte scaricati finora (directory centrali comprese)"""
+        return self.file.transferred
+
+    def provinces(self):
+        """(nome dello zip, dimensione compressa) delle province"""
+        return [(info.filename, info.compress_size) for info in self.zip.infolist()
+                if info.filename.lower().endswith('.zip')]
+
+    def _province_zip(self, name):
+        """ZipFile letto a distanza dello zip di una provincia, None se è compresso (non ci si può spostare)"""
+        if name not in self._inner:
+            info = self.zip.getinfo(name)
+            inner = None
+            if info.compress_type == ZIP_STORED:
+                start = _member_data_offset(self.file, info)
+                inner = ZipFile(FileSlice(self.file, start, info.file_size))
+            self._inner[name] = inner
+        return self._inner[name]
+
+    def comuni(self, province):
+        """(nome, dimensione compressa) degli zip dei comuni, None se lo zip della provincia è compresso"""
+        inner = self._province_zip(province)
+        if inner is None:
+            return None
+        return [(info.filename, info.compress_size) for info in inner.infolist()
+                if info.filename.lower().endswith(('.zip', '.gml'))]
+
+    def fetch_province(self, province, folder, progress_callback=None):
+        """
+        Scarica nella cartella solo lo zip della provincia
+        (progress_callback come in _copy_member; None se annullato)
+        """
+        return _copy_member(self.zip, self.zip.getinfo(province), os.path.join(folder, os.path.basename(province)),
+                            self.file, progress_callback=progress_callback)
+
+    def fetch_comune(self, province, comune, folder, progress_callback=None):
+        """
+        Scarica nella cartella solo lo zip (o il GML) di un comune
+        (progress_callback come in _copy_member; None se annullato)
+        """
+        inner = self._province_zip(province)
+        if inner is None:
+            raise Exception(f"{province} è compresso: si può scaricare solo la provincia intera")
+        return _copy_member(inner, inner.getinfo(comune), os.path.join(folder, os.path.basename(comune)),
+                            self.file, inner.fp.start, progress_callback)
+
+    def close(self):
+        for inner in self._inner.values():
+            if inner is not None:
+                inner.close()
+        self.zip.close()
+
+
+def open_remote_zip(url, session=None):
+    """RemoteZip, o None se il server non gestisce le richieste Range"""
+    try:
+        return RemoteZip(url, session)
+    except (RangeNotSupported, HttpError, OSError) as e:
+        print(f"Lettura parziale dello zip non disponibile: {str(e)}")
+        return None
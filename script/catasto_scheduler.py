@@ -0,0 +1,304 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Scheduler delle richieste verso il WFS dell'Agenzia delle Entrate.
+
+- ritenta gli errori transitori (timeout, 429, 5xx) con backoff esponenziale
+  e jitter, rispettando l'eventuale header Retry-After;
+- adatta in modo AIMD (aumento additivo, riduzione moltiplicativa) il numero
+  di richieste in parallelo e la dimensione della pagina (COUNT) in base a
+  latenza ed errori osservati;
+- espone tasso corrente, tentativi e throughput.
+
+Dalla console di QGIS:
+
+    from catasto_scheduler import get_scheduler
+    print(get_scheduler().summary())
+"""
+
+import http.client
+import random
+import socket
+import ssl
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from xml.parsers import expat
+
+from catasto_http import HttpError
+
+RETRY_STATUS = (429, 500, 502, 503, 504)
+# Errori del parser XML di una risposta troncata (connessione caduta a metà);
+# gli altri (es. una pagina di errore HTML) non cambiano ripetendo la richiesta
+TRUNCATED_XML = {expat.errors.codes[message] for message in (
+    expat.errors.XML_ERROR_NO_ELEMENTS, expat.errors.XML_ERROR_UNCLOSED_TOKEN,
+    expat.errors.XML_ERROR_PARTIAL_CHAR, expat.errors.XML_ERROR_UNCLOSED_CDATA_SECTION)}
+
+
+class PageFetchError(Exception):
+    """Una pagina non è stata scaricata neanche dopo tutti i tentativi"""
+    def __init__(self, start_index, cause):
+        super().__init__(f"Pagina STARTINDEX={start_index} non scaricata: {cause}")
+        self.start_index = start_index
+        self.cause = cause
+
+
+def is_retriable(error):
+    """True se l'errore è transitorio e la richiesta può essere ripetuta"""
+    if isinstance(error, HttpError):
+        return error.status in RETRY_STATUS
+    if isinstance(error, ET.ParseError):
+        return error.code in TRUNCATED_XML
+    # Solo errori di rete: quelli del disco locale (anch'essi OSError) non si ripetono
+    return isinstance(error, (socket.timeout, TimeoutError, ConnectionError, socket.gaierror, ssl.SSLEOFError,
+                              http.client.HTTPException))
+
+
+class RequestScheduler:
+    """
+    Controllore di concorrenza e backoff.
+
+    Args:
+        min_concurrency, max_concurrency (int): limiti delle richieste in parallelo
+        min_page_size, max_page_size (int): limiti di COUNT per le richieste paginate
+        target_latency (float): latenza (s) oltre la quale si smette di aumentare
+        max_retries (int): tentativi oltre il primo per ogni richiesta
+        base_delay, max_delay (float): parametri del backoff esponenziale (s)
+
+    L'attributo log (funzione che riceve un messaggio, di base None) riceve i
+    singoli tentativi; senza, i tentativi compaiono solo nel riepilogo.
+    """
+    def __init__(self, min_concurrency=1, max_concurrency=6, concurrency=2,
+                 min_page_size=100, max_page_size=2000, page_size=1000, page_step=250,
+                 target_latency=4.0, max_retries=5, base_delay=0.5, max_delay=30.0):
+        self.min_concurrency = min_concurrency
+        self.max_concurrency = max_concurrency
+        self.concurrency = concurrency
+        self.min_page_size = min_page_size
+        self.max_page_size = max_page_size
+        self.page_size = page_size
+        self.page_step = page_step
+        self.target_latency = target_latency
+        self.max_retries = max_retries
+        self.base_delay = base_delay
+        self.max_delay = max_delay
+        self.log = None
+
+        self._lock = threading.Condition()
+        self._in_flight = 0
+        self._credit = 0.0
+        self._last_decrease = 0.0
+        # COUNT più grande per cui il server ha restituito una pagina piena
+        self._proven_page_size = 0
+
+        self.requests = 0
+        self.retries = 0
+        self.errors = 0
+        self.features = 0
+        self.latency = None
+        self._started = None
+
+    # --- controllo AIMD ------------------------------------------------------
+
+    def _on_success(self, latency):
+        with self._lock:
+            self.latency = latency if self.latency is None else 0.8 * self.latency + 0.2 * latency
+            if latency > 2 * self.target_latency:
+                self._decrease()
+            elif latency <= self.target_latency:
+                # Un passo di aumento ogni "finestra" di richieste riuscite
+                self._credit += 1.0 / self.concurrency
+                if self._credit >= 1.0:
+                    self._credit = 0.0
+                    self.concurrency = min(self.max_concurrency, self.concurrency + 1)
+                    self.page_size = min(self.max_page_size, self.page_size + self.page_step)
+            self._lock.notify_all()
+
+    def _on_error(self, error):
+        with self._lock:
+            self.errors += 1
+            self._decrease()
+
+    def _decrease(self):
+        # Una sola riduzione per finestra: le risposte in volo dello stesso
+        # episodio di congestione non dimezzano più volte
+        now = time.monotonic()
+        window = self.latency or self.base_delay
+        if now - self._last_decrease < window:
+            return
+        self._last_decrease = now
+        self._credit = 0.0
+        self.concurrency = max(self.min_concurrency, self.concurrency // 2)
+        self.page_size = max(self.min_page_size, self.page_size // 2)
+
+    def _backoff(self, attempt, error):
+        retry_after = getattr(error, 'retry_after', None)
+        if retry_after:
+            try:
+                return min(self.max_delay, float(retry_after))
+            except ValueError:
+                pass
+        # Full jitter: attesa casuale tra 0 e il tetto esponenziale
+        return random.uniform(0, min(self.max_delay, self.base_delay * 2 ** attempt))
+
+    # --- esecuzione ------------------------------------------------------------
+
+    def call(self, fn, *args, **kwargs):
+        """
+        Esegue fn rispettando il limite di concorrenza e ritentando gli errori transitori.
+        Gli errori non ripetibili (o esauriti i tentativi) vengono rilanciati.
+        """
+        if self._started is None:
+            self._started = time.monotonic()
+        attempt = 0
+        while True:
+            with self._lock:
+                while self._in_flight >= self.concurrency:
+                    self._lock.wait()
+                self._in_flight += 1
+                self.requests += 1
+            start = time.monotonic()
+            try:
+                result = fn(*args, **kwargs)
+            except Exception as e:
+                with self._lock:
+                    self._in_flight -= 1
+                    self._lock.notify_all()
+                if not is_retriable(e) or attempt >= self.max_retries:
+                    with self._lock:
+                        self.errors += 1
+                    raise
+                self._on_error(e)
+                delay = self._backoff(attempt, e)
+                attempt += 1
+                with self._lock:
+                    self.retries += 1
+                if self.log is not None:
+                    self.log(f"Tentativo {attempt}/{self.max_retries} tra {delay:.1f}s dopo errore: {e}")
+                time.sleep(delay)
+                continue
+            with self._lock:
+                self._in_flight -= 1
+            self._on_success(time.monotonic() - start)
+            return result
+
+    def run_pages(self, fetch_page, start_index=0):
+        """
+        Scarica in parallelo le pagine di una GetFeature paginata con STARTINDEX/COUNT.
+
+        Args:
+            fetch_page: funzione (start_index, count) -> (risultato, numero_feature)
+        Yields:
+            (start_index, risultato) nell'ordine originale delle pagine
+        Raises:
+            PageFetchError: se una pagina fallisce anche dopo tutti i tentativi,
+                così il risultato non viene mai troncato in silenzio
+        """
+        results = {}
+        pending = {}
+        next_start = start_index
+        next_yield = start_index
+        end = None
+
+        pool = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        try:
+            while True:
+                # Mette in coda nuove pagine finché c'è spazio nella finestra corrente
+                while end is None and len(pending) < self.concurrency:
+                    count = self.page_size
+                    future = pool.submit(self.call, fetch_page, next_start, count)
+                    pending[future] = (next_start, count, None)
+                    next_start += count
+
+                if not pending and next_yield not in results:
+                    break
+
+                if pending:
+                    done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                    for future in done:
+                        start, count, probe = pending.pop(future)
+                        try:
+                            result, num = future.result()
+                        except Exception as e:
+                            raise PageFetchError(start, e)
+                        results[start] = (result, num, count)
+                        if probe and num > 0:
+                            # Dopo una pagina corta ci sono altre feature: era un limite del server
+                            with self._lock:
+                                self.max_page_size = max(self.min_page_size, probe)
+                                self.page_size = min(self.page_size, self.max_page_size)
+                        if num >= count:
+                            with self._lock:
+                                self._proven_page_size = max(self._proven_page_size, count)
+                        elif num == 0:
+                            end = start if end is None else min(end, start)
+                        elif count <= self._proven_page_size:
+                            # Il server sa restituire pagine di questa dimensione: è l'ultima
+                            end = start + num if end is None else min(end, start + num)
+                        else:
+                            # Pagina corta oltre la dimensione verificata: potrebbe essere
+                            # un limite del server, si scarica il tratto mancante
+                            gap = pool.submit(self.call, fetch_page, start + num, count - num)
+                            pending[gap] = (start + num, count - num, num)
+
+                # Restituisce le pagine contigue già pronte
+                while next_yield in results:
+                    if end is not None and next_yield >= end:
+                        return
+                    result, num, count = results.pop(next_yield)
+                    if num == 0:
+                        return
+                    with self._lock:
+                        self.features += num
+                    yield next_yield, result
+                    next_yield += num if num < count else count
+        finally:
+            for future in pending:
+                future.cancel()
+            pool.shutdown(wait=False)
+
+    # --- statistiche -----------------------------------------------------------
+
+    def reset_stats(self):
+        """Azzera i contatori (i parametri di concorrenza appresi restano)"""
+        with self._lock:
+            self.requests = self.retries = self.errors = self.features = 0
+            self._started = None
+
+    def stats(self):
+        """Stato corrente del controllore"""
+        with self._lock:
+            elapsed = time.monotonic() - self._started if self._started else 0
+            return {
+                'concurrency': self.concurrency,
+                'page_size': self.page_size,
+                'requests': self.requests,
+                'retries': self.retries,
+                'errors': self.errors,
+                'features': self.features,
+                'latency': self.latency,
+                'requests_per_s': self.requests / elapsed if elapsed else 0.0,
+                'features_per_s': self.features / elapsed if elapsed else 0.0
+            }
+
+    def summary(self):
+        s = self.stats()
+        latency = f"{s['latency']:.2f}s" if s['latency'] is not None else "n/d"
+        return (f"Concorrenza: {s['concurrency']} - COUNT: {s['page_size']} - "
+                f"Richieste: {s['requests']} ({s['requests_per_s']:.2f}/s) - "
+                f"Tentativi: {s['retries']} - Errori: {s['errors']} - "
+                f"Latenza media: {latency} - Feature: {s['features']} ({s['features_per_s']:.1f}/s)")
+
+
+_scheduler = None
+_scheduler_lock = threading.Lock()
+
+
+def get_scheduler():
+    """Scheduler condiviso: i parametri appresi restano validi tra un'esecuzione e l'altra"""
+    global _scheduler
+    with _scheduler_lock:
+        if _scheduler is None:
+            _scheduler = RequestScheduler()
+        return _scheduler
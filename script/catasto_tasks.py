@@ -0,0 +1,165 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Interrogazioni dei clic in background per gli strumenti di mappa.
+
+Ogni clic diventa un QgsTask: la mappa non resta bloccata mentre il WFS
+risponde. I clic che arrivano mentre un'interrogazione è in corso vengono
+uniti nella successiva (MERGE) oppure annullano quella in corso (LATEST).
+I risultati vengono consegnati nel thread principale, l'unico che può
+modificare i layer; un'etichetta nella barra di stato mostra le
+interrogazioni in corso e la latenza dell'ultima.
+"""
+
+import time
+
+from qgis.core import QgsApplication, QgsTask
+from PyQt5.QtWidgets import QLabel
+
+# I clic arrivati durante un'interrogazione vengono risolti tutti insieme nella successiva
+MERGE = 'merge'
+# Un nuovo clic annulla quello in corso: conta solo l'ultimo
+LATEST = 'latest'
+
+
+class QueryStatus:
+    """Etichetta nella barra di stato di QGIS con interrogazioni in corso e latenza"""
+    def __init__(self, iface, title='Catasto'):
+        self.iface = iface
+        self.title = title
+        self.in_flight = 0
+        self.latency = None
+        self.label = QLabel()
+        self.visible = False
+        self.show()
+
+    def show(self):
+        """Mostra l'etichetta (di nuovo, se lo strumento torna attivo)"""
+        if not self.visible:
+            self.iface.statusBarIface().addPermanentWidget(self.label)
+            self.label.show()
+            self.visible = True
+        self.refresh()
+
+    def started(self, count=1):
+        self.in_flight += count
+        self.refresh()
+
+    def finished(self, latency=None, count=1):
+        self.in_flight = max(0, self.in_flight - count)
+        if latency is not None:
+            self.latency = latency
+        self.refresh()
+
+    def refresh(self):
+        text = f"{self.title}: {self.in_flight} in corso"
+        if self.latency is not None:
+            text += f" - ultima {self.latency:.2f}s"
+        self.label.setText(text)
+
+    def remove(self):
+        if self.visible:
+            self.iface.statusBarIface().removeWidget(self.label)
+            self.visible = False
+
+
+class ClickQueue:
+    """
+    Coda dei clic risolti in background.
+
+    Args:
+        resolve: funzione (x, y) -> risultato, eseguita nel task; non deve
+            toccare layer né stampare sulla console
+        on_result: funzione (x, y, risultato) eseguita nel thread principale
+        on_error: funzione (x, y, eccezione) eseguita nel thread principale
+        mode: MERGE o LATEST
+        status (QueryStatus): indicatore da aggiornare
+    """
+    def __init__(self, resolve, on_result, on_error, mode=MERGE, status=None):
+        self.resolve = resolve
+        self.on_result = on_result
+        self.on_error = on_error
+        self.mode = mode
+        self.status = status
+        self.pending = []
+        self.task = None
+        self._task_points = []
+        # Riferimenti ai task annullati ancora in esecuzione (non vanno raccolti dal GC)
+        self._cancelled = []
+        self.generation = 0
+
+    def submit(self, x, y):
+        """Accoda un clic (coordinate già nel CRS del WFS)"""
+        if self.mode == LATEST:
+            self.pending = [(x, y)]
+            if self.task is not None:
+                # Il risultato del task annullato viene ignorato anche se arriva
+                self._cancel_task()
+        else:
+            self.pending.append((x, y))
+        if self.task is None:
+            self._start()
+
+    def _run(self, task, points):
+        results = []
+        for x, y in points:
+            if task.isCanceled():
+                return None
+            try:
+                results.append((x, y, self.resolve(x, y), None))
+            except Exception as e:
+                results.append((x, y, None, e))
+        return results
+
+    def _start(self):
+        points = self.pending
+        self.pending = []
+        generation = self.generation
+        started = time.monotonic()
+
+        def finished(exception, results=None):
+            self._finished(task, generation, started, points, exception, results)
+
+        task = QgsTask.fromFunction('Interrogazione catasto', self._run, points,
+                                    on_finished=finished)
+        self.task = task
+        self._task_points = points
+        if self.status:
+            self.status.started(len(points))
+        QgsApplication.taskManager().addTask(task)
+
+    def _finish_task(self, count, latency=None):
+        self.task = None
+        if self.status:
+            self.status.finished(latency, count)
+
+    def _cancel_task(self):
+        self.task.cancel()
+        self._cancelled.append(self.task)
+        self.generation += 1
+        self._finish_task(len(self._task_points))
+
+    def _finished(self, task, generation, started, points, exception, results):
+        if generation != self.generation:
+            # Task annullato da un clic successivo
+            if task in self._cancelled:
+                self._cancelled.remove(task)
+            return
+        self._finish_task(len(points), time.monotonic() - started)
+        if exception is not None:
+            for x, y in points:
+                self.on_error(x, y, exception)
+        elif results:
+            for x, y, result, error in results:
+                if error is not None:
+                    self.on_error(x, y, error)
+                else:
+                    self.on_result(x, y, result)
+        if self.pending:
+            self._start()
+
+    def cancel(self):
+        """Annulla il task in corso e i clic in coda"""
+        self.pending = []
+        if self.task is not None:
+            self._cancel_task()
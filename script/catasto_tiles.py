@@ -0,0 +1,153 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Risoluzione dei clic sulla mappa a partire dalle particelle già in locale.
+
+Il territorio è diviso in tessere fisse di TILE_SIZE gradi. Un clic su una
+tessera già scaricata (cache di catasto_cache) si risolve con un test punto
+in poligono, senza rete. Un clic su una tessera nuova scarica la tessera
+intera invece del solo punto e avvia in background il prefetch delle otto
+tessere vicine: i clic successivi nella stessa zona di lavoro restano locali.
+"""
+
+import math
+import threading
+from concurrent.futures import ThreadPoolExecutor
+
+from catasto_cache import get_cache
+from catasto_geom import records_at_point
+from catasto_scheduler import get_scheduler
+from catasto_wfs import PARCEL_TYPENAME
+
+# Circa 220 x 160 metri alle nostre latitudini: poche centinaia di particelle
+TILE_SIZE = 0.002
+PREFETCH_WORKERS = 2
+
+
+def tile_of(x, y, size=TILE_SIZE):
+    """Indici (colonna, riga) della tessera che contiene il punto"""
+    return math.floor(x / size), math.floor(y / size)
+
+
+def tile_bbox(tile, size=TILE_SIZE):
+    """Bbox (xmin, ymin, xmax, ymax) di una tessera"""
+    i, j = tile
+    return (i * size, j * size, (i + 1) * size, (j + 1) * size)
+
+
+def neighbours(tile):
+    """Le otto tessere attorno a quella indicata"""
+    i, j = tile
+    return [(i + di, j + dj) for dj in (-1, 0, 1) for di in (-1, 0, 1) if di or dj]
+
+
+class TileLookup:
+    """
+    Ricerca delle particelle sotto un punto con cache a tessere e prefetch.
+
+    Args:
+        wfs_session (WfsSession): sessione usata per scaricare le tessere
+        prefetch (bool): scarica in background le tessere vicine a quella del clic
+    """
+    def __init__(self, wfs_session, typename=PARCEL_TYPENAME, tile_size=TILE_SIZE, prefetch=True,
+                 workers=PREFETCH_WORKERS):
+        self.wfs = wfs_session
+        self.typename = typename
+        self.tile_size = tile_size
+        self.prefetch = prefetch
+        self.cache = get_cache()
+        self._pending = {}
+        self._lock = threading.Lock()
+        self._executor = ThreadPoolExecutor(max_workers=workers)
+        self.local_hits = 0
+        self.remote_hits = 0
+
+    def _download_tile(self, tile):
+        """Scarica tutte le particelle di una tessera (a pagine) e le salva in cache"""
+        bbox = tile_bbox(tile, self.tile_size)
+        if self.cache.covers(self.typename, bbox):
+            return
+
+        def fetch_page(start_index, count):
+            page = self.wfs.get_records(bbox, count, start_index)
+            return page, len(page)
+
+        # Come nei download per bbox: una pagina corta può essere un limite del
+        # server su COUNT, lo scheduler ne scarica il seguito prima di chiudere la tessera
+        records = []
+        for _, page in get_scheduler().run_pages(fetch_page):
+            records.extend(page)
+        self.cache.store(self.typename, bbox, records)
+
+    def fetch_tile(self, tile):
+        """
+        Scarica una tessera se non è già in cache. Se la stessa tessera è già in
+        download (es. dal prefetch) attende quel download invece di ripeterlo.
+        """
+        with self._lock:
+            done = self._pending.get(tile)
+            owner = done is None
+            if owner:
+                done = self._pending[tile] = threading.Event()
+        if not owner:
+            done.wait()
+            return
+        try:
+            self._download_tile(tile)
+        finally:
+            with self._lock:
+                del self._pending[tile]
+            done.set()
+
+    def _prefetch_tile(self, tile):
+        try:
+            self.fetch_tile(tile)
+        except Exception as e:
+            print(f"Prefetch della tessera {tile} non riuscito: {str(e)}")
+
+    def prefetch_around(self, tile):
+        """Accoda in background il download delle tessere vicine non ancora in cache"""
+        for near in neighbours(tile):
+            with self._lock:
+                if near in self._pending:
+                    continue
+            if not self.cache.covers(self.typename, tile_bbox(near, self.tile_size)):
+                self._executor.submit(self._prefetch_tile, near)
+
+    def fetch_tiles(self, tiles):
+        """
+        Scarica in parallelo le tessere indicate non ancora in cache e attende la fine.
+        Returns:
+            int: numero di tessere scaricate
+        """
+        missing = [tile for tile in set(tiles)
+                   if not self.cache.covers(self.typename, tile_bbox(tile, self.tile_size))]
+        futures = [self._executor.submit(self.fetch_tile, tile) for tile in missing]
+        for future in futures:
+            future.result()
+        return len(missing)
+
+    def lookup(self, x, y):
+        """
+        Record delle particelle che contengono il punto (x, y) in EPSG:6706.
+        Returns:
+            (records, local): local è True se il clic è stato risolto senza rete
+        """
+        tile = tile_of(x, y, self.tile_size)
+        local = self.cache.covers(self.typename, (x, y, x, y))
+        if local:
+            self.local_hits += 1
+        else:
+            self.remote_hits += 1
+            self.fetch_tile(tile)
+        if self.prefetch:
+            self.prefetch_around(tile)
+        return records_at_point(self.cache.query(self.typename, (x, y, x, y)), x, y), local
+
+    def summary(self):
+        return (f"Clic risolti in locale: {self.local_hits} - "
+                f"con download della tessera: {self.remote_hits}")
+
+    def close(self):
+        """Interrompe i prefetch in coda"""
+        self._executor.shutdown(wait=False, cancel_futures=True)
@@ -5,13 +5,29 @@ from qgis.PyQt.QtWidgets import QInputDialog, QLineEdit, QFileDialog, QMessageBo
 import os
 import tempfile
 import shutil
-import urllib.request
+import sys
+import inspect
 from zipfile import ZipFile
 import processing
 import time
 import gc
 from datetime import datetime
 
+# I moduli condivisi (catasto_*.py) stanno nella stessa cartella dello script
+cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+from catasto_compact import compact_summary, write_compact
+from catasto_diff import write_change_feed
+from catasto_gml import convert_large_gml
+from catasto_http import download_to_file
+from catasto_offline import register_gpkg
+from catasto_pyramid import build_pyramid
+from catasto_refindex import get_refindex
+from catasto_remotezip import open_remote_zip
+from catasto_valid import GeometryValidator
+
 def log_message(msg):
     print(msg)
     QgsMessageLog.logMessage(msg, 'Elaborazione GML')
@@ -25,29 +41,24 @@ def cleanup_temp_dir(temp_dir):
     except Exception as e:
         log_message(f"Errore nella pulizia della directory temporanea: {str(e)}")
 
-def download_file_with_progress(url, dest_path):
-    response = urllib.request.urlopen(url)
-    total_size = int(response.info().get('Content-Length', 0))
-    block_size = 8192
-    downloaded_size = 0
-    
-    progress = QProgressDialog("Download in corso...", "Annulla", 0, 100)
+def progress_callback(label="Download in corso..."):
+    """Funzione (scaricati, totale) -> bool collegata a una finestra di avanzamento con Annulla"""
+    progress = QProgressDialog(label, "Annulla", 0, 100)
     progress.setWindowModality(2)
     progress.show()
     
-    with open(dest_path, 'wb') as f:
-        while True:
-            buffer = response.read(block_size)
-            if not buffer:
-                break
-            f.write(buffer)
-            downloaded_size += len(buffer)
+    def update_progress(downloaded_size, total_size):
+        if total_size:
             progress.setValue(int((downloaded_size / total_size) * 100))
-            if progress.wasCanceled():
-                log_message("Download annullato.")
-                return False
+        if progress.wasCanceled():
+            log_message("Download annullato.")
+            return False
+        return True
     
-    return True
+    return update_progress
+
+def download_file_with_progress(url, dest_path):
+    return download_to_file(url, dest_path, progress_callback())
 
 def collect_inputs():
     inputs = {}
@@ -68,6 +79,24 @@ def collect_inputs():
     if not main_folder: return None
     inputs['main_folder'] = main_folder
     
+    pyramid, ok = QInputDialog.getItem(None, 'Livelli semplificati',
+                                       'Vuoi creare i livelli semplificati delle particelle per le piccole scale?',
+                                       ['No', 'Sì'], 0, False)
+    if not ok: return None
+    inputs['pyramid'] = pyramid == 'Sì'
+    
+    changes, ok = QInputDialog.getItem(None, 'Variazioni',
+                                       'Se nella cartella c\'è già un file PLE unito, vuoi le variazioni delle particelle rispetto ad esso?',
+                                       ['No', 'Sì'], 0, False)
+    if not ok: return None
+    inputs['changes'] = changes == 'Sì'
+    
+    compact, ok = QInputDialog.getItem(None, 'Profilo compatto',
+                                       'Vuoi salvare anche una copia compatta (.cpkg, coordinate quantizzate) dei file uniti?',
+                                       ['No', 'Sì'], 0, False)
+    if not ok: return None
+    inputs['compact'] = compact == 'Sì'
+    
     return inputs
 
 def extract_all_gml(zip_folder, extract_to):
@@ -99,6 +128,7 @@ def merge_gml_files(gml_files, output_file):
         log_message(f"Nessun file GML trovato per {output_file}")
         return
     
+    converted_dir = None
     try:
         # Se il file esiste già, lo elimina
         if os.path.exists(output_file):
@@ -123,6 +153,10 @@ def merge_gml_files(gml_files, output_file):
         
         log_message(f"Trovati {len(valid_paths)} file GML validi")
         
+        # I GML molto grandi si leggono in parallelo e passano al merge come GeoPackage
+        converted_dir = tempfile.mkdtemp()
+        valid_paths = convert_large_gml(valid_paths, converted_dir, log=log_message)
+        
         # Forza la pulizia della memoria prima del merge
         gc.collect()
         time.sleep(1)
@@ -149,6 +183,12 @@ def merge_gml_files(gml_files, output_file):
         check_layer = QgsVectorLayer(output_file, "check", "ogr")
         if not check_layer.isValid():
             raise Exception("File di output non valido")
+        
+        # Geometrie del file unito: controllo rapido, GEOS e riparazione in parallelo
+        validator = GeometryValidator()
+        if validator.validate_layer(check_layer):
+            log_message(validator.summary())
+        del check_layer
             
         log_message(f"File unito salvato con successo in: {output_file}")
         
@@ -157,6 +197,8 @@ def merge_gml_files(gml_files, output_file):
         log_message(error_msg)
         raise Exception(error_msg)
     finally:
+        if converted_dir:
+            shutil.rmtree(converted_dir, ignore_errors=True)
         # Libera la memoria
         gc.collect()
 
@@ -167,25 +209,68 @@ def process_gml_files():
         return
     
     temp_dir = tempfile.mkdtemp()
+    remote = None
     try:
         main_folder = inputs['main_folder']
-        zip_path = os.path.join(temp_dir, "downloaded.zip")
-        log_message("Download del file zip...")
+        province = None
+        comune_code = None
         
-        if not download_file_with_progress(inputs['url'], zip_path):
-            return
+        # Se il server accetta le richieste Range si legge solo l'indice dello zip regionale:
+        # con una provincia (o un comune) si scaricano solo i suoi byte
+        remote = open_remote_zip(inputs['url'])
+        if remote:
+            members = remote.provinces()
+            if not members:
+                log_message("Nessun file ZIP di provincia trovato.")
+                return
+            labels = [f"{os.path.basename(name)[:2]} - {size / 1048576:.1f} MB" for name, size in members]
+            choice, ok = QInputDialog.getItem(None, 'Seleziona Provincia', 'Scegli la provincia da elaborare:', ['Tutte'] + labels, 0, False)
+            if not ok: return
+            province = 'Tutte' if choice == 'Tutte' else choice.split(' ')[0]
+            if province != 'Tutte':
+                member = members[labels.index(choice)][0]
+                prov_zip = os.path.basename(member)
+                comuni = remote.comuni(member)
+                comune = 'Tutti'
+                if comuni:
+                    comune_labels = [f"{os.path.splitext(os.path.basename(name))[0]} - {size / 1048576:.1f} MB"
+                                     for name, size in comuni]
+                    comune, ok = QInputDialog.getItem(None, 'Seleziona Comune', 'Scegli il comune da elaborare:', ['Tutti'] + comune_labels, 0, False)
+                    if not ok: return
+                if comune == 'Tutti':
+                    log_message(f"Download della sola provincia {prov_zip}...")
+                    if not remote.fetch_province(member, temp_dir, progress_callback(f"Download di {prov_zip}...")):
+                        return
+                else:
+                    name = comuni[comune_labels.index(comune)][0]
+                    comune_code = comune.split(' ')[0]
+                    prov_dir = os.path.join(temp_dir, os.path.splitext(prov_zip)[0])
+                    os.makedirs(prov_dir, exist_ok=True)
+                    log_message(f"Download del solo comune {comune_code}...")
+                    if not remote.fetch_comune(member, name, prov_dir, progress_callback(f"Download del comune {comune_code}...")):
+                        return
+                log_message(f"Scaricati {remote.transferred / 1048576:.1f} MB su {remote.size / 1048576:.1f} MB dello zip regionale")
+                province_zips = [prov_zip]
         
-        log_message("Estrazione province...")
-        with ZipFile(zip_path, 'r') as zip_ref:
-            zip_ref.extractall(temp_dir)
-        
-        province_zips = [f for f in os.listdir(temp_dir) if f.endswith('.zip') and f != "downloaded.zip"]
-        if not province_zips:
-            log_message("Nessun file ZIP di provincia trovato.")
-            return
+        if province in (None, 'Tutte'):
+            zip_path = os.path.join(temp_dir, "downloaded.zip")
+            log_message("Download del file zip...")
+            
+            if not download_file_with_progress(inputs['url'], zip_path):
+                return
+            
+            log_message("Estrazione province...")
+            with ZipFile(zip_path, 'r') as zip_ref:
+                zip_ref.extractall(temp_dir)
+            
+            province_zips = [f for f in os.listdir(temp_dir) if f.endswith('.zip') and f != "downloaded.zip"]
+            if not province_zips:
+                log_message("Nessun file ZIP di provincia trovato.")
+                return
         
-        province, ok = QInputDialog.getItem(None, 'Seleziona Provincia', 'Scegli la provincia da elaborare:', ['Tutte'] + [p[:2] for p in province_zips], 0, False)
-        if not ok: return
+        if province is None:
+            province, ok = QInputDialog.getItem(None, 'Seleziona Provincia', 'Scegli la provincia da elaborare:', ['Tutte'] + [p[:2] for p in province_zips], 0, False)
+            if not ok: return
         
         for prov_zip in province_zips:
             if province != 'Tutte' and not prov_zip.startswith(province):
@@ -195,8 +280,10 @@ def process_gml_files():
             prov_path = os.path.join(temp_dir, prov_zip)
             prov_dir = os.path.join(temp_dir, os.path.splitext(prov_zip)[0])
             
-            with ZipFile(prov_path, 'r') as zip_ref:
-                zip_ref.extractall(prov_dir)
+            # Con un solo comune scaricato lo zip della provincia non c'è
+            if os.path.exists(prov_path):
+                with ZipFile(prov_path, 'r') as zip_ref:
+                    zip_ref.extractall(prov_dir)
             
             map_files, ple_files = extract_all_gml(prov_dir, prov_dir)
             
@@ -205,12 +292,49 @@ def process_gml_files():
                 prov_code = prov_zip[:2]  # Usa il codice provincia dal nome file
             else:
                 prov_code = province
+            if comune_code:
+                prov_code = f"{prov_code}_{comune_code}"
                 
             output_map = os.path.join(main_folder, f"{prov_code}_map_unito.gpkg")
             output_ple = os.path.join(main_folder, f"{prov_code}_ple_unito.gpkg")
             
+            # Il file PLE del rilascio precedente si tiene da parte per il confronto
+            previous_ple = None
+            if inputs['changes'] and os.path.exists(output_ple):
+                previous_ple = os.path.join(main_folder, f"{prov_code}_ple_unito_prec.gpkg")
+                os.replace(output_ple, previous_ple)
+            
             merge_gml_files(map_files, output_map)
-            merge_gml_files(ple_files, output_ple)
+            try:
+                merge_gml_files(ple_files, output_ple)
+            except Exception:
+                if previous_ple and not os.path.exists(output_ple):
+                    os.replace(previous_ple, output_ple)
+                raise
+            
+            if previous_ple and os.path.exists(output_ple):
+                feed = os.path.join(main_folder, f"{prov_code}_ple_variazioni.jsonl")
+                counts = write_change_feed(previous_ple, output_ple, feed)
+                log_message(f"Variazioni: {counts['added']} aggiunte, {counts['removed']} rimosse, "
+                            f"{counts['modified']} modificate - salvate in {feed}")
+                os.remove(previous_ple)
+            
+            if inputs['compact']:
+                for output in (output_map, output_ple):
+                    if os.path.exists(output):
+                        log_message(compact_summary(write_compact(output)))
+            
+            # Le particelle unite diventano disponibili per la ricerca offline e nell'indice dei riferimenti
+            if os.path.exists(output_ple):
+                refindex = get_refindex()
+                refindex.add_gpkg(output_ple)
+                refindex.save()
+                if inputs['pyramid']:
+                    build_pyramid(output_ple)
+                    log_message(f"Livelli semplificati creati: from catasto_pyramid import load_pyramid; load_pyramid('{output_ple}')")
+                # Dopo i livelli semplificati, che modificano il file: l'indice per la ricerca offline si crea qui
+                log_message("Indice dei riferimenti per la ricerca offline...")
+                register_gpkg(output_ple)
             
         log_message(f"Elaborazione completata per provincia: {province if province != 'Tutte' else 'tutte le province'}")
         
@@ -218,6 +342,8 @@ def process_gml_files():
         log_message(f"ERRORE: {str(e)}")
         QMessageBox.critical(None, "Errore", str(e))
     finally:
+        if remote:
+            remote.close()
         cleanup_temp_dir(temp_dir)
 
 # Avvia lo script
@@ -0,0 +1,243 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Validazione delle geometrie per i download e per i file uniti.
+
+Un controllo rapido in Python sulle coordinate (anello chiuso, numero di
+vertici, bbox finito, area non nulla, verso di percorrenza costante) riconosce
+le particelle ovviamente valide: un anello unico convesso non può
+autointersecarsi, quindi non serve il test GEOS completo. Le altre geometrie
+passano a un pool di thread (le chiamate GEOS non tengono il GIL) per
+isGeosValid() e, se serve, makeValid(). Quelle che non si riparano in un
+poligono vengono scartate, come le geometrie vuote: in uscita ci sono solo
+geometrie valide.
+"""
+
+import math
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+from qgis.core import QgsFeatureRequest, QgsGeometry, QgsVectorDataProvider, QgsWkbTypes
+
+VALIDATION_WORKERS = 4
+# Feature di un layer lette e validate per volta
+LAYER_CHUNK_SIZE = 5000
+
+# Esito del controllo rapido
+VALID = 1
+INVALID = 0
+UNKNOWN = -1
+
+# Poligono (o multipoligono con un solo poligono) con un solo anello, in
+# qualunque grafia: 'POLYGON((' di catasto_wfs, 'Polygon ((' e 'MultiPolygon (((' di asWkt()
+_SINGLE_RING_WKT = re.compile(r'^\s*(MULTI)?POLYGON\s*\(\s*\((?(1)\s*\()([^()]*)\)\s*\)(?(1)\s*\))\s*$',
+                              re.IGNORECASE)
+
+
+def rings_from_wkt(wkt):
+    """Anelli di un WKT poligonale con un solo anello, altrimenti None"""
+    match = _SINGLE_RING_WKT.match(wkt or '')
+    if match is None:
+        return None
+    try:
+        return [[tuple(map(float, pair.split())) for pair in match.group(2).split(',')]]
+    except ValueError:
+        return None
+
+
+def rings_from_geometry(geom):
+    """Anelli di una geometria con un solo poligono e un solo anello, altrimenti None"""
+    if QgsWkbTypes.geometryType(geom.wkbType()) != QgsWkbTypes.PolygonGeometry:
+        return None
+    polygons = geom.asMultiPolygon() if geom.isMultipart() else [geom.asPolygon()]
+    if len(polygons) != 1 or len(polygons[0]) != 1:
+        return None
+    return [[(p.x(), p.y()) for p in polygons[0][0]]]
+
+
+def quick_check(rings):
+    """
+    Controllo rapido su un anello unico.
+    Returns:
+        VALID se l'anello è chiuso, con almeno tre vertici distinti, bbox finito
+        e convesso; INVALID se è aperto, degenere o con coordinate non finite;
+        UNKNOWN negli altri casi (serve il test GEOS).
+    """
+    if not rings or len(rings) != 1:
+        return UNKNOWN
+    ring = rings[0]
+    if len(ring) < 4 or ring[0] != ring[-1]:
+        return INVALID
+    xs = [p[0] for p in ring]
+    ys = [p[1] for p in ring]
+    if not all(math.isfinite(v) for v in (min(xs), max(xs), min(ys), max(ys))):
+        return INVALID
+    if min(xs) == max(xs) or min(ys) == max(ys):
+        return INVALID
+    # Convessità: il prodotto vettoriale dei lati consecutivi ha sempre lo stesso
+    # segno e la x cambia direzione al più due volte (esclude le stelle che si
+    # avvolgono più volte, anch'esse con svolte tutte nello stesso verso)
+    sign = 0
+    x_turns = 0
+    last_dx = 0
+    area = 0.0
+    n = len(ring) - 1
+    for i in range(n):
+        x0, y0 = ring[i - 1] if i else ring[n - 1]
+        x1, y1 = ring[i]
+        x2, y2 = ring[i + 1]
+        if (x1, y1) == (x2, y2):
+            return UNKNOWN
+        cross = (x1 - x0) * (y2 - y1) - (y1 - y0) * (x2 - x1)
+        if cross:
+            if sign and (cross > 0) != (sign > 0):
+                return UNKNOWN
+            sign = cross
+        dx = x2 - x1
+        if dx:
+            if last_dx and (dx > 0) != (last_dx > 0):
+                x_turns += 1
+            last_dx = dx
+        area += x1 * y2 - x2 * y1
+    if x_turns > 2:
+        return UNKNOWN
+    if not area:
+        return INVALID
+    return VALID
+
+
+def _polygonal(geom):
+    """Solo la parte poligonale di una geometria riparata (makeValid può restituire collezioni)"""
+    if geom is None or geom.isEmpty():
+        return None
+    if QgsWkbTypes.geometryType(geom.wkbType()) == QgsWkbTypes.PolygonGeometry:
+        return geom
+    polygons = geom.convertGeometryCollectionToSubclass(QgsWkbTypes.PolygonGeometry)
+    if polygons is None or polygons.isEmpty():
+        return None
+    return polygons
+
+
+class GeometryValidator:
+    """
+    Validazione e riparazione delle geometrie con conteggi.
+
+    Args:
+        workers (int): thread per il test GEOS e la riparazione
+    """
+    def __init__(self, workers=VALIDATION_WORKERS):
+        self.workers = workers
+        self.fast = 0
+        self.checked = 0
+        self.repaired = 0
+        self.dropped = 0
+        self.empty = 0
+
+    def _full_check(self, geom):
+        """Test GEOS e riparazione; restituisce (geometria valida o None, riparata)"""
+        if geom.isEmpty():
+            return None, False
+        if geom.isGeosValid():
+            return geom, False
+        repaired = _polygonal(geom.makeValid())
+        if repaired is None or not repaired.isGeosValid():
+            return None, True
+        return repaired, True
+
+    def _count(self, geom, repaired):
+        if geom is None:
+            self.dropped += 1
+        elif repaired:
+            self.repaired += 1
+        else:
+            self.checked += 1
+
+    def validate_records(self, records):
+        """
+        Record (vedi catasto_wfs) con la geometria valida: coppie (record, QgsGeometry),
+        nello stesso ordine, senza i record la cui geometria non si può riparare.
+        """
+        results = [None] * len(records)
+        pending = []
+        for i, record in enumerate(records):
+            if not record.get('wkt'):
+                self.empty += 1
+                continue
+            status = quick_check(rings_from_wkt(record['wkt']))
+            if status == VALID:
+                results[i] = QgsGeometry.fromWkt(record['wkt'])
+                self.fast += 1
+            else:
+                pending.append(i)
+        if pending:
+            with ThreadPoolExecutor(max_workers=self.workers) as executor:
+                checked = executor.map(lambda i: self._full_check(QgsGeometry.fromWkt(records[i]['wkt'])), pending)
+                for i, (geom, repaired) in zip(pending, checked):
+                    if geom is None and not repaired:
+                        self.empty += 1
+                    else:
+                        self._count(geom, repaired)
+                    results[i] = geom
+        return [(record, geom) for record, geom in zip(records, results) if geom is not None]
+
+    def validate_layer(self, layer, feedback=None):
+        """
+        Valida un layer su disco (es. il GeoPackage unito): le geometrie riparate
+        vengono riscritte, le feature non riparabili o senza geometria eliminate.
+        Returns:
+            bool: False se il provider non permette di modificare le geometrie
+        """
+        provider = layer.dataProvider()
+        capabilities = provider.capabilities()
+        if not (capabilities & QgsVectorDataProvider.ChangeGeometries
+                and capabilities & QgsVectorDataProvider.DeleteFeatures):
+            return False
+        request = QgsFeatureRequest().setNoAttributes()
+        chunk = []
+        changed = {}
+        dropped = []
+        total = max(layer.featureCount(), 1)
+        done = 0
+        with ThreadPoolExecutor(max_workers=self.workers) as executor:
+            for feat in layer.getFeatures(request):
+                chunk.append((feat.id(), feat.geometry()))
+                if len(chunk) >= LAYER_CHUNK_SIZE:
+                    self._validate_chunk(chunk, executor, changed, dropped)
+                    done += len(chunk)
+                    chunk = []
+                    if feedback:
+                        feedback.setProgress(100 * done / total)
+                        if feedback.isCanceled():
+                            break
+            self._validate_chunk(chunk, executor, changed, dropped)
+        # Le modifiche si scrivono a lettura finita: sul GeoPackage non si scrive con un iteratore aperto
+        if changed:
+            provider.changeGeometryValues(changed)
+        if dropped:
+            provider.deleteFeatures(dropped)
+        layer.updateExtents()
+        return True
+
+    def _validate_chunk(self, chunk, executor, changed, dropped):
+        pending = []
+        for fid, geom in chunk:
+            if geom.isNull() or geom.isEmpty():
+                self.empty += 1
+                dropped.append(fid)
+                continue
+            if quick_check(rings_from_geometry(geom)) == VALID:
+                self.fast += 1
+            else:
+                pending.append((fid, geom))
+        for (fid, geom), (valid_geom, repaired) in zip(
+                pending, executor.map(lambda item: self._full_check(item[1]), pending)):
+            self._count(valid_geom, repaired)
+            if valid_geom is None:
+                dropped.append(fid)
+            elif repaired:
+                changed[fid] = valid_geom
+
+    def summary(self):
+        return (f"Geometrie valide al controllo rapido: {self.fast} - "
+                f"verificate con GEOS: {self.checked} - riparate: {self.repaired} - scartate: {self.dropped} - "
+                f"vuote scartate: {self.empty}")
@@ -0,0 +1,505 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Esportazione in tile vettoriali (MBTiles o PMTiles) dei file MAP e PLE uniti.
+
+L'estensione viene divisa in strisce di colonne di tile allo zoom minimo:
+ogni striscia è tagliata da un processo qgis_process separato
+(native:writevectortiles_mbtiles) e i bordi delle strisce coincidono con i
+bordi delle tile a tutti gli zoom, quindi nessuna tile viene scritta da due
+processi. Le parti vengono poi riunite in un solo archivio: MBTiles
+(SQLite) o PMTiles (un file unico servibile da qualsiasi server statico con
+richieste Range).
+
+Ogni processo scrive il proprio output in un file di log (nessuna pipe da
+svuotare) e l'esportazione gira in un QgsTask: QGIS resta utilizzabile e
+il task si può annullare dal gestore delle attività.
+
+Generalizzazione e scarto delle feature per zoom si configurano in
+VECTOR_TILE_LAYERS: per ogni fascia di zoom si sceglie il layer (anche un
+livello semplificato di catasto_pyramid) e un filtro.
+
+Dalla console di QGIS:
+
+    from catasto_vtiles import export_vector_tiles
+    export_vector_tiles('/percorso/map.gpkg', '/percorso/ple.gpkg', '/percorso/catasto.pmtiles')
+
+oppure, senza bloccare QGIS:
+
+    from catasto_vtiles import export_vector_tiles_task
+    export_vector_tiles_task('/percorso/map.gpkg', '/percorso/ple.gpkg', '/percorso/catasto.pmtiles')
+"""
+
+import gzip
+import hashlib
+import json
+import math
+import os
+import shutil
+import signal
+import sqlite3
+import struct
+import subprocess
+import sys
+import tempfile
+import time
+
+from qgis.core import QgsApplication, QgsTask, QgsVectorLayer
+
+from catasto_pyramid import gpkg_layers
+
+DEFAULT_MIN_ZOOM = 10
+DEFAULT_MAX_ZOOM = 16
+TILE_WORKERS = 4
+# Secondi tra un controllo e l'altro dei processi qgis_process (fine, annullamento)
+POLL_INTERVAL = 0.5
+# Righe finali del log di un processo riportate nell'errore
+LOG_TAIL = 500
+
+# Layer nei tile: (nome nel tile, file 'map' o 'ple', livello della piramide
+# o None per il layer originale, zoom minimo, zoom massimo, filtro).
+# Sotto lo zoom 14 si scartano le particelle più piccole di circa 100 m²
+VECTOR_TILE_LAYERS = [
+    ('fogli', 'map', None, 10, 16, ''),
+    ('particelle', 'ple', 'ple_l3', 12, 13, 'area($geometry) > 0.00000001'),
+    ('particelle', 'ple', 'ple_l2', 14, 14, ''),
+    ('particelle', 'ple', 'ple_l1', 15, 15, ''),
+    ('particelle', 'ple', None, 16, 16, ''),
+]
+
+# Margine (in gradi) che tiene le strisce strettamente dentro le proprie colonne di tile
+_EPSILON = 1e-9
+
+# Task in corso: il riferimento Python deve restare vivo finché il task non finisce
+_tasks = []
+
+
+# --- griglia dei tile (XYZ, Web Mercator) --------------------------------------------
+
+def lon_to_tile_x(lon, zoom):
+    return int(math.floor((lon + 180.0) / 360.0 * (1 << zoom)))
+
+
+def tile_x_to_lon(x, zoom):
+    return x / (1 << zoom) * 360.0 - 180.0
+
+
+def tile_y_to_lat(y, zoom):
+    n = math.pi - 2.0 * math.pi * y / (1 << zoom)
+    return math.degrees(math.atan(math.sinh(n)))
+
+
+# --- qgis_process ------------------------------------------------------------------------
+
+def qgis_process_path():
+    """Eseguibile qgis_process dell'installazione di QGIS in uso"""
+    names = ['qgis_process-qgis.bat', 'qgis_process-qgis-ltr.bat'] if sys.platform == 'win32' else ['qgis_process']
+    prefix = QgsApplication.prefixPath()
+    for folder in (os.path.join(prefix, 'bin'), os.path.join(prefix, '..', '..', 'bin'),
+                   os.path.join(prefix, '..', 'bin')):
+        for name in names:
+            path = os.path.normpath(os.path.join(folder, name))
+            if os.path.exists(path):
+                return path
+    for name in names:
+        path = shutil.which(name)
+        if path:
+            return path
+    raise Exception("qgis_process non trovato: serve per tagliare i tile in più processi")
+
+
+def _tile_layers(map_path, ple_path, layers, min_zoom, max_zoom):
+    """Parametro LAYERS di native:writevectortiles_mbtiles per le fasce di zoom configurate"""
+    paths = {'map': map_path, 'ple': ple_path}
+    result = []
+    for name, kind, level, zoom_from, zoom_to, expression in layers:
+        path = paths.get(kind)
+        if not path or zoom_to < min_zoom or zoom_from > max_zoom:
+            continue
+        uri = path
+        if path.endswith('.gpkg'):
+            tables = gpkg_layers(path)
+            # Senza piramide si usa il layer originale anche alle fasce generalizzate
+            table = level if level in tables else tables[0]
+            uri = f"{path}|layername={table}"
+        result.append({
+            'layer': uri,
+            'layerName': name,
+            'filterExpression': expression,
+            'minZoom': max(zoom_from, min_zoom),
+            'maxZoom': min(zoom_to, max_zoom)
+        })
+    return result
+
+
+def _extent(paths):
+    xmin = ymin = math.inf
+    xmax = ymax = -math.inf
+    for path in paths:
+        layer = QgsVectorLayer(path, 'extent', 'ogr')
+        if not layer.isValid():
+            raise Exception(f"Layer non valido: {path}")
+        e = layer.extent()
+        xmin, ymin = min(xmin, e.xMinimum()), min(ymin, e.yMinimum())
+        xmax, ymax = max(xmax, e.xMaximum()), max(ymax, e.yMaximum())
+    return xmin, ymin, xmax, ymax
+
+
+def partitions(extent, zoom, count):
+    """
+    Strisce (xmin, ymin, xmax, ymax) in EPSG:4326 allineate alle colonne di tile
+    dello zoom indicato (e quindi di tutti gli zoom maggiori).
+    """
+    xmin, ymin, xmax, ymax = extent
+    first = lon_to_tile_x(xmin, zoom)
+    last = lon_to_tile_x(xmax, zoom)
+    columns = last - first + 1
+    count = max(1, min(count, columns))
+    strips = []
+    for i in range(count):
+        c0 = first + columns * i // count
+        c1 = first + columns * (i + 1) // count
+        strips.append((max(xmin, tile_x_to_lon(c0, zoom) + _EPSILON), ymin,
+                       min(xmax, tile_x_to_lon(c1, zoom) - _EPSILON), ymax))
+    return strips
+
+
+def _kill_tree(process):
+    """
+    Termina un processo con tutti i suoi figli. Su Windows qgis_process parte da
+    un .bat: process.kill() chiuderebbe solo cmd.exe e lascerebbe qgis_process in vita.
+    """
+    if sys.platform == 'win32':
+        subprocess.run(['taskkill', '/T', '/F', '/PID', str(process.pid)],
+                       stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+    else:
+        # Ogni processo è capo del proprio gruppo (start_new_session)
+        try:
+            os.killpg(process.pid, signal.SIGKILL)
+        except OSError:
+            process.kill()
+    process.wait()
+
+
+def _log_tail(path):
+    """Ultimi caratteri del log di un processo"""
+    try:
+        with open(path, 'rb') as f:
+            f.seek(max(0, os.path.getsize(path) - LOG_TAIL))
+            return f.read().decode('utf-8', 'replace').strip()
+    except OSError:
+        return ''
+
+
+def cut_tiles(map_path, ple_path, folder, min_zoom=DEFAULT_MIN_ZOOM, max_zoom=DEFAULT_MAX_ZOOM,
+              workers=TILE_WORKERS, layers=VECTOR_TILE_LAYERS, name='Catasto', feedback=None):
+    """
+    Taglia i tile in processi paralleli. L'output di ogni processo va in un
+    file di log nella cartella: nessuna pipe si riempie bloccando il processo.
+    Args:
+        feedback: QgsTask o QgsFeedback per avanzamento e annullamento (facoltativo)
+    Returns:
+        list: percorsi delle parti MBTiles
+    """
+    tile_layers = _tile_layers(map_path, ple_path, layers, min_zoom, max_zoom)
+    if not tile_layers:
+        raise Exception("Nessun layer da esportare nelle fasce di zoom indicate")
+    extent = _extent([path for path in (map_path, ple_path) if path])
+    executable = qgis_process_path()
+    running = []
+    parts = []
+    for i, strip in enumerate(partitions(extent, min_zoom, workers)):
+        part = os.path.join(folder, f"parte_{i}.mbtiles")
+        inputs = {
+            'LAYERS': tile_layers,
+            'MIN_ZOOM': min_zoom,
+            'MAX_ZOOM': max_zoom,
+            'EXTENT': f"{strip[0]},{strip[2]},{strip[1]},{strip[3]} [EPSG:4326]",
+            'META_NAME': name,
+            'META_ATTRIBUTION': 'Agenzia delle Entrate CC BY 4.0',
+            'META_TYPE': 'overlay',
+            'OUTPUT': part
+        }
+        log_path = os.path.join(folder, f"parte_{i}.log")
+        with open(log_path, 'wb') as log:
+            # Un gruppo di processi per parte: all'annullamento si chiude anche ciò che il .bat ha avviato
+            if sys.platform == 'win32':
+                group = {'creationflags': subprocess.CREATE_NEW_PROCESS_GROUP}
+            else:
+                group = {'start_new_session': True}
+            process = subprocess.Popen([executable, 'run', 'native:writevectortiles_mbtiles', '-'],
+                                       stdin=subprocess.PIPE, stdout=log, stderr=subprocess.STDOUT, **group)
+        process.stdin.write(json.dumps({'inputs': inputs}).encode('utf-8'))
+        process.stdin.close()
+        running.append((process, part, log_path))
+    try:
+        while True:
+            done = sum(process.poll() is not None for process, _, _ in running)
+            if done == len(running):
+                break
+            if feedback is not None:
+                if feedback.isCanceled():
+                    raise Exception("Esportazione dei tile annullata")
+                feedback.setProgress(90 * done / len(running))
+            time.sleep(POLL_INTERVAL)
+    finally:
+        # Annullamento o errore: nessun processo resta in vita
+        for process, _, _ in running:
+            if process.poll() is None:
+                _kill_tree(process)
+    errors = []
+    for process, part, log_path in running:
+        if process.returncode != 0 or not os.path.exists(part):
+            errors.append(f"{os.path.basename(part)}: {_log_tail(log_path)}")
+        else:
+            parts.append(part)
+    if errors:
+        raise Exception("Taglio dei tile non riuscito:\n" + '\n'.join(errors))
+    return parts
+
+
+# --- MBTiles -----------------------------------------------------------------------------
+
+def merge_mbtiles(parts, output):
+    """Riunisce le parti in un solo MBTiles (a parità di tile vale la prima parte)"""
+    if os.path.exists(output):
+        os.remove(output)
+    db = sqlite3.connect(output)
+    db.execute('CREATE TABLE metadata (name TEXT, value TEXT)')
+    db.execute('CREATE TABLE tiles (zoom_level INTEGER, tile_column INTEGER, tile_row INTEGER, tile_data BLOB)')
+    db.execute('CREATE UNIQUE INDEX tile_index ON tiles (zoom_level, tile_column, tile_row)')
+    metadata = {}
+    for part in parts:
+        db.execute('ATTACH DATABASE ? AS part', (part,))
+        db.execute('INSERT OR IGNORE INTO tiles SELECT zoom_level, tile_column, tile_row, tile_data FROM part.tiles')
+        for key, value in db.execute('SELECT name, value FROM part.metadata'):
+            metadata.setdefault(key, value)
+        db.commit()
+        db.execute('DETACH DATABASE part')
+    metadata.update(_mbtiles_summary(db))
+    db.executemany('INSERT INTO metadata VALUES (?, ?)', sorted(metadata.items()))
+    db.commit()
+    db.close()
+    return output
+
+
+def _mbtiles_summary(db):
+    """minzoom, maxzoom, bounds e center calcolati dai tile presenti"""
+    min_zoom, max_zoom = db.execute('SELECT min(zoom_level), max(zoom_level) FROM tiles').fetchone()
+    if min_zoom is None:
+        return {}
+    x0, x1, r0, r1 = db.execute('SELECT min(tile_column), max(tile_column), min(tile_row), max(tile_row) '
+                                'FROM tiles WHERE zoom_level = ?', (max_zoom,)).fetchone()
+    rows = 1 << max_zoom
+    # tile_row è in schema TMS (origine in basso)
+    west, east = tile_x_to_lon(x0, max_zoom), tile_x_to_lon(x1 + 1, max_zoom)
+    north, south = tile_y_to_lat(rows - 1 - r1, max_zoom), tile_y_to_lat(rows - r0, max_zoom)
+    return {
+        'minzoom': str(min_zoom),
+        'maxzoom': str(max_zoom),
+        'bounds': f"{west:.6f},{south:.6f},{east:.6f},{north:.6f}",
+        'center': f"{(west + east) / 2:.6f},{(south + north) / 2:.6f},{min_zoom}"
+    }
+
+
+# --- PMTiles (versione 3) ------------------------------------------------------------------
+
+PMTILES_HEADER_SIZE = 127
+# Header e directory radice devono stare nei primi 16 KiB
+PMTILES_ROOT_LIMIT = 16384 - PMTILES_HEADER_SIZE
+COMPRESSION_NONE = 1
+COMPRESSION_GZIP = 2
+TILE_TYPE_MVT = 1
+
+
+def zxy_to_tileid(z, x, y):
+    """Id PMTiles di un tile: tile dei livelli precedenti più la posizione sulla curva di Hilbert"""
+    acc = ((1 << (2 * z)) - 1) // 3
+    d = 0
+    s = (1 << z) // 2
+    while s > 0:
+        rx = 1 if x & s else 0
+        ry = 1 if y & s else 0
+        d += s * s * ((3 * rx) ^ ry)
+        if ry == 0:
+            if rx == 1:
+                x = s - 1 - x
+                y = s - 1 - y
+            x, y = y, x
+        s //= 2
+    return acc + d
+
+
+def _varint(value, out):
+    while value >= 0x80:
+        out.append((value & 0x7F) | 0x80)
+        value >>= 7
+    out.append(value)
+
+
+def _serialize_directory(entries):
+    """Directory PMTiles: entries (tile_id, offset, length, run_length) ordinate per tile_id"""
+    out = bytearray()
+    _varint(len(entries), out)
+    last_id = 0
+    for tile_id, _, _, _ in entries:
+        _varint(tile_id - last_id, out)
+        last_id = tile_id
+    for _, _, _, run_length in entries:
+        _varint(run_length, out)
+    for _, _, length, _ in entries:
+        _varint(length, out)
+    for i, (_, offset, _, _) in enumerate(entries):
+        if i > 0 and offset == entries[i - 1][1] + entries[i - 1][2]:
+            _varint(0, out)
+        else:
+            _varint(offset + 1, out)
+    return gzip.compress(bytes(out), mtime=0)
+
+
+def _build_directories(entries):
+    """Directory radice e directory foglia, con foglie sempre più grandi finché la radice non sta nel limite"""
+    root = _serialize_directory(entries)
+    if len(root) <= PMTILES_ROOT_LIMIT:
+        return root, b''
+    leaf_size = 4096
+    while True:
+        root_entries = []
+        leaves = bytearray()
+        for i in range(0, len(entries), leaf_size):
+            chunk = entries[i:i + leaf_size]
+            leaf = _serialize_directory(chunk)
+            # Le voci della radice che puntano a una foglia hanno run_length 0
+            root_entries.append((chunk[0][0], len(leaves), len(leaf), 0))
+            leaves.extend(leaf)
+        root = _serialize_directory(root_entries)
+        if len(root) <= PMTILES_ROOT_LIMIT:
+            return root, bytes(leaves)
+        leaf_size *= 2
+
+
+def write_pmtiles(parts, output):
+    """
+    Scrive un archivio PMTiles dalle parti MBTiles: tile ordinati per id di
+    Hilbert (archivio "clustered"), contenuti identici salvati una volta sola.
+    """
+    dbs = [sqlite3.connect(f"file:{part}?mode=ro", uri=True) for part in parts]
+    index = {}
+    for n, db in enumerate(dbs):
+        for z, x, row in db.execute('SELECT zoom_level, tile_column, tile_row FROM tiles'):
+            y = (1 << z) - 1 - row
+            index.setdefault(zxy_to_tileid(z, x, y), (n, z, x, row))
+    metadata = {}
+    for db in dbs:
+        for key, value in db.execute('SELECT name, value FROM metadata'):
+            metadata.setdefault(key, value)
+
+    entries = []
+    contents = {}
+    tile_compression = COMPRESSION_NONE
+    data_path = output + '.data'
+    data_length = 0
+    with open(data_path, 'wb') as data:
+        for tile_id in sorted(index):
+            n, z, x, row = index[tile_id]
+            blob = dbs[n].execute('SELECT tile_data FROM tiles WHERE zoom_level = ? AND tile_column = ? '
+                                  'AND tile_row = ?', (z, x, row)).fetchone()[0]
+            if blob[:2] == b'\x1f\x8b':
+                tile_compression = COMPRESSION_GZIP
+            digest = hashlib.md5(blob).digest()
+            if digest in contents:
+                offset, length = contents[digest]
+                last = entries[-1] if entries else None
+                if last and last[1] == offset and last[0] + last[3] == tile_id:
+                    # Tile consecutivi uguali: si allunga la corsa
+                    entries[-1] = (last[0], last[1], last[2], last[3] + 1)
+                    continue
+            else:
+                offset, length = data_length, len(blob)
+                contents[digest] = (offset, length)
+                data.write(blob)
+                data_length += length
+            entries.append((tile_id, offset, length, 1))
+    for db in dbs:
+        db.close()
+
+    root, leaves = _build_directories(entries)
+    vector_layers = json.loads(metadata.get('json', '{}')).get('vector_layers', [])
+    meta = {key: value for key, value in metadata.items() if key != 'json'}
+    meta['vector_layers'] = vector_layers
+    meta = json.dumps(meta).encode('utf-8')
+    meta = gzip.compress(meta, mtime=0)
+
+    summary = {}
+    if index:
+        zooms = [index[tile_id][1] for tile_id in index]
+        summary = {'min_zoom': min(zooms), 'max_zoom': max(zooms)}
+    bounds = [float(v) for v in metadata.get('bounds', '-180,-85,180,85').split(',')]
+    center = metadata.get('center', '').split(',')
+    center_lon = float(center[0]) if len(center) > 1 else (bounds[0] + bounds[2]) / 2
+    center_lat = float(center[1]) if len(center) > 1 else (bounds[1] + bounds[3]) / 2
+
+    root_offset = PMTILES_HEADER_SIZE
+    meta_offset = root_offset + len(root)
+    leaves_offset = meta_offset + len(meta)
+    data_offset = leaves_offset + len(leaves)
+    header = b'PMTiles' + struct.pack(
+        '<BQQQQQQQQQQQBBBBBBiiiiBii', 3,
+        root_offset, len(root), meta_offset, len(meta), leaves_offset, len(leaves),
+        data_offset, data_length,
+        sum(entry[3] for entry in entries), len(entries), len(contents),
+        1, COMPRESSION_GZIP, tile_compression, TILE_TYPE_MVT,
+        summary.get('min_zoom', 0), summary.get('max_zoom', 0),
+        int(bounds[0] * 1e7), int(bounds[1] * 1e7), int(bounds[2] * 1e7), int(bounds[3] * 1e7),
+        summary.get('min_zoom', 0), int(center_lon * 1e7), int(center_lat * 1e7))
+    with open(output, 'wb') as f:
+        f.write(header)
+        f.write(root)
+        f.write(meta)
+        f.write(leaves)
+        with open(data_path, 'rb') as data:
+            shutil.copyfileobj(data, f, 1024 * 1024)
+    os.remove(data_path)
+    return output
+
+
+def export_vector_tiles(map_path, ple_path, output, min_zoom=DEFAULT_MIN_ZOOM, max_zoom=DEFAULT_MAX_ZOOM,
+                        workers=TILE_WORKERS, layers=VECTOR_TILE_LAYERS, feedback=None):
+    """
+    Tile vettoriali dei file MAP e PLE uniti (uno dei due può essere None) in un
+    solo archivio: .pmtiles o .mbtiles secondo l'estensione di output.
+    """
+    folder = tempfile.mkdtemp()
+    try:
+        parts = cut_tiles(map_path, ple_path, folder, min_zoom, max_zoom, workers, layers, feedback=feedback)
+        if output.endswith('.pmtiles'):
+            merged = merge_mbtiles(parts, os.path.join(folder, 'unito.mbtiles'))
+            if feedback is not None:
+                feedback.setProgress(95)
+            return write_pmtiles([merged], output)
+        return merge_mbtiles(parts, output)
+    finally:
+        shutil.rmtree(folder, ignore_errors=True)
+
+
+def export_vector_tiles_task(map_path, ple_path, output, on_finished=None, **kwargs):
+    """
+    Esporta i tile in un QgsTask, senza bloccare QGIS.
+    Args:
+        on_finished: chiamata nel thread principale a task finito come
+            on_finished(eccezione, percorso): eccezione è None se l'esportazione è riuscita
+    Returns:
+        QgsTask: il task avviato
+    """
+    def run(task):
+        return export_vector_tiles(map_path, ple_path, output, feedback=task, **kwargs)
+
+    def finished(exception, result=None):
+        _tasks.remove(task)
+        if on_finished:
+            on_finished(exception, result)
+
+    task = QgsTask.fromFunction('Esportazione tile vettoriali catasto', run, on_finished=finished)
+    _tasks.append(task)
+    QgsApplication.taskManager().addTask(task)
+    return task
@@ -0,0 +1,408 @@
+#© totò fiandaca - 19/10/2026
+
+"""
+Funzioni comuni per le richieste GetFeature al WFS del catasto: costruzione
+degli URL, lettura delle risposte GML in record (dizionari indipendenti da
+QGIS, usati anche dalla cache) e conversione record <-> QgsFeature.
+"""
+
+import json
+import os
+import threading
+import time
+import urllib.parse
+import xml.etree.ElementTree as ET
+from xml.sax.saxutils import escape
+
+from qgis.core import QgsFeature, QgsField, QgsFields, QgsGeometry
+from PyQt5.QtCore import QVariant
+
+from catasto_gml import GML_NAMESPACE, parse_feature_element
+from catasto_http import HttpError, get_session
+from catasto_geom import records_at_point
+from catasto_scheduler import get_scheduler
+
+WFS_URL = 'https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/owfs01.php'
+SRSNAME = 'urn:ogc:def:crs:EPSG::6706'
+
+PARCEL_TYPENAME = 'CP:CadastralParcel'
+ZONING_TYPENAME = 'CP:CadastralZoning'
+
+NAMESPACES = {
+    'wfs': 'http://www.opengis.net/wfs/2.0',
+    'gml': GML_NAMESPACE,
+    'CP': 'http://mapserver.gis.umn.edu/mapserver'
+}
+
+# Attributi di CP:CadastralParcel
+PARCEL_ATTRIBUTES = [
+    'INSPIREID_LOCALID',
+    'INSPIREID_NAMESPACE',
+    'LABEL',
+    'NATIONALCADASTRALREFERENCE',
+    'ADMINISTRATIVEUNIT',
+    'AREAVALUE',
+    'BEGINLIFESPANVERSION',
+    'ENDLIFESPANVERSION',
+    'QUALITY',
+    'SOURCE'
+]
+
+_XSD = '{http://www.w3.org/2001/XMLSchema}'
+
+# Riferimenti per richiesta nelle ricerche per codice: in GET il filtro va
+# nell'URL e deve restare corto, in POST sta nel corpo della richiesta
+GET_BATCH_SIZE = 20
+POST_BATCH_SIZE = 200
+
+SCHEMA_FOLDER = os.path.join(os.path.expanduser('~'), '.catasto_unzip_all', 'cache')
+SCHEMA_TTL = 30 * 24 * 3600
+
+# Tipi XSD -> tipi dei campi QGIS
+XSD_TYPES = {
+    'string': QVariant.String,
+    'int': QVariant.Int,
+    'integer': QVariant.LongLong,
+    'long': QVariant.LongLong,
+    'short': QVariant.Int,
+    'double': QVariant.Double,
+    'decimal': QVariant.Double,
+    'float': QVariant.Double
+}
+
+
+class WfsError(Exception):
+    """Il WFS ha risposto con un ExceptionReport invece che con le feature"""
+
+
+def getfeature_url(typename, bbox, start_index=0, count=1000, **extra):
+    """
+    URL GetFeature WFS 2.0 per un bbox (xmin, ymin, xmax, ymax) in EPSG:6706.
+    L'ordine degli assi di EPSG:6706 è lat/lon, per questo il BBOX parte da ymin.
+    Con bbox None la selezione è affidata a un FILTER passato in extra
+    (BBOX e FILTER non possono stare nella stessa richiesta).
+    """
+    params = {
+        'language': 'ita',
+        'SERVICE': 'WFS',
+        'REQUEST': 'GetFeature',
+        'VERSION': '2.0.0',
+        'TYPENAMES': typename,
+        'STARTINDEX': str(start_index),
+        'COUNT': str(count),
+        'SRSNAME': SRSNAME
+    }
+    if bbox is not None:
+        xmin, ymin, xmax, ymax = bbox
+        params['BBOX'] = f"{ymin},{xmin},{ymax},{xmax},{SRSNAME}"
+    params.update(extra)
+    return f"{WFS_URL}?{urllib.parse.urlencode(params)}"
+
+
+def point_filter(x, y, geometry_name, operator='Intersects'):
+    """
+    Filtro FES 2.0 spaziale su un punto (lon, lat in EPSG:6706): con Intersects
+    il server restituisce solo le particelle che contengono davvero il punto,
+    non tutte quelle il cui bbox lo contiene.
+    """
+    return (f'<fes:Filter xmlns:fes="http://www.opengis.net/fes/2.0" '
+            f'xmlns:gml="{NAMESPACES["gml"]}">'
+            f'<fes:{operator}><fes:ValueReference>{geometry_name}</fes:ValueReference>'
+            f'<gml:Point gml:id="clic" srsName="{SRSNAME}"><gml:pos>{y} {x}</gml:pos></gml:Point>'
+            f'</fes:{operator}></fes:Filter>')
+
+
+def _code(value):
+    # I codici letti da campi numerici arrivano anche come float (40.0)
+    if isinstance(value, float) and value.is_integer():
+        value = int(value)
+    return str(value).strip().upper()
+
+
+def compose_reference(admin, foglio, particella, sezione=None):
+    """
+    NATIONALCADASTRALREFERENCE dai codici: belfiore (4), sezione (1, '_' se
+    assente), foglio (4, con zeri), allegato e sviluppo (2, '00' se assenti),
+    '.' e particella. Es. ('C342', '40', '101') -> 'C342_004000.101'.
+    Il foglio può essere già completo di allegato e sviluppo ('0019C0').
+    """
+    admin = _code(admin)
+    if sezione is None and len(admin) == 5:
+        admin, sezione = admin[:4], admin[4]
+    sezione = _code(sezione) if sezione else '_'
+    foglio = _code(foglio)
+    if len(foglio) <= 4:
+        foglio = foglio.zfill(4) + '00'
+    return f"{admin}{sezione}{foglio}.{_code(particella)}"
+
+
+def refs_filter(refs, field='NATIONALCADASTRALREFERENCE'):
+    """Filtro FES 2.0: field uguale a uno dei riferimenti (PropertyIsEqualTo in Or)"""
+    conditions = ''.join(f'<fes:PropertyIsEqualTo><fes:ValueReference>{field}</fes:ValueReference>'
+                         f'<fes:Literal>{escape(ref)}</fes:Literal></fes:PropertyIsEqualTo>'
+                         for ref in refs)
+    if len(refs) > 1:
+        conditions = f'<fes:Or>{conditions}</fes:Or>'
+    return f'<fes:Filter xmlns:fes="http://www.opengis.net/fes/2.0">{conditions}</fes:Filter>'
+
+
+def parse_getfeature(data, typename):
+    """Record delle feature di una risposta GetFeature"""
+    root = ET.fromstring(data)
+    if root.tag.endswith('ExceptionReport'):
+        texts = [el.text.strip() for el in root.iter() if el.tag.endswith('ExceptionText') and el.text]
+        raise WfsError('; '.join(texts) or 'ExceptionReport senza messaggio')
+    records = []
+    for element in root.iter('{' + NAMESPACES['CP'] + '}' + typename.split(':')[-1]):
+        record = parse_feature_element(element)
+        if record:
+            records.append(record)
+    return records
+
+
+def string_fields(names):
+    """QgsFields di tipo stringa con i nomi indicati"""
+    fields = QgsFields()
+    for name in names:
+        fields.append(QgsField(name, QVariant.String))
+    return fields
+
+
+def _convert(value, field_type):
+    try:
+        if field_type in (QVariant.Int, QVariant.LongLong):
+            return int(value)
+        if field_type == QVariant.Double:
+            return float(value)
+    except ValueError:
+        return None
+    return value
+
+
+def record_to_feature(record, fields):
+    """QgsFeature con i campi indicati, valorizzati dagli attributi del record con lo stesso nome"""
+    feat = QgsFeature(fields)
+    attrs = record['attrs']
+    for field in fields:
+        if field.name() in attrs:
+            feat[field.name()] = _convert(attrs[field.name()], field.type())
+    feat.setGeometry(QgsGeometry.fromWkt(record['wkt']))
+    return feat
+
+
+def feature_to_record(feat, key_field='INSPIREID_LOCALID', names=None):
+    """
+    Record da una QgsFeature (es. risultato del provider WFS di QGIS).
+    Con names si copiano solo gli attributi indicati.
+    """
+    attrs = {}
+    for field in feat.fields():
+        if names is not None and field.name() not in names:
+            continue
+        value = feat[field.name()]
+        if value is not None and not (hasattr(value, 'isNull') and value.isNull()):
+            attrs[field.name()] = str(value)
+    geom = feat.geometry()
+    bbox = geom.boundingBox()
+    return {
+        'key': attrs.get(key_field) or str(feat.id()),
+        'wkt': geom.asWkt(),
+        'bbox': (bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum()),
+        'attrs': attrs
+    }
+
+
+class WfsSession:
+    """
+    Sessione WFS di lunga durata, da tenere una per strumento.
+
+    Al posto di un QgsVectorLayer WFS creato a ogni clic (che ripete ogni volta
+    GetCapabilities e DescribeFeatureType) usa la connessione keep-alive della
+    sessione HTTP condivisa e tiene capabilities e schema in una cache su disco
+    valida tra un riavvio di QGIS e l'altro: ogni interrogazione costa una sola
+    GetFeature.
+
+    Args:
+        typename (str): es. 'CP:CadastralParcel'
+    """
+    def __init__(self, typename=PARCEL_TYPENAME, url=WFS_URL, folder=SCHEMA_FOLDER):
+        self.typename = typename
+        self.url = url
+        self.folder = folder
+        self.http = get_session()
+        self._fields = None
+        self._capabilities = None
+        self._spatial_filter = None
+        self._post = None
+        self._lock = threading.Lock()
+
+    def _base_params(self, request):
+        return {'language': 'ita', 'SERVICE': 'WFS', 'VERSION': '2.0.0', 'REQUEST': request}
+
+    def _cache_path(self, name):
+        safe = self.typename.replace(':', '_')
+        return os.path.join(self.folder, f"wfs_{safe}_{name}")
+
+    def _read_cached(self, path):
+        if os.path.exists(path) and time.time() - os.path.getmtime(path) < SCHEMA_TTL:
+            with open(path, 'r', encoding='utf-8') as f:
+                return f.read()
+        return None
+
+    def _write_cached(self, path, text):
+        os.makedirs(self.folder, exist_ok=True)
+        tmp_path = path + '.tmp'
+        with open(tmp_path, 'w', encoding='utf-8') as f:
+            f.write(text)
+        os.replace(tmp_path, path)
+
+    def capabilities(self):
+        """Documento GetCapabilities (ElementTree), dalla cache su disco se presente"""
+        with self._lock:
+            if self._capabilities is None:
+                path = self._cache_path('capabilities.xml')
+                text = self._read_cached(path)
+                if text is None:
+                    params = self._base_params('GetCapabilities')
+                    text = self.http.get_text(f"{self.url}?{urllib.parse.urlencode(params)}")
+                    self._write_cached(path, text)
+                self._capabilities = ET.fromstring(text)
+            return self._capabilities
+
+    def schema(self):
+        """
+        Lista (nome, tipo XSD) degli elementi, da DescribeFeatureType o dalla cache su disco.
+        La geometria ha un tipo che termina per PropertyType.
+        """
+        path = self._cache_path('schema.json')
+        text = self._read_cached(path)
+        if text is not None:
+            return json.loads(text)
+        params = self._base_params('DescribeFeatureType')
+        params['TYPENAMES'] = self.typename
+        root = ET.fromstring(self.http.get(f"{self.url}?{urllib.parse.urlencode(params)}"))
+        local_name = self.typename.split(':')[-1]
+        schema = []
+        for complex_type in root.iter(_XSD + 'complexType'):
+            if not complex_type.get('name', '').startswith(local_name):
+                continue
+            for element in complex_type.iter(_XSD + 'element'):
+                xsd_type = element.get('type', 'string').split(':')[-1]
+                schema.append([element.get('name'), xsd_type])
+        if not schema:
+            raise Exception(f"Schema non disponibile per {self.typename}")
+        self._write_cached(path, json.dumps(schema))
+        return schema
+
+    def fields(self):
+        """QgsFields del typename"""
+        with self._lock:
+            if self._fields is None:
+                fields = QgsFields()
+                for name, xsd_type in self.schema():
+                    if xsd_type.endswith('PropertyType'):
+                        continue  # geometria
+                    fields.append(QgsField(name, XSD_TYPES.get(xsd_type, QVariant.String)))
+                self._fields = fields
+            return self._fields
+
+    def geometry_name(self):
+        """Nome della proprietà geometrica da usare nei filtri (msGeometry per MapServer)"""
+        for name, xsd_type in self.schema():
+            if xsd_type.endswith('PropertyType'):
+                return name
+        return 'msGeometry'
+
+    def supports_spatial_filter(self, operator='Intersects'):
+        """True se le capabilities dichiarano l'operatore spaziale FES indicato"""
+        if self._spatial_filter is None:
+            try:
+                names = [op.get('name') for op in self.capabilities().iter(
+                    '{http://www.opengis.net/fes/2.0}SpatialOperator')]
+            except Exception:
+                names = []
+            self._spatial_filter = operator in names
+        return self._spatial_filter
+
+    def supports_post(self):
+        """True se le capabilities dichiarano GetFeature in POST"""
+        if self._post is None:
+            self._post = False
+            try:
+                for operation in self.capabilities().iter('{http://www.opengis.net/ows/1.1}Operation'):
+                    if operation.get('name') == 'GetFeature':
+                        self._post = operation.find('.//{http://www.opengis.net/ows/1.1}Post') is not None
+            except Exception:
+                pass
+        return self._post
+
+    def warm_up(self):
+        """
+        Carica lo schema e apre la connessione in un thread in background, così
+        anche il primo clic costa solo la GetFeature.
+        """
+        def run():
+            try:
+                self.fields()
+                self.capabilities()
+                self.http.prewarm(self.url)
+            except Exception as e:
+                print(f"Preparazione della sessione WFS non riuscita: {str(e)}")
+        threading.Thread(target=run, daemon=True).start()
+
+    def get_records(self, bbox, count=100, start_index=0, **extra):
+        """Record delle feature nel bbox (xmin, ymin, xmax, ymax), con una sola GetFeature"""
+        url = getfeature_url(self.typename, bbox, start_index, count, **extra)
+        return parse_getfeature(self.http.get(url), self.typename)
+
+    def get_records_at(self, x, y):
+        """
+        Record delle particelle che contengono il punto (x, y).
+        Con un filtro FES Intersects se il server lo supporta (risposta con la sola
+        particella giusta), altrimenti per bbox del punto; in entrambi i casi i
+        candidati passano da un test esatto di contenimento in locale.
+        """
+        if self.supports_spatial_filter():
+            try:
+                records = self.get_records(None, FILTER=point_filter(x, y, self.geometry_name()))
+                return records_at_point(records, x, y)
+            except (HttpError, WfsError) as e:
+                if isinstance(e, HttpError) and e.status != 400:
+                    raise
+                # Filtro rifiutato dal server: da qui in poi si usa il bbox
+                self._spatial_filter = False
+        return records_at_point(self.get_records((x, y, x, y)), x, y)
+
+    def get_records_filtered(self, fes_filter, count=100):
+        """Record che soddisfano un filtro FES, in POST se il server lo accetta"""
+        if not self.supports_post():
+            return self.get_records(None, count, FILTER=fes_filter)
+        body = (f'<wfs:GetFeature service="WFS" version="2.0.0" count="{count}" '
+                f'xmlns:wfs="{NAMESPACES["wfs"]}">'
+                f'<wfs:Query typeNames="{self.typename}" srsName="{SRSNAME}" '
+                f'xmlns:CP="{NAMESPACES["CP"]}">{fes_filter}</wfs:Query></wfs:GetFeature>')
+        response = self.http.request('POST', f"{self.url}?language=ita",
+                                     headers={'Content-Type': 'text/xml; charset=utf-8'},
+                                     body=body.encode('utf-8'))
+        return parse_getfeature(response.data, self.typename)
+
+    def get_records_by_refs(self, refs, batch_size=None):
+        """
+        Record delle particelle con i riferimenti catastali indicati.
+        I riferimenti sono chiesti a gruppi (PropertyIsEqualTo in Or), una
+        richiesta per gruppo invece di una per riferimento.
+        """
+        refs = list(dict.fromkeys(refs))
+        if not batch_size:
+            batch_size = POST_BATCH_SIZE if self.supports_post() else GET_BATCH_SIZE
+        scheduler = get_scheduler()
+        records = []
+        for i in range(0, len(refs), batch_size):
+            batch = refs[i:i + batch_size]
+            records.extend(scheduler.call(self.get_records_filtered, refs_filter(batch), 2 * len(batch)))
+        return records
+
+    def get_features(self, bbox, count=100, **extra):
+        """QgsFeature nel bbox, con i campi dello schema"""
+        fields = self.fields()
+        return [record_to_feature(record, fields) for record in self.get_records(bbox, count, **extra)]
@@ -5,13 +5,28 @@ from qgis.PyQt.QtWidgets import QInputDialog, QLineEdit, QFileDialog, QMessageBo
 import os
 import tempfile
 import shutil
-import urllib.request
+import sys
+import inspect
 from zipfile import ZipFile
 import processing
 import time
 import gc
 from datetime import datetime, timedelta
 
+# I moduli condivisi (catasto_*.py) stanno nella stessa cartella dello script
+cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+from catasto_compact import compact_summary, write_compact
+from catasto_gml import convert_large_gml
+from catasto_http import download_to_file
+from catasto_offline import register_gpkg
+from catasto_pyramid import build_pyramid, load_pyramid
+from catasto_refindex import get_refindex
+from catasto_valid import GeometryValidator
+from catasto_vtiles import export_vector_tiles_task
+
 def log_message(msg):
     print(msg)
     QgsMessageLog.logMessage(msg, 'Elaborazione GML')
@@ -122,11 +137,34 @@ def collect_inputs():
     if not ok: return None
     inputs['load_layers'] = load_layers == 'Sì'
     
+    inputs['pyramid'] = False
+    if format_name == 'GPKG' and file_type in ['Particelle (PLE)', 'Entrambi']:
+        pyramid, ok = QInputDialog.getItem(None, 'Livelli semplificati',
+                                           'Vuoi creare i livelli semplificati delle particelle per le piccole scale?',
+                                           ['No', 'Sì'], 0, False)
+        if not ok: return None
+        inputs['pyramid'] = pyramid == 'Sì'
+    
+    inputs['compact'] = False
+    if format_name == 'GPKG':
+        compact, ok = QInputDialog.getItem(None, 'Profilo compatto',
+                                           'Vuoi salvare anche una copia compatta (.cpkg, coordinate quantizzate) dei file uniti?',
+                                           ['No', 'Sì'], 0, False)
+        if not ok: return None
+        inputs['compact'] = compact == 'Sì'
+    
+    tiles, ok = QInputDialog.getItem(None, 'Tile vettoriali',
+                                     'Vuoi esportare i file uniti in tile vettoriali?',
+                                     ['No', 'PMTiles', 'MBTiles'], 0, False)
+    if not ok: return None
+    inputs['vector_tiles'] = None if tiles == 'No' else tiles.lower()
+    
     return inputs
 
 def merge_files(source_folder, output_file, file_type, inputs):
     start_time = datetime.now()
     temp_merge = None
+    converted_dir = None
     try:
         source_files = [os.path.join(source_folder, f) for f in os.listdir(source_folder) 
                     if f.endswith('.gml')]
@@ -134,6 +172,9 @@ def merge_files(source_folder, output_file, file_type, inputs):
         if source_files:
             temp_merge = os.path.join(os.path.dirname(output_file), 
                                     f"temp_merge_{file_type}.gpkg")
+            # I GML molto grandi si leggono in parallelo e passano al merge come GeoPackage
+            converted_dir = tempfile.mkdtemp()
+            source_files = convert_large_gml(source_files, converted_dir, log=log_message)
             
             merge_params = {
                 'LAYERS': source_files,
@@ -161,7 +202,17 @@ def merge_files(source_folder, output_file, file_type, inputs):
             log_message(f"Filtro attributi per {file_type}...")
             result = processing.run("native:retainfields", filter_params)
             
-            if inputs['load_layers']:
+            # Geometrie del file unito: controllo rapido, GEOS e riparazione in parallelo
+            validator = GeometryValidator()
+            output_layer = QgsVectorLayer(output_file, f"{file_type}_check", "ogr")
+            if output_layer.isValid() and validator.validate_layer(output_layer):
+                log_message(validator.summary())
+            else:
+                log_message(f"Validazione delle geometrie non disponibile per {os.path.basename(output_file)}")
+            del output_layer
+            
+            # Con i livelli semplificati le particelle si caricano dopo, come gruppo a scale
+            if inputs['load_layers'] and not (file_type == 'PLE' and inputs['pyramid']):
                 merged_layer = QgsVectorLayer(output_file, f"{file_type}_Uniti", "ogr")
                 if merged_layer.isValid():
                     QgsProject.instance().addMapLayer(merged_layer)
@@ -185,6 +236,8 @@ def merge_files(source_folder, output_file, file_type, inputs):
                 os.remove(temp_merge)
             except Exception as e:
                 log_message(f"Impossibile rimuovere il file temporaneo: {str(e)}")
+        if converted_dir:
+            shutil.rmtree(converted_dir, ignore_errors=True)
     
     return None
 
@@ -205,7 +258,7 @@ def process_gml_files():
         
         log_message("Download del file zip...")
         zip_path = os.path.join(temp_dir, "downloaded.zip")
-        urllib.request.urlretrieve(inputs['url'], zip_path)
+        download_to_file(inputs['url'], zip_path)
         
         log_message("Estrazione province...")
         with ZipFile(zip_path, 'r') as zip_ref:
@@ -252,9 +305,53 @@ def process_gml_files():
         
         if inputs['file_type'] in ['Particelle (PLE)', 'Entrambi']:
             ple_time = merge_files(ple_folder, inputs['ple_output'], 'PLE', inputs)
+        
+        # Profilo compatto prima dei livelli semplificati: il confronto delle dimensioni
+        # riguarda solo il layer unito, che è quello che finisce nel file compatto
+        if inputs['compact']:
+            for key in ('map_output', 'ple_output'):
+                if key in inputs and os.path.exists(inputs[key]):
+                    log_message(compact_summary(write_compact(inputs[key])))
+        
+        if inputs['file_type'] in ['Particelle (PLE)', 'Entrambi']:
+            # Le particelle unite in GeoPackage diventano disponibili per la ricerca offline e nell'indice dei riferimenti
+            if inputs['ple_output'].endswith('.gpkg') and os.path.exists(inputs['ple_output']):
+                refindex = get_refindex()
+                refindex.add_gpkg(inputs['ple_output'])
+                refindex.save()
+                if inputs['pyramid']:
+                    build_pyramid(inputs['ple_output'])
+                # Dopo i livelli semplificati, che modificano il file: l'indice per la ricerca offline si crea qui
+                log_message("Indice dei riferimenti per la ricerca offline...")
+                register_gpkg(inputs['ple_output'])
+                if inputs['pyramid'] and inputs['load_layers']:
+                    load_pyramid(inputs['ple_output'], 'PLE_Uniti')
+                    log_message("Layer PLE caricato in QGIS con i livelli semplificati")
             if ple_time:
                 processing_times['PLE'] = ple_time
         
+        if inputs['vector_tiles']:
+            map_path = inputs.get('map_output') if map_count and os.path.exists(inputs.get('map_output', '')) else None
+            ple_path = inputs.get('ple_output') if ple_count and os.path.exists(inputs.get('ple_output', '')) else None
+            if map_path or ple_path:
+                tiles_output = os.path.join(os.path.dirname(ple_path or map_path),
+                                            f"{inputs['region'].lower()}_catasto.{inputs['vector_tiles']}")
+                log_message("Esportazione in tile vettoriali in background (gestore delle attività di QGIS)...")
+                tiles_start = datetime.now()
+
+                def tiles_finished(exception, result=None, tiles_start=tiles_start):
+                    if exception is None:
+                        minutes = (datetime.now() - tiles_start).total_seconds() / 60
+                        log_message(f"Tile vettoriali esportati in {minutes:.2f} minuti: {result}")
+                    else:
+                        log_message(f"Errore nell'esportazione dei tile: {str(exception)}")
+
+                try:
+                    export_vector_tiles_task(map_path, ple_path, tiles_output, on_finished=tiles_finished)
+                    inputs['tiles_output'] = tiles_output
+                except Exception as e:
+                    log_message(f"Errore nell'esportazione dei tile: {str(e)}")
+        
         if inputs['delete_temp']:
             log_message("Pulizia file temporanei...")
             safe_cleanup(temp_dir)
@@ -274,6 +371,8 @@ def process_gml_files():
             log_message(f"File MAP salvato in: {inputs['map_output']}")
         if 'ple_output' in inputs:
             log_message(f"File PLE salvato in: {inputs['ple_output']}")
+        if 'tiles_output' in inputs:
+            log_message(f"Tile vettoriali (in esportazione in background) in: {inputs['tiles_output']}")
         
         log_message("\nTempi di elaborazione:")
         for file_type, proc_time in processing_times.items():
@@ -1,14 +1,26 @@
 #© totò fiandaca - 16/02/2025
 
 from qgis.PyQt.QtWidgets import QMessageBox
-from qgis.core import (QgsVectorLayer, QgsProject, QgsGeometry, 
+from qgis.core import (QgsVectorLayer, QgsProject, 
                       QgsFeature, QgsPointXY, QgsWkbTypes)
 from qgis.gui import QgsMapToolEmitPoint, QgsRubberBand
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QColor
-import urllib.request
-import urllib.parse
-import xml.etree.ElementTree as ET
+import os
+import sys
+import inspect
+
+# I moduli condivisi (catasto_*.py) stanno nella stessa cartella dello script
+cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+from catasto_http import get_session
+from catasto_scheduler import get_scheduler
+from catasto_cache import get_cache
+from catasto_geom import PolygonClipper
+from catasto_valid import GeometryValidator
+from catasto_wfs import ZONING_TYPENAME, getfeature_url, parse_getfeature
 
 class CadastralDownloader:
     def __init__(self, iface):
@@ -44,29 +56,30 @@ class CadastralDownloader:
     def download_cadastral_data(self):
         geometry = self.rubber_band.asGeometry()
         bbox = geometry.boundingBox()
+        bbox_rect = (bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum())
         
-        base_url = "https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/owfs01.php"
-        params = {
-            'language': 'ita',
-            'SERVICE': 'WFS',
-            'REQUEST': 'GetFeature',
-            'VERSION': '2.0.0',
-            'TYPENAMES': 'CP:CadastralZoning',
-            'STARTINDEX': '0',
-            'COUNT': '1000',
-            'SRSNAME': 'urn:ogc:def:crs:EPSG::6706',
-            'BBOX': f"{bbox.yMinimum()},{bbox.xMinimum()},{bbox.yMaximum()},{bbox.xMaximum()},urn:ogc:def:crs:EPSG::6706"
-        }
-        
-        url = f"{base_url}?{urllib.parse.urlencode(params)}"
+        def fetch(piece):
+            # Solo le parti del bbox non già in cache arrivano al WFS, a pagine:
+            # una pagina corta (limite del server su COUNT) non chiude la parte
+            # prima della verifica dello scheduler, e una parte in cache è sempre completa.
+            # Gli errori transitori (timeout, 5xx) sono ritentati con backoff
+            def fetch_page(start_index, count):
+                url = getfeature_url(ZONING_TYPENAME, piece, start_index, count)
+                page = parse_getfeature(get_session().get(url), ZONING_TYPENAME)
+                return page, len(page)
+            
+            records = []
+            for _, page in get_scheduler().run_pages(fetch_page):
+                records.extend(page)
+            return records
         
         try:
-            headers = {
-                'User-Agent': 'Mozilla/5.0 QGIS/33415/Windows 11 Version 2009'
-            }
-            request = urllib.request.Request(url, headers=headers)
-            response = urllib.request.urlopen(request)
-            data = response.read()
+            records = get_cache().get(ZONING_TYPENAME, bbox_rect, fetch)
+            
+            # Il WFS lavora per bbox: si tengono solo i fogli che toccano il poligono disegnato
+            clipper = PolygonClipper(geometry)
+            records = clipper.filter_records(records)
+            print(clipper.summary())
             
             # Crea il layer con i campi corretti basati sulla risposta XML
             uri = ("Polygon?crs=EPSG:6706"
@@ -87,65 +100,43 @@ class CadastralDownloader:
             
             temp_layer.startEditing()
             
-            # Parse XML con i namespace corretti
-            namespaces = {
-                'wfs': 'http://www.opengis.net/wfs/2.0',
-                'gml': 'http://www.opengis.net/gml/3.2',
-                'CP': 'http://mapserver.gis.umn.edu/mapserver'
+            # Campo del layer -> tag della risposta WFS
+            attribute_tags = {
+                'label': 'LABEL',
+                'inspireid_localid': 'INSPIREID_LOCALID',
+                'inspireid_namespace': 'INSPIREID_NAMESPACE',
+                'nationalcadastralref': 'NATIONALCADASTRALZONINGREFERENCE',
+                'beginlifespanversion': 'BEGINLIFESPANVERSION',
+                'level': 'LEVEL',
+                'levelname': 'LEVELNAME',
+                'originalscale': 'ORIGINALMAPSCALEDENOMINATOR',
+                'administrativeunit': 'ADMINISTRATIVEUNIT'
             }
             
-            root = ET.fromstring(data)
-            features = root.findall('.//CP:CadastralZoning', namespaces)
+            # Controllo rapido sui fogli semplici, GEOS e riparazione in parallelo sugli altri
+            validator = GeometryValidator()
+            valid_records = validator.validate_records(records)
+            print(validator.summary())
             
-            for feature in features:
+            for record, geom in valid_records:
                 try:
-                    # Cerca la geometria
-                    geom_elem = feature.find('.//gml:posList', namespaces)
-                    if geom_elem is not None and geom_elem.text:
-                        coords_text = geom_elem.text.strip()
-                        coords_list = coords_text.split()
-                        
-                        coords_pairs = []
-                        for i in range(0, len(coords_list), 2):
-                            lat = coords_list[i]
-                            lon = coords_list[i+1]
-                            coords_pairs.append(f"{lon} {lat}")
-                        
-                        wkt = f"POLYGON(({', '.join(coords_pairs)}))"
-                        
-                        # Crea la feature
-                        feat = QgsFeature(temp_layer.fields())
-                        geom = QgsGeometry.fromWkt(wkt)
-                        if not geom.isGeosValid():
-                            geom = geom.makeValid()
-                        feat.setGeometry(geom)
-                        
-                        # Estrai attributi usando i tag corretti
-                        attributes = {
-                            'label': feature.find('.//CP:LABEL', namespaces),
-                            'inspireid_localid': feature.find('.//CP:INSPIREID_LOCALID', namespaces),
-                            'inspireid_namespace': feature.find('.//CP:INSPIREID_NAMESPACE', namespaces),
-                            'nationalcadastralref': feature.find('.//CP:NATIONALCADASTRALZONINGREFERENCE', namespaces),
-                            'beginlifespanversion': feature.find('.//CP:BEGINLIFESPANVERSION', namespaces),
-                            'level': feature.find('.//CP:LEVEL', namespaces),
-                            'levelname': feature.find('.//CP:LEVELNAME', namespaces),
-                            'originalscale': feature.find('.//CP:ORIGINALMAPSCALEDENOMINATOR', namespaces),
-                            'administrativeunit': feature.find('.//CP:ADMINISTRATIVEUNIT', namespaces)
-                        }
-                        
-                        # Imposta gli attributi
-                        for field_name, elem in attributes.items():
-                            if elem is not None and elem.text:
-                                if field_name == 'originalscale':
-                                    feat.setAttribute(field_name, int(elem.text))
-                                else:
-                                    feat.setAttribute(field_name, elem.text)
-                                print(f"Attributo {field_name}: {elem.text}")  # Debug
-                        
-                        # Aggiungi la feature
-                        success = temp_layer.addFeature(feat)
-                        if not success:
-                            print(f"Errore nell'aggiunta della feature")
+                    # Crea la feature
+                    feat = QgsFeature(temp_layer.fields())
+                    feat.setGeometry(geom)
+                    
+                    # Imposta gli attributi
+                    for field_name, tag in attribute_tags.items():
+                        value = record['attrs'].get(tag)
+                        if value:
+                            if field_name == 'originalscale':
+                                feat.setAttribute(field_name, int(value))
+                            else:
+                                feat.setAttribute(field_name, value)
+                    
+                    # Aggiungi la feature
+                    success = temp_layer.addFeature(feat)
+                    if not success:
+                        print(f"Errore nell'aggiunta della feature")
                 
                 except Exception as e:
                     print(f"Errore nel processare una feature: {str(e)}")
@@ -155,7 +146,9 @@ class CadastralDownloader:
             
             if temp_layer.featureCount() > 0:
                 QgsProject.instance().addMapLayer(temp_layer)
-                QMessageBox.information(None, "Successo", f"Scaricate {temp_layer.featureCount()} geometrie catastali!")
+                QMessageBox.information(None, "Successo",
+                                        f"Scaricate {temp_layer.featureCount()} geometrie catastali!\n"
+                                        f"Scartate {clipper.discarded} geometrie del bbox esterne al poligono")
             else:
                 QMessageBox.warning(None, "Attenzione", "Nessuna geometria trovata nell'area selezionata")
             
@@ -1,16 +1,33 @@
 #© totò fiandaca - 16/02/2025
 
 from qgis.PyQt.QtWidgets import QMessageBox
-from qgis.core import (QgsVectorLayer, QgsProject, QgsGeometry, 
+from qgis.core import (QgsVectorLayer, QgsProject, 
                       QgsFeature, QgsPointXY, QgsWkbTypes)
 from qgis.gui import QgsMapToolEmitPoint, QgsRubberBand
 from PyQt5.QtCore import Qt
 from PyQt5.QtGui import QColor
-import urllib.request
-import urllib.parse
 import xml.etree.ElementTree as ET
-import gzip
-import re
+import os
+import sys
+import inspect
+
+# I moduli condivisi (catasto_*.py) stanno nella stessa cartella dello script
+cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+from catasto_http import get_session
+from catasto_scheduler import get_scheduler, PageFetchError
+from catasto_checkpoint import DownloadCheckpoint, page_digest, prune_checkpoints
+from catasto_cache import get_cache
+from catasto_geom import PolygonClipper
+from catasto_refindex import get_refindex, parse_inspire_id
+from catasto_valid import GeometryValidator
+from catasto_wfs import (PARCEL_TYPENAME, PARCEL_ATTRIBUTES, getfeature_url, parse_getfeature,
+                         string_fields, record_to_feature, feature_to_record)
+
+# Campi salvati nel checkpoint: gli attributi originali del WFS
+PARCEL_FIELDS = string_fields(PARCEL_ATTRIBUTES)
 
 class ParcelDownloader:
     def __init__(self, iface):
@@ -27,17 +44,10 @@ class ParcelDownloader:
             return None, None
             
         # L'ID è nel formato IT.AGE.PLA.C342_004000.101
-        try:
-            # Estrai il codice belfiore (comune)
-            comune_match = re.search(r'\.([A-Z]\d{3})[_A-Z]', inspireid)
-            comune = comune_match.group(1) if comune_match else ""
-            
-            # Estrai il numero del foglio (caratteri 17-20)
-            foglio = inspireid[16:20] if len(inspireid) >= 20 else ""
-            
-            return comune, foglio
-        except:
+        parts = parse_inspire_id(inspireid)
+        if parts is None:
             return "", ""
+        return parts.belfiore, parts.foglio
         
     def start_drawing(self):
         self.rubber_band = QgsRubberBand(self.canvas, QgsWkbTypes.PolygonGeometry)
@@ -62,41 +72,92 @@ class ParcelDownloader:
             self.download_parcels()
             
     def download_chunk(self, bbox, start_index=0, chunk_size=1000):
-        base_url = "https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/owfs01.php"
-        params = {
-            'language': 'ita',
-            'SERVICE': 'WFS',
-            'REQUEST': 'GetFeature',
-            'VERSION': '2.0.0',
-            'TYPENAMES': 'CP:CadastralParcel',
-            'STARTINDEX': str(start_index),
-            'COUNT': str(chunk_size),
-            'SRSNAME': 'urn:ogc:def:crs:EPSG::6706',
-            'BBOX': f"{bbox.yMinimum()},{bbox.xMinimum()},{bbox.yMaximum()},{bbox.xMaximum()},urn:ogc:def:crs:EPSG::6706"
-        }
-        
-        url = f"{base_url}?{urllib.parse.urlencode(params)}"
+        url = getfeature_url(PARCEL_TYPENAME, bbox, start_index, chunk_size)
         print(f"Scaricamento chunk {start_index}-{start_index + chunk_size}, URL: {url}")
         
-        headers = {
-            'User-Agent': 'Mozilla/5.0 QGIS/33415/Windows 11 Version 2009',
-            'Accept-Encoding': 'gzip',
-            'Accept': '*/*'
-        }
+        # La sessione condivisa riusa la stessa connessione keep-alive per tutte le pagine
+        return get_session().get_text(url)
+    
+    def count_matched(self, bbox):
+        """Numero di particelle nel bbox secondo il server (RESULTTYPE=hits), None se non disponibile"""
+        url = getfeature_url(PARCEL_TYPENAME, bbox, RESULTTYPE='hits')
+        try:
+            root = ET.fromstring(get_scheduler().call(get_session().get, url))
+            return int(root.get('numberMatched'))
+        except Exception as e:
+            print(f"Conteggio delle particelle non disponibile: {str(e)}")
+            return None
+    
+    def download_area(self, bbox):
+        """
+        Scarica tutte le particelle di un bbox (xmin, ymin, xmax, ymax) a pagine.
+        Returns:
+            (records, incomplete): record scaricati e PageFetchError se il download si è interrotto
+        """
+        def fetch_page(start_index, count):
+            # Eseguita nei thread dello scheduler: scarica e interpreta la pagina
+            chunk_data = self.download_chunk(bbox, start_index, count)
+            records = parse_getfeature(chunk_data, PARCEL_TYPENAME)
+            return (records, page_digest(records)), len(records)
+        
+        def fetch_digest(start_index, count):
+            (records, digest), _ = get_scheduler().call(fetch_page, start_index, count)
+            return digest
         
-        request = urllib.request.Request(url, headers=headers)
-        response = urllib.request.urlopen(request)
+        # Ogni pagina completata viene salvata su disco: un download interrotto
+        # riparte dall'ultima pagina, uno già completo viene solo verificato
+        checkpoint = DownloadCheckpoint(PARCEL_TYPENAME, bbox, PARCEL_FIELDS)
+        if checkpoint.complete:
+            try:
+                unchanged = checkpoint.verify(self.count_matched(bbox), fetch_digest)
+            except Exception as e:
+                print(f"Verifica del checkpoint non riuscita: {str(e)}")
+                unchanged = False
+            if unchanged:
+                print(f"Area già scaricata e invariata sul server: {checkpoint.total} particelle dal checkpoint")
+            else:
+                print("Dati sul server cambiati o non verificabili: nuovo download dell'area")
+                checkpoint.reset()
+        elif checkpoint.completed_pages:
+            # Le pagine già salvate si riusano solo se sul server sono invariate
+            try:
+                if not checkpoint.verify_pages(fetch_digest):
+                    print("Dati sul server cambiati: il download dell'area riparte da zero")
+                    checkpoint.reset()
+            except Exception as e:
+                print(f"Verifica delle pagine salvate non riuscita, si riprende comunque: {str(e)}")
         
-        if response.info().get('Content-Encoding') == 'gzip':
-            data = gzip.decompress(response.read())
-        else:
-            data = response.read()
-            
-        return data.decode('utf-8')
+        start = 0
+        if not checkpoint.complete:
+            start = checkpoint.resume_from()
+        
+        # Ricarica le pagine già salvate (download ripreso o verificato)
+        records = [feature_to_record(saved, names=PARCEL_ATTRIBUTES) for saved in checkpoint.features()]
+        if records:
+            print(f"Particelle già salvate nel checkpoint: {len(records)}")
+        
+        incomplete = None
+        if not checkpoint.complete:
+            # Lo scheduler ritenta gli errori transitori e adatta concorrenza e COUNT
+            try:
+                for start_index, (page_records, digest) in get_scheduler().run_pages(fetch_page, start_index=start):
+                    print(f"Features trovate nel chunk {start_index}: {len(page_records)}")
+                    features = [record_to_feature(record, PARCEL_FIELDS) for record in page_records]
+                    checkpoint.add_page(start_index, len(page_records), features, digest)
+                    records.extend(page_records)
+                    print(f"Totale features scaricate: {len(records)}")
+                checkpoint.finish()
+            except PageFetchError as e:
+                incomplete = e
+                print(f"Errore nel processare il chunk {e.start_index}: {str(e.cause)}")
+                print("Le pagine scaricate sono salvate: rilanciare il download sulla stessa area per riprendere")
+        
+        return records, incomplete
             
     def download_parcels(self):
         geometry = self.rubber_band.asGeometry()
         bbox = geometry.boundingBox()
+        bbox_rect = (bbox.xMinimum(), bbox.yMinimum(), bbox.xMaximum(), bbox.yMaximum())
         
         try:
             # Crea il layer con i campi nell'ordine richiesto
@@ -113,48 +174,60 @@ class ParcelDownloader:
             
             temp_layer.startEditing()
             
-            chunk_size = 1000
-            start_index = 0
-            total_processed = 0
-            has_more = True
-            
-            namespaces = {
-                'wfs': 'http://www.opengis.net/wfs/2.0',
-                'gml': 'http://www.opengis.net/gml/3.2',
-                'CP': 'http://mapserver.gis.umn.edu/mapserver'
-            }
-            
-            while has_more:
-                try:
-                    chunk_data = self.download_chunk(bbox, start_index, chunk_size)
-                    chunk_root = ET.fromstring(chunk_data)
-                    features = chunk_root.findall('.//CP:CadastralParcel', namespaces)
-                    
-                    num_features = len(features)
-                    if num_features == 0:
-                        has_more = False
-                        break
-                        
-                    print(f"Features trovate in questo chunk: {num_features}")
-                    processed = self.process_features(features, temp_layer, namespaces)
-                    total_processed += processed
-                    print(f"Processate {processed} features nel chunk {start_index}-{start_index + chunk_size}")
-                    print(f"Totale features processate: {total_processed}")
-                    
-                    if num_features < chunk_size:
-                        has_more = False
-                    else:
-                        start_index += chunk_size
-                        
-                except Exception as e:
-                    print(f"Errore nel processare il chunk {start_index}: {str(e)}")
-                    has_more = False
+            scheduler = get_scheduler()
+            scheduler.reset_stats()
+            
+            # Dal WFS si scarica solo la parte dell'area non già presente in cache
+            cache = get_cache()
+            # Checkpoint di aree non più richieste da tempo: spazio su disco liberato
+            prune_checkpoints()
+            pieces = cache.uncovered(PARCEL_TYPENAME, bbox_rect)
+            if not pieces:
+                print("Area interamente presente nella cache locale")
+            
+            incomplete = None
+            partial_records = []
+            for piece in pieces:
+                records, incomplete = self.download_area(piece)
+                if incomplete:
+                    # Un'area incompleta non entra in cache: si mostra quello che c'è
+                    partial_records = records
+                    break
+                # Il checkpoint completo resta: scaduta la cache, la stessa area si riverifica senza riscaricarla
+                cache.store(PARCEL_TYPENAME, piece, records)
+            
+            records = cache.query(PARCEL_TYPENAME, bbox_rect)
+            if partial_records:
+                keys = set(record['key'] for record in records)
+                records.extend(record for record in partial_records if record['key'] not in keys)
+            
+            print(scheduler.summary())
+            
+            # Il WFS lavora per bbox: si tengono solo le particelle che toccano il poligono disegnato
+            clipper = PolygonClipper(geometry)
+            records = clipper.filter_records(records)
+            print(clipper.summary())
+            
+            processed = self.process_features(records, temp_layer)
+            print(f"Totale features processate: {processed}")
+            
+            # Le particelle scaricate entrano nell'indice dei riferimenti
+            refindex = get_refindex()
+            refindex.add_records(records)
+            refindex.save()
             
             temp_layer.commitChanges()
             
             if temp_layer.featureCount() > 0:
                 QgsProject.instance().addMapLayer(temp_layer)
-                QMessageBox.information(None, "Successo", f"Scaricate {temp_layer.featureCount()} particelle catastali!")
+                if incomplete:
+                    QMessageBox.warning(None, "Download incompleto",
+                                        f"Scaricate {temp_layer.featureCount()} particelle catastali, "
+                                        f"ma la pagina {incomplete.start_index} non è stata scaricata: {str(incomplete.cause)}")
+                else:
+                    QMessageBox.information(None, "Successo",
+                                            f"Scaricate {temp_layer.featureCount()} particelle catastali!\n"
+                                            f"Scartate {clipper.discarded} particelle del bbox esterne al poligono")
             else:
                 QMessageBox.warning(None, "Attenzione", "Nessuna particella trovata nell'area selezionata")
             
@@ -168,52 +241,36 @@ class ParcelDownloader:
                 self.rubber_band = None
             self.points = []
             
-    def process_features(self, features, layer, namespaces):
+    def process_features(self, records, layer):
         processed = 0
-        for i, feature in enumerate(features, 1):
+        # Controllo rapido sulle particelle semplici, GEOS e riparazione in parallelo sulle altre
+        validator = GeometryValidator()
+        valid_records = validator.validate_records(records)
+        print(validator.summary())
+        for record, geom in valid_records:
             try:
-                geom_elem = feature.find('.//gml:posList', namespaces)
-                if geom_elem is not None and geom_elem.text:
-                    coords_text = geom_elem.text.strip()
-                    coords_list = coords_text.split()
-                    
-                    coords_pairs = []
-                    for i in range(0, len(coords_list), 2):
-                        lat = coords_list[i]
-                        lon = coords_list[i+1]
-                        coords_pairs.append(f"{lon} {lat}")
-                    
-                    wkt = f"POLYGON(({', '.join(coords_pairs)}))"
-                    
-                    feat = QgsFeature(layer.fields())
-                    geom = QgsGeometry.fromWkt(wkt)
-                    if not geom.isGeosValid():
-                        geom = geom.makeValid()
-                    feat.setGeometry(geom)
-                    
-                    # Estrai i campi
-                    label = feature.find('.//CP:LABEL', namespaces)
-                    inspireid = feature.find('.//CP:INSPIREID_LOCALID', namespaces)
-                    
-                    # Imposta i valori nell'ordine corretto
-                    inspireid_value = inspireid.text if inspireid is not None else ""
-                    feat.setAttribute('inspireid_localid', inspireid_value)
-                    
-                    # Estrai e imposta comune e foglio
-                    comune, foglio = self.extract_info_from_id(inspireid_value)
-                    feat.setAttribute('comune', comune)
-                    feat.setAttribute('foglio', foglio)
-                    
-                    # Imposta la particella (ex label)
-                    feat.setAttribute('particella', label.text if label is not None else "")
-                    
-                    success = layer.addFeature(feat)
-                    if success:
-                        processed += 1
-                        if processed % 100 == 0:
-                            print(f"Aggiunte {processed} features al layer")
-                    else:
-                        print(f"Errore nell'aggiunta della feature")
+                feat = QgsFeature(layer.fields())
+                feat.setGeometry(geom)
+                
+                # Imposta i valori nell'ordine corretto
+                inspireid_value = record['attrs'].get('INSPIREID_LOCALID', "")
+                feat.setAttribute('inspireid_localid', inspireid_value)
+                
+                # Estrai e imposta comune e foglio
+                comune, foglio = self.extract_info_from_id(inspireid_value)
+                feat.setAttribute('comune', comune)
+                feat.setAttribute('foglio', foglio)
+                
+                # Imposta la particella (ex label)
+                feat.setAttribute('particella', record['attrs'].get('LABEL', ""))
+                
+                success = layer.addFeature(feat)
+                if success:
+                    processed += 1
+                    if processed % 100 == 0:
+                        print(f"Aggiunte {processed} features al layer")
+                else:
+                    print(f"Errore nell'aggiunta della feature")
             
             except Exception as e:
                 print(f"Errore nel processare una feature: {str(e)}")
@@ -13,32 +13,99 @@ from qgis.utils import qgsfunction
 import urllib.request
 import urllib.parse
 from xml.etree import ElementTree as ET
+import os
+import sys
+import inspect
 
-def format_wkt(wkt, decimals=6):
+# I moduli condivisi (catasto_*.py) stanno nella stessa cartella dello script
+cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+from catasto_geom import geometry_output
+from catasto_memo import get_memo, snap_point
+from catasto_offline import ParcelBackend
+from catasto_tiles import TileLookup, tile_of
+from catasto_wfs import PARCEL_TYPENAME, WfsSession
+
+# Tessere più grandi di quelle dei clic: nel calcolo su un layer intero i punti sono fitti
+BATCH_TILE_SIZE = 0.01
+# Righe valutate in una tessera prima di scaricarla intera: con meno punti
+# la richiesta riga per riga scarica meno dati della tessera
+BATCH_MIN_POINTS = 16
+
+# Sessione WFS e ricerca a tessere condivise da tutte le valutazioni della funzione
+_wfs_session = None
+_batch_lookup = None
+_batch_tiles = {}
+_backend = None
+
+def get_wfs_session():
+    global _wfs_session
+    if _wfs_session is None:
+        _wfs_session = WfsSession(PARCEL_TYPENAME)
+    return _wfs_session
+
+def get_backend():
+    """WFS o GeoPackage offline secondo ~/.catasto_unzip_all/offline.json"""
+    global _backend
+    if _backend is None:
+        _backend = ParcelBackend()
+    return _backend
+
+def get_batch_lookup(x, y, context):
     """
-    Formatta una stringa WKT con il numero specificato di decimali.
+    Ricerca a tessere per il punto, quando l'espressione è calcolata su un layer.
+    Si contano le righe valutate in ogni tessera: arrivata a BATCH_MIN_POINTS la
+    tessera si scarica intera e le sue righe successive si risolvono in locale.
+    Si scaricano così solo tessere fitte di righe davvero valutate (selezione e
+    filtri compresi); una tessera che non si riesce a scaricare torna, da sola,
+    alle richieste riga per riga.
+    Returns:
+        TileLookup, o None per la richiesta sul solo punto
     """
-    import re
+    global _batch_lookup, _batch_tiles
+    if context is None or not context.hasVariable('layer_id') or get_backend().mode == 'offline':
+        return None
+    cache_key = 'catasto_batch_lookup'
+    if not context.hasCachedValue(cache_key):
+        # Nuovo calcolo: i conteggi ripartono da zero
+        context.setCachedValue(cache_key, True)
+        _batch_tiles = {}
+    if _batch_lookup is None:
+        _batch_lookup = TileLookup(get_wfs_session(), tile_size=BATCH_TILE_SIZE, prefetch=False)
     
-    def format_number(match):
-        num = float(match.group(0))
-        return f"{num:.{decimals}f}"
-    
-    formatted = re.sub(r'\d+\.\d+', format_number, wkt)
-    formatted = formatted.replace(",", ", ")
-    formatted = formatted.replace("), ", "),\n")
-    
-    return formatted
+    tile = tile_of(x, y, BATCH_TILE_SIZE)
+    state = _batch_tiles.get(tile, 0)
+    if state is True:
+        return _batch_lookup
+    if state is False:
+        return None
+    if state + 1 < BATCH_MIN_POINTS:
+        _batch_tiles[tile] = state + 1
+        return None
+    try:
+        _batch_lookup.fetch_tile(tile)
+        _batch_tiles[tile] = True
+        return _batch_lookup
+    except Exception:
+        _batch_tiles[tile] = False
+        return None
 
-@qgsfunction(args='auto', group='Catasto', usesgeometry=True)
-def get_particella_infoWFS(geom, feature, parent):
+NOT_FOUND = ('N/D', 'N/D', 'N/D', 'N/D', 'N/D')
+
+@qgsfunction(args=-1, group='Catasto', usesgeometry=True)
+def get_particella_infoWFS(values, feature, parent, context):
     """
     <h1>Catasto Agenzia delle Entrate CC BY 4.0:</h1>    
     La funzione restituisce le informazioni WFS Catasto disponibili nella particella sottostante.
 
     <h2>Parametri</h2>
     <ul>
-      <li>geometry: geometria del punto (viene passata automaticamente)</li>
+      <li>geometry: geometria del punto</li>
+      <li>mode (facoltativo): forma della geometria restituita: 'wkt' (predefinita), 'geom'
+          (geometria QGIS), 'wkb' oppure 'simplified' (WKT del contorno semplificato)</li>
+      <li>precision (facoltativo): decimali del WKT (6) o tolleranza in gradi di 'simplified' (0.00001)</li>
     </ul>
     
     <h2>Returns</h2>
@@ -47,66 +114,78 @@ def get_particella_infoWFS(geom, feature, parent):
     </ul>
     
     <h2>Esempio</h2>
-        <pre>get_particella_info($geometry)[0]--> M011_0019C0.131</pre>
-        <pre>get_particella_info($geometry)[1]--> 0019</pre>
-        <pre>get_particella_info($geometry)[2]--> 131</pre>
-        <pre>get_particella_info($geometry)[3]--> M011</pre>
-        <pre>get_particella_info($geometry)[4]--> geometria WKT</pre>
+        <pre>get_particella_infoWFS($geometry)[0]--> M011_0019C0.131</pre>
+        <pre>get_particella_infoWFS($geometry)[1]--> 0019</pre>
+        <pre>get_particella_infoWFS($geometry)[2]--> 131</pre>
+        <pre>get_particella_infoWFS($geometry)[3]--> M011</pre>
+        <pre>get_particella_infoWFS($geometry)[4]--> geometria WKT</pre>
+        <pre>get_particella_infoWFS($geometry, 'geom')[4]--> geometria</pre>
     """
     try:
+        geom = values[0]
+        mode = values[1] if len(values) > 1 and values[1] else 'wkt'
         # Verifica che la geometria sia un punto
-        if geom.type() != QgsWkbTypes.PointGeometry:
+        if not isinstance(geom, QgsGeometry) or geom.type() != QgsWkbTypes.PointGeometry:
             return ['ERROR', 'ERROR', 'ERROR', 'ERROR', 'ERROR']
+        options = {}
+        if len(values) > 2 and values[2] is not None:
+            options['tolerance' if mode == 'simplified' else 'decimals'] = (
+                float(values[2]) if mode == 'simplified' else int(values[2]))
             
         # Prendi le coordinate del punto
         point = geom.asPoint()
         x = point.x()
         y = point.y()
         
-        # Base URL con i parametri base che sappiamo funzionare
-        uri = (f"pagingEnabled='true' "
-               f"preferCoordinatesForWfsT11='false' "
-               f"restrictToRequestBBOX='1' "
-               f"srsname='EPSG:6706' "
-               f"typename='CP:CadastralParcel' "
-               f"url='https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/owfs01.php' "
-               f"version='2.0.0' "
-               f"language='ita'")
-               
-        # Crea un layer temporaneo per la richiesta
-        layer = QgsVectorLayer(uri, "catasto_query", "WFS")
-        
-        if not layer.isValid():
-            return ['ERROR', 'ERROR', 'ERROR', 'ERROR', 'ERROR']
-            
-        # Crea il punto per il filtro spaziale
-        point_geom = QgsGeometry.fromPointXY(QgsPointXY(x, y))
-        request = QgsFeatureRequest().setFilterRect(point_geom.boundingBox())
-        
-        # Recupera le features
-        features = list(layer.getFeatures(request))
-        
-        if features:
-            # Prendi la prima particella trovata
-            feat = features[0]
-            ref = feat['NATIONALCADASTRALREFERENCE']
-            admin = feat['ADMINISTRATIVEUNIT']
-            label = feat['LABEL']
-            foglio = ref[5:9] if len(ref) > 9 else 'N/D'
-            
-            # Ottieni la geometria WKT e formattala
-            geom_wkt = 'N/D'
-            if feat.hasGeometry():
-                geom_wkt = format_wkt(feat.geometry().asWkt())
-            
-            # Restituisci la lista
-            return [ref, foglio, label, admin, geom_wkt]
-        else:
-            return ['N/D', 'N/D', 'N/D', 'N/D', 'N/D']
+        # Stesso punto già risolto (ridisegno, tabella attributi, campo virtuale): nessuna richiesta
+        memo = get_memo('get_particella_infoWFS')
+        key = snap_point(x, y)
+        cached = memo.get(key)
+        if cached is None:
+            cached, source = find_particella(x, y, context)
+            # Un errore di rete solleva un'eccezione e non entra in cache; N/D dai
+            # GeoPackage offline (WFS giù per poco) nemmeno, per riprovare sul WFS
+            if cached is not NOT_FOUND or source == 'wfs':
+                memo.put(key, cached)
+        if cached is NOT_FOUND:
+            return list(NOT_FOUND)
+        # In cache c'è la geometria: ogni valutazione la restituisce nella forma richiesta
+        return list(cached[:4]) + [geometry_output(cached[4], mode, **options)]
                 
     except Exception as e:
         return ['ERROR', 'ERROR', 'ERROR', 'ERROR', 'ERROR']
 
+def find_particella(x, y, context):
+    """
+    Riferimento, foglio, particella, comune e geometria della particella sotto il punto.
+    Returns:
+        (risultato, sorgente): sorgente è 'wfs' oppure 'offline'
+    """
+    lookup = get_batch_lookup(x, y, context)
+    if lookup:
+        # Calcolo su un layer: tessere già in cache, test punto in poligono in locale
+        records, local = lookup.lookup(x, y)
+        source = 'wfs'
+    else:
+        # Filtro spaziale FES sul punto (o bbox con verifica esatta in locale):
+        # arrivano solo le particelle che contengono davvero il punto.
+        # Con WFS lento o irraggiungibile risponde il GeoPackage offline
+        records, source = get_backend().records_at(x, y, get_wfs_session().get_records_at)
+    
+    if not records:
+        return NOT_FOUND, source
+    # Particella che contiene il punto
+    attrs = records[0]['attrs']
+    ref = attrs.get('NATIONALCADASTRALREFERENCE', '')
+    admin = attrs.get('ADMINISTRATIVEUNIT', '')
+    label = attrs.get('LABEL', '')
+    foglio = ref[5:9] if len(ref) > 9 else 'N/D'
+    
+    # Geometria così come arriva (Polygon o MultiPolygon), come il WKT di sempre
+    parcel_geom = QgsGeometry.fromWkt(records[0]['wkt'])
+    return (ref, foglio, label, admin, parcel_geom), source
+
 # Esempio di utilizzo nel calcolatore di campi:
-# get_particella_info($geometry)[0]  # per il riferimento catastale
-# get_particella_info($geometry)[4]  # per la geometria WKT
+# get_particella_infoWFS($geometry)[0]  # per il riferimento catastale
+# get_particella_infoWFS($geometry)[4]  # per la geometria WKT
+# get_particella_infoWFS($geometry, 'geom')[4]  # per la geometria, senza passare dal WKT
@@ -3,60 +3,183 @@ from qgis.utils import qgsfunction
 import urllib.request
 import urllib.parse
 from xml.etree import ElementTree as ET
+import os
+import sys
+import inspect
+import itertools
 
-@qgsfunction(args='auto', group='Catasto')
-def get_particella_by_codes(admin, foglio, particella, feature, parent):
+# I moduli condivisi (catasto_*.py) stanno nella stessa cartella dello script
+cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+from catasto_geom import geometry_output
+from catasto_memo import get_memo
+from catasto_offline import ParcelBackend
+from catasto_wfs import PARCEL_TYPENAME, WfsSession, compose_reference
+
+FUNCTION_NAME = 'get_particella_by_codes'
+# Riferimenti per richiesta WFS (None: 200 se il server accetta POST, altrimenti 20)
+BATCH_SIZE = None
+NOT_FOUND = ('N/D', 'N/D', 'N/D', 'N/D', 'N/D')
+# Righe valutate una per una prima di raccogliere i codici delle altre righe:
+# aggiornare poche righe non fa leggere tutto il layer
+BATCH_MIN_ROWS = 16
+
+# Sessione WFS e sorgente condivise da tutte le valutazioni della funzione
+_wfs_session = None
+_backend = None
+# Ultimo calcolo su un layer: [identificativo, {riferimento: risultato}, righe valutate].
+# I risultati restano fuori dalla cache LRU, che con più righe del suo limite scarterebbe i primi
+_batch = [None, {}, 0]
+_batch_ids = itertools.count(1)
+
+def get_wfs_session():
+    global _wfs_session
+    if _wfs_session is None:
+        _wfs_session = WfsSession(PARCEL_TYPENAME)
+    return _wfs_session
+
+def get_backend():
+    """WFS o GeoPackage offline secondo ~/.catasto_unzip_all/offline.json"""
+    global _backend
+    if _backend is None:
+        _backend = ParcelBackend()
+    return _backend
+
+def record_result(record):
+    """Lista restituita dalla funzione per un record trovato"""
+    attrs = record['attrs']
+    ref = attrs.get('NATIONALCADASTRALREFERENCE', '')
+    foglio = ref[5:9] if len(ref) > 9 else 'N/D'
+    parcel_geom = QgsGeometry.fromWkt(record['wkt'])
+    parcel_geom.convertToMultiType()
+    return (ref, foglio, attrs.get('LABEL', ''), attrs.get('ADMINISTRATIVEUNIT', ''),
+            geometry_output(parcel_geom))
+
+def resolve_refs(refs):
     """
-    Esplora i codici amministrativi disponibili nel servizio WFS.
+    Risultati dei riferimenti: dalla cache quelli già cercati, gli altri con
+    richieste a gruppi (salvati in cache).
+    Returns:
+        dict: {riferimento: risultato}, NOT_FOUND per quelli non trovati
     """
-    try:
-        # Base URL con i parametri base
-        uri = (f"pagingEnabled='true' "
-               f"preferCoordinatesForWfsT11='false' "
-               f"restrictToRequestBBOX='1' "
-               f"srsname='EPSG:6706' "
-               f"typename='CP:CadastralParcel' "
-               f"url='https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/owfs01.php' "
-               f"version='2.0.0' "
-               f"language='ita'")
-               
-        # Crea un layer temporaneo per la richiesta
-        layer = QgsVectorLayer(uri, "catasto_query", "WFS")
-        
-        if not layer.isValid():
-            return 'ERROR: Layer WFS non valido'
-        
-        # Cerchiamo le prime features disponibili nel servizio
-        request = QgsFeatureRequest().setLimit(20)  # Limita a 20 risultati
-        features = list(layer.getFeatures(request))
-        
-        debug_info = [
-            f"Features trovate: {len(features)}",
-            "\nPrimi esempi di particelle disponibili:"
-        ]
-        
-        if features:
-            # Raccoglie i codici amministrativi unici
-            admin_codes = set()
-            refs = []
-            
-            for feat in features:
-                admin_code = feat['ADMINISTRATIVEUNIT']
-                ref = feat['NATIONALCADASTRALREFERENCE']
-                admin_codes.add(admin_code)
-                refs.append(f"Admin: {admin_code}, Ref: {ref}")
-            
-            debug_info.append("\nCodici amministrativi trovati:")
-            debug_info.extend(sorted(list(admin_codes)))
-            
-            debug_info.append("\nEsempi di riferimenti:")
-            debug_info.extend(refs)
-            
-            # Aggiungi dettagli del codice cercato
-            debug_info.append(f"\nStavi cercando il codice admin: {admin}")
-            return '\n'.join(debug_info)
+    memo = get_memo(FUNCTION_NAME)
+    results = {}
+    missing = []
+    for ref in dict.fromkeys(refs):
+        cached = memo.get(ref)
+        if cached is None:
+            missing.append(ref)
+        else:
+            results[ref] = cached
+    if not missing:
+        return results
+    records, source = get_backend().records_by_refs(
+        missing, lambda refs: get_wfs_session().get_records_by_refs(refs, BATCH_SIZE))
+    found = {}
+    for record in records:
+        found[record['attrs'].get('NATIONALCADASTRALREFERENCE')] = record
+    for ref in missing:
+        if ref in found:
+            results[ref] = record_result(found[ref])
+            memo.put(ref, results[ref])
         else:
-            return '\n'.join(debug_info + ['\nNessuna particella trovata nel servizio'])
-                
+            results[ref] = NOT_FOUND
+            if source == 'wfs':
+                # Un N/D dai GeoPackage offline (WFS giù per poco) non resta in cache
+                memo.put(ref, NOT_FOUND)
+    return results
+
+def layer_references(parent, context, feature=None):
+    """
+    Riferimenti delle righe del layer su cui si calcola l'espressione: gli
+    argomenti della funzione vengono valutati su ogni feature. Se la riga
+    corrente è selezionata (calcolo sulle sole feature selezionate) si leggono
+    solo le selezionate; il filtro del layer vale comunque.
+    """
+    layer = QgsProject.instance().mapLayer(context.variable('layer_id'))
+    if not isinstance(layer, QgsVectorLayer):
+        return []
+    request = QgsFeatureRequest()
+    selected = layer.selectedFeatureIds()
+    if feature is not None and feature.id() in selected:
+        request.setFilterFids(list(selected))
+    calls = [node for node in parent.rootNode().nodes()
+             if isinstance(node, QgsExpressionNodeFunction)
+             and QgsExpression.Functions()[node.fnIndex()].name() == FUNCTION_NAME]
+    eval_context = QgsExpressionContext(context)
+    arguments = []
+    for node in calls:
+        expressions = [QgsExpression(arg.dump()) for arg in node.args().list()[:4]]
+        for expression in expressions:
+            expression.prepare(eval_context)
+        arguments.append(expressions)
+    refs = []
+    for feat in layer.getFeatures(request):
+        eval_context.setFeature(feat)
+        for expressions in arguments:
+            values = [expression.evaluate(eval_context) for expression in expressions]
+            values = [None if value == '' or (hasattr(value, 'isNull') and value.isNull()) else value
+                      for value in values]
+            if all(value is not None for value in values[:3]):
+                refs.append(compose_reference(*values))
+    return refs
+
+@qgsfunction(args=-1, group='Catasto')
+def get_particella_by_codes(values, feature, parent, context):
+    """
+    <h1>Catasto Agenzia delle Entrate CC BY 4.0:</h1>
+    La funzione restituisce le informazioni WFS Catasto della particella con i codici indicati.
+
+    <h2>Parametri</h2>
+    <ul>
+      <li>admin: codice belfiore del comune (con la sezione come quinto carattere, se presente)</li>
+      <li>foglio: numero del foglio</li>
+      <li>particella: numero della particella</li>
+      <li>sezione (facoltativo): sezione censuaria, se non è già nel codice del comune</li>
+    </ul>
+
+    <h2>Returns</h2>
+    <ul>
+      <li>ARRAY: riferimento catastale, foglio, particella, comune, geometria WKT</li>
+    </ul>
+
+    <h2>Esempio</h2>
+        <pre>get_particella_by_codes('C342', '40', '101')[0]--> C342_004000.101</pre>
+        <pre>get_particella_by_codes('A662', '12', '35', 'B')[0]--> A662B001200.35</pre>
+        <pre>geom_from_wkt(get_particella_by_codes("belfiore", "foglio", "particella")[4])</pre>
+
+    Calcolata su un layer, dopo le prime righe raccoglie i codici di tutte le righe
+    del calcolo (le sole selezionate, se si aggiornano quelle) e li cerca a gruppi:
+    poche decine di richieste invece di una per riga.
+    """
+    global _batch
+    try:
+        admin, foglio, particella = values[:3]
+        sezione = values[3] if len(values) > 3 and values[3] not in (None, '') else None
+        ref = compose_reference(admin, foglio, particella, sezione)
+        batch_key = 'catasto_codes_batch'
+        if context is not None and context.hasVariable('layer_id'):
+            if not context.hasCachedValue(batch_key):
+                batch_id = next(_batch_ids)
+                context.setCachedValue(batch_key, batch_id)
+                _batch = [batch_id, {}, 0]
+            if context.cachedValue(batch_key) == _batch[0]:
+                results = _batch[1]
+                if ref in results:
+                    return list(results[ref])
+                _batch[2] += 1
+                if _batch[2] == BATCH_MIN_ROWS:
+                    # Calcolo su molte righe: i codici delle altre si cercano insieme
+                    try:
+                        refs = layer_references(parent, context, feature)
+                    except Exception:
+                        # Argomenti non valutabili sulle altre righe: si cerca solo questa
+                        refs = []
+                    results.update(resolve_refs([ref] + refs))
+                    return list(results[ref])
+        return list(resolve_refs([ref])[ref])
+
     except Exception as e:
-        return f'ERROR: {str(e)}'
\ No newline at end of file
+        return ['ERROR', 'ERROR', 'ERROR', 'ERROR', 'ERROR']
@@ -1,24 +1,56 @@
 #© totò fiandaca - 14/02/2025
 
-from qgis.core import (QgsVectorLayer, QgsPointXY, QgsGeometry, 
-                      QgsSpatialIndex, QgsFeatureRequest, QgsCoordinateReferenceSystem,
+from qgis.core import (QgsVectorLayer, 
+                      QgsSpatialIndex, QgsCoordinateReferenceSystem,
                       QgsCoordinateTransform, QgsProject, QgsField, QgsFeature)
 from qgis.gui import QgsMapToolEmitPoint
 from qgis.utils import iface
 from PyQt5.QtCore import QVariant
+import os
+import sys
+import inspect
+
+# I moduli condivisi (catasto_*.py) stanno nella stessa cartella dello script
+cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+from catasto_cache import get_cache
+from catasto_geom import records_at_point
+from catasto_offline import ParcelBackend
+from catasto_tiles import TileLookup
+from catasto_tasks import ClickQueue, QueryStatus, LATEST
+from catasto_wfs import PARCEL_TYPENAME, WfsSession, record_to_feature
+
+# Risoluzione del clic: True = prima le particelle in locale (tessere con prefetch
+# delle vicine per i clic successivi), False = una GetFeature sul solo punto
+LOCAL_FIRST = True
 
 class PointTool(QgsMapToolEmitPoint):
     def __init__(self, canvas):
         QgsMapToolEmitPoint.__init__(self, canvas)
         self.canvas = canvas
         self.active = False
+        # Una sola sessione WFS per tutta la vita dello strumento
+        self.wfs = WfsSession(PARCEL_TYPENAME)
+        self.wfs.warm_up()
+        self.lookup = TileLookup(self.wfs) if LOCAL_FIRST else None
+        # WFS o GeoPackage offline secondo ~/.catasto_unzip_all/offline.json
+        self.backend = ParcelBackend()
+        self.status = QueryStatus(iface)
+        self.queue = ClickQueue(self.resolve_point, self.show_result, self.show_error,
+                                mode=LATEST, status=self.status)
     
     def activate(self):
         self.active = True
+        self.status.show()
         super().activate()
     
     def deactivate(self):
         self.active = False
+        # Anche passando a un altro strumento: niente interrogazioni orfane né etichetta nella barra
+        self.queue.cancel()
+        self.status.remove()
         super().deactivate()
     
     def canvasReleaseEvent(self, event):
@@ -34,79 +66,112 @@ class PointTool(QgsMapToolEmitPoint):
         transform = QgsCoordinateTransform(source_crs, dest_crs, QgsProject.instance())
         wgs84_point = transform.transform(point)
         
-        # Esegui la query
-        try:
-            particelle, layer = query_catasto_point(wgs84_point.x(), wgs84_point.y())
-            if particelle:
-                print("\nRisultati della ricerca:")
-                for i, particella in enumerate(particelle):
-                    print_feature_details(particella, i)
-                    
-                if layer:
-                    print(f"\nCreato layer '{layer.name()}' con {layer.featureCount()} particelle")
-            else:
-                print("\nNessuna particella trovata in quel punto")
-        except Exception as e:
-            print(f"\nErrore durante la query: {str(e)}")
-            print("\nControlla:")
-            print("1. La connessione internet")
-            print("2. L'accessibilità del servizio WFS del Catasto")
-            print("3. La validità delle credenziali (se richieste)")
-        
+        # Esegui la query in background: un nuovo clic prima della risposta
+        # annulla quella in corso e conta solo l'ultimo punto
+        print(f"\nInizio query per il punto ({wgs84_point.x()}, {wgs84_point.y()})")
+        self.queue.submit(wgs84_point.x(), wgs84_point.y())
+    
+    def resolve_point(self, x, y):
+        return find_particelle(x, y, self.wfs, self.lookup, self.backend)
+    
+    def show_result(self, x, y, result):
+        particelle, fields, origin = result
+        print(f"Features trovate {origin}: {len(particelle)}")
+        layer = create_particelle_layer(particelle, fields)
+        if particelle:
+            print("\nRisultati della ricerca:")
+            for i, particella in enumerate(particelle):
+                print_feature_details(particella, i)
+                
+            if layer:
+                print(f"\nCreato layer '{layer.name()}' con {layer.featureCount()} particelle")
+        else:
+            print("\nNessuna particella trovata in quel punto")
+        self.finish()
+    
+    def show_error(self, x, y, e):
+        print(f"\nErrore durante la query: {str(e)}")
+        print("\nControlla:")
+        print("1. La connessione internet")
+        print("2. L'accessibilità del servizio WFS del Catasto")
+        print("3. La validità delle credenziali (se richieste)")
+        self.finish()
+    
+    def finish(self):
         # Disattiva lo strumento dopo l'uso
         self.deactivate()
         iface.mapCanvas().unsetMapTool(self)
 
-def query_catasto_point(x, y, create_layer=True):
+def find_particelle(x, y, wfs_session=None, lookup=None, backend=None):
+    """
+    Particelle nel punto, dalla cache locale, dal WFS o dai GeoPackage offline.
+    Può essere eseguita in background: non modifica layer e non stampa sulla console.
+    Returns:
+        (features, fields, origine)
+    """
+    if wfs_session is None:
+        wfs_session = lookup.wfs if lookup else WfsSession(PARCEL_TYPENAME)
+    fields = wfs_session.fields()
+    origin = None
+    
+    def online(x, y):
+        nonlocal origin
+        if lookup:
+            records, local = lookup.lookup(x, y)
+            origin = "in locale" if local else "scaricando la tessera del punto"
+            return records
+        # Punto in un'area scaricata o in una particella scaricata di recente: risposta dalla cache locale
+        point_rect = (x, y, x, y)
+        cache = get_cache()
+        cached = records_at_point(cache.query(PARCEL_TYPENAME, point_rect, fresh=True), x, y)
+        if cached or cache.covers(PARCEL_TYPENAME, point_rect):
+            origin = "nella cache locale"
+            return cached
+        # Schema e connessione della sessione sono già pronti: una sola GetFeature,
+        # filtrata sul server alla sola particella che contiene il punto
+        records = wfs_session.get_records_at(x, y)
+        # Il filtro sul punto non copre un'area: in cache vanno solo le particelle
+        cache.store(PARCEL_TYPENAME, None, records)
+        origin = "sul WFS"
+        return records
+    
+    if backend:
+        records, source = backend.records_at(x, y, online)
+        if source == 'offline':
+            origin = "nei GeoPackage offline"
+    else:
+        records = online(x, y)
+    return [record_to_feature(record, fields) for record in records], fields, origin
+
+def query_catasto_point(x, y, create_layer=True, wfs_session=None, lookup=None):
     """
     Interroga il WFS del Catasto per un punto specificato e crea opzionalmente un layer
     Args:
         x (float): Longitudine del punto (WGS84)
         y (float): Latitudine del punto (WGS84)
         create_layer (bool): Se True, crea un layer vettoriale con i risultati
+        wfs_session (WfsSession): sessione WFS da riutilizzare (se assente ne crea una)
+        lookup (TileLookup): ricerca locale a tessere; se None si interroga il solo punto
     """
-    
-    # URL base del servizio WFS catastale con tutti i parametri necessari
-    base_url = 'https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/owfs01.php'
-    
-    # Costruzione dell'URI con parametri verificati
-    uri = (f"pagingEnabled='true' "
-           f"preferCoordinatesForWfsT11='false' "
-           f"restrictToRequestBBOX='1' "
-           f"srsname='EPSG:6706' "
-           f"typename='CP:CadastralParcel' "
-           f"url='{base_url}' "
-           f"version='2.0.0' "
-           f"language='ita'")
-    
     print(f"\nInizio query per il punto ({x}, {y})")
     
-    # Carica il layer WFS
-    wfs_layer = QgsVectorLayer(uri, "catasto_query", "WFS")
-    
-    if not wfs_layer.isValid():
-        error_msg = wfs_layer.dataProvider().error().message() if wfs_layer.dataProvider() else "Nessun dettaglio disponibile"
-        raise Exception(f"Layer non valido. Dettagli: {error_msg}")
-    
-    print("Layer WFS caricato con successo")
-    
-    # Crea il filtro spaziale
-    point = QgsGeometry.fromPointXY(QgsPointXY(x, y))
+    features, fields, origin = find_particelle(x, y, wfs_session, lookup)
+    print(f"Features trovate {origin}: {len(features)}")
     
-    # Imposta una request con il filtro spaziale
-    request = QgsFeatureRequest().setFilterRect(point.boundingBox())
+    if create_layer:
+        return features, create_particelle_layer(features, fields)
     
-    # Recupera le features
-    features = list(wfs_layer.getFeatures(request))
-    print(f"Features trovate: {len(features)}")
-    
-    if create_layer and features:
+    return features, None
+
+def create_particelle_layer(features, fields):
+    """Crea un layer in memoria con le particelle trovate (None se non ce ne sono)"""
+    if features:
         # Crea un nuovo layer vettoriale in memoria
         memory_layer = QgsVectorLayer("MultiPolygon?crs=EPSG:6706", "Particelle_Catastali", "memory")
         memory_layer.startEditing()
         
         # Aggiungi i campi al layer
-        for field in wfs_layer.fields():
+        for field in fields:
             memory_layer.addAttribute(field)
         memory_layer.updateFields()
         
@@ -114,7 +179,7 @@ def query_catasto_point(x, y, create_layer=True):
         for feat in features:
             new_feat = QgsFeature(memory_layer.fields())
             # Copia gli attributi
-            for field in wfs_layer.fields():
+            for field in fields:
                 new_feat[field.name()] = feat[field.name()]
             # Copia la geometria
             new_feat.setGeometry(feat.geometry())
@@ -126,9 +191,9 @@ def query_catasto_point(x, y, create_layer=True):
         QgsProject.instance().addMapLayer(memory_layer)
         print(f"Creato nuovo layer: {memory_layer.name()}")
         
-        return features, memory_layer
+        return memory_layer
     
-    return features, None
+    return None
 
 def print_feature_details(feature, index):
     """
@@ -1,11 +1,90 @@
 #© totò fiandaca - 13/02/2025
 
-from qgis.core import (QgsVectorLayer, QgsPointXY, QgsGeometry, 
-                      QgsSpatialIndex, QgsFeatureRequest, QgsCoordinateReferenceSystem,
+from qgis.core import (QgsVectorLayer, QgsGeometry, 
+                      QgsSpatialIndex, QgsCoordinateReferenceSystem,
                       QgsCoordinateTransform, QgsProject, QgsField, QgsFeature)
 from qgis.gui import QgsMapToolEmitPoint
 from qgis.utils import iface
 from PyQt5.QtCore import Qt, QVariant
+import os
+import sys
+import inspect
+
+# I moduli condivisi (catasto_*.py) stanno nella stessa cartella dello script
+cmd_folder = os.path.split(inspect.getfile(inspect.currentframe()))[0]
+if cmd_folder not in sys.path:
+    sys.path.insert(0, cmd_folder)
+
+from catasto_cache import get_cache
+from catasto_geom import records_at_point
+from catasto_offline import ParcelBackend
+from catasto_refindex import get_refindex, parse_reference
+from catasto_tiles import TileLookup
+from catasto_tasks import ClickQueue, QueryStatus, MERGE
+from catasto_wfs import PARCEL_TYPENAME, WfsSession, record_to_feature
+
+# Risoluzione dei clic: True = prima le particelle in locale (tessere con prefetch
+# delle vicine), False = una GetFeature sul solo punto per ogni clic
+LOCAL_FIRST = True
+
+class SessionIndex:
+    """
+    Indice incrementale delle particelle del layer della sessione.
+
+    Tiene i riferimenti catastali già presenti (controllo dei doppioni in tempo
+    costante) e un QgsSpatialIndex con le geometrie (ricerca per punto senza
+    scorrere il layer). Il layer viene letto tutto una sola volta, poi l'indice
+    segue i segnali di aggiunta e cancellazione delle feature.
+    """
+    def __init__(self, layer):
+        self.layer = layer
+        self.rebuild()
+        layer.committedFeaturesAdded.connect(self.on_features_added)
+        layer.featureDeleted.connect(self.on_feature_deleted)
+        layer.afterRollBack.connect(self.rebuild)
+    
+    def rebuild(self):
+        """Ricostruisce l'indice leggendo tutto il layer"""
+        self.refs = {}
+        self.fid_refs = {}
+        self.spatial = QgsSpatialIndex(QgsSpatialIndex.FlagStoreFeatureGeometries)
+        if self.layer.fields().indexOf('NATIONALCADASTRALREFERENCE') >= 0:
+            for feat in self.layer.getFeatures():
+                self.add(feat)
+    
+    def add(self, feat):
+        ref_catastale = feat['NATIONALCADASTRALREFERENCE']
+        if not ref_catastale or ref_catastale in self.refs:
+            return
+        self.refs[ref_catastale] = feat.id()
+        self.fid_refs[feat.id()] = ref_catastale
+        self.spatial.addFeature(feat)
+    
+    def on_features_added(self, layer_id, features):
+        # Solo le feature salvate: gli id provvisori del buffer di modifica cambiano al commit
+        for feat in features:
+            self.add(feat)
+    
+    def on_feature_deleted(self, fid):
+        ref_catastale = self.fid_refs.pop(fid, None)
+        if ref_catastale is None:
+            return
+        del self.refs[ref_catastale]
+        deleted = QgsFeature(fid)
+        deleted.setGeometry(self.spatial.geometry(fid))
+        self.spatial.deleteFeature(deleted)
+    
+    def __contains__(self, ref_catastale):
+        return ref_catastale in self.refs
+    
+    def __len__(self):
+        return len(self.refs)
+    
+    def refs_at(self, point):
+        """Riferimenti delle particelle della sessione che contengono il punto (QgsPointXY)"""
+        point_geom = QgsGeometry.fromPointXY(point)
+        return [self.fid_refs[fid] for fid in self.spatial.intersects(point_geom.boundingBox())
+                if self.spatial.geometry(fid).contains(point_geom)]
 
 class CatastoQueryTool(QgsMapToolEmitPoint):
     def __init__(self, canvas):
@@ -13,7 +92,16 @@ class CatastoQueryTool(QgsMapToolEmitPoint):
         self.canvas = canvas
         self.active = False
         self.memory_layer = None
+        # Una sola sessione WFS per tutta la vita dello strumento
+        self.wfs = WfsSession(PARCEL_TYPENAME)
+        self.wfs.warm_up()
+        self.lookup = TileLookup(self.wfs) if LOCAL_FIRST else None
+        # WFS o GeoPackage offline secondo ~/.catasto_unzip_all/offline.json
+        self.backend = ParcelBackend()
         self.initialize_memory_layer()
+        self.status = QueryStatus(iface)
+        self.queue = ClickQueue(self.resolve_point, self.show_result, self.show_error,
+                                mode=MERGE, status=self.status)
     
     def initialize_memory_layer(self):
         """Inizializza il layer di memoria per la sessione"""
@@ -21,15 +109,20 @@ class CatastoQueryTool(QgsMapToolEmitPoint):
         # Aggiungeremo i campi quando riceviamo la prima feature
         self.memory_layer.startEditing()
         QgsProject.instance().addMapLayer(self.memory_layer)
+        self.index = SessionIndex(self.memory_layer)
         print("\nCreato nuovo layer per la sessione: Particelle_Catastali_Sessione")
     
     def activate(self):
         self.active = True
         print("\nStrumento attivo. Clicca sulla mappa per interrogare il catasto. Premi ESC per uscire.")
+        self.status.show()
         super().activate()
     
     def deactivate(self):
         self.active = False
+        # Anche passando a un altro strumento: niente interrogazioni orfane né etichetta nella barra
+        self.queue.cancel()
+        self.status.remove()
         if self.memory_layer and self.memory_layer.featureCount() == 0:
             # Rimuovi il layer se vuoto
             QgsProject.instance().removeMapLayer(self.memory_layer.id())
@@ -38,6 +131,11 @@ class CatastoQueryTool(QgsMapToolEmitPoint):
     def keyPressEvent(self, event):
         if event.key() == Qt.Key_Escape:
             print("\nStrumento disattivato.")
+            if self.lookup:
+                print(self.lookup.summary())
+                self.lookup.close()
+            # Le particelle della sessione restano nell'indice dei riferimenti
+            get_refindex().save()
             self.deactivate()
             iface.mapCanvas().unsetMapTool(self)
             
@@ -53,58 +151,87 @@ class CatastoQueryTool(QgsMapToolEmitPoint):
         transform = QgsCoordinateTransform(source_crs, dest_crs, QgsProject.instance())
         wgs84_point = transform.transform(point)
         
-        try:
-            particelle = query_catasto_point(wgs84_point.x(), wgs84_point.y(), self.memory_layer)
-            if particelle:
-                print("\nRisultati della ricerca:")
-                for i, particella in enumerate(particelle):
-                    print_feature_details(particella, i)
-                print(f"\nLayer aggiornato: {self.memory_layer.featureCount()} particelle totali")
-            else:
-                print("\nNessuna particella trovata in quel punto")
-        except Exception as e:
-            print(f"\nErrore durante la query: {str(e)}")
-            print("\nControlla:")
-            print("1. La connessione internet")
-            print("2. L'accessibilità del servizio WFS del Catasto")
-            print("3. La validità delle credenziali (se richieste)")
+        # Clic su una particella già nel layer della sessione: nessuna richiesta
+        known = self.index.refs_at(wgs84_point)
+        if known:
+            print(f"\nParticella già presente nel layer della sessione: {', '.join(known)}")
+            return
         
+        # L'interrogazione gira in background: la mappa resta utilizzabile
+        # e i clic fatti nel frattempo vengono risolti insieme
+        self.queue.submit(wgs84_point.x(), wgs84_point.y())
+    
+    def resolve_point(self, x, y):
+        return query_catasto_point(x, y, self.wfs, self.lookup, self.backend)
+    
+    def show_result(self, x, y, result):
+        particelle, origin = result
+        print(f"\nPunto ({x}, {y}): features trovate {origin}: {len(particelle)}")
+        add_features_to_layer(particelle, self.memory_layer, self.index)
+        if particelle:
+            print("\nRisultati della ricerca:")
+            for i, particella in enumerate(particelle):
+                print_feature_details(particella, i)
+            print(f"\nLayer aggiornato: {self.memory_layer.featureCount()} particelle totali")
+        else:
+            print("\nNessuna particella trovata in quel punto")
+        print("\nClicca per una nuova ricerca o premi ESC per uscire.")
+    
+    def show_error(self, x, y, e):
+        print(f"\nErrore durante la query del punto ({x}, {y}): {str(e)}")
+        print("\nControlla:")
+        print("1. La connessione internet")
+        print("2. L'accessibilità del servizio WFS del Catasto")
+        print("3. La validità delle credenziali (se richieste)")
         print("\nClicca per una nuova ricerca o premi ESC per uscire.")
 
-def query_catasto_point(x, y, memory_layer):
+def query_catasto_point(x, y, wfs_session, lookup=None, backend=None):
     """
-    Interroga il WFS del Catasto per un punto specificato e aggiunge i risultati al layer della sessione
+    Interroga il WFS del Catasto per un punto specificato.
+    Viene eseguita in background: non modifica layer e non stampa sulla console.
     Args:
         x (float): Longitudine del punto (WGS84)
         y (float): Latitudine del punto (WGS84)
-        memory_layer: Layer vettoriale dove salvare i risultati
+        wfs_session (WfsSession): sessione WFS dello strumento
+        lookup (TileLookup): ricerca locale a tessere; se None si interroga il solo punto
+        backend (ParcelBackend): scelta tra WFS e GeoPackage offline; se None solo WFS
+    Returns:
+        (features, origine): particelle nel punto e provenienza del risultato
     """
-    base_url = 'https://wfs.cartografia.agenziaentrate.gov.it/inspire/wfs/owfs01.php'
-    
-    uri = (f"pagingEnabled='true' "
-           f"preferCoordinatesForWfsT11='false' "
-           f"restrictToRequestBBOX='1' "
-           f"srsname='EPSG:6706' "
-           f"typename='CP:CadastralParcel' "
-           f"url='{base_url}' "
-           f"version='2.0.0' "
-           f"language='ita'")
-    
-    print(f"\nInizio query per il punto ({x}, {y})")
-    
-    wfs_layer = QgsVectorLayer(uri, "catasto_query", "WFS")
+    fields = wfs_session.fields()
+    origin = None
     
-    if not wfs_layer.isValid():
-        error_msg = wfs_layer.dataProvider().error().message() if wfs_layer.dataProvider() else "Nessun dettaglio disponibile"
-        raise Exception(f"Layer non valido. Dettagli: {error_msg}")
-    
-    print("Layer WFS caricato con successo")
-    
-    point = QgsGeometry.fromPointXY(QgsPointXY(x, y))
-    request = QgsFeatureRequest().setFilterRect(point.boundingBox())
-    features = list(wfs_layer.getFeatures(request))
-    print(f"Features trovate: {len(features)}")
+    def online(x, y):
+        nonlocal origin
+        if lookup:
+            records, local = lookup.lookup(x, y)
+            origin = "in locale" if local else "scaricando la tessera del punto"
+            return records
+        # Punto in un'area scaricata o in una particella scaricata di recente: risposta dalla cache locale
+        point_rect = (x, y, x, y)
+        cache = get_cache()
+        cached = records_at_point(cache.query(PARCEL_TYPENAME, point_rect, fresh=True), x, y)
+        if cached or cache.covers(PARCEL_TYPENAME, point_rect):
+            origin = "nella cache locale"
+            return cached
+        # Schema e connessione sono già pronti: il clic costa una sola GetFeature,
+        # filtrata sul server alla sola particella che contiene il punto
+        records = wfs_session.get_records_at(x, y)
+        # Il filtro sul punto non copre un'area: in cache vanno solo le particelle
+        cache.store(PARCEL_TYPENAME, None, records)
+        origin = "sul WFS"
+        return records
     
+    if backend:
+        records, source = backend.records_at(x, y, online)
+        if source == 'offline':
+            origin = "nei GeoPackage offline"
+    else:
+        records = online(x, y)
+    return [record_to_feature(record, fields) for record in records], origin
+
+def add_features_to_layer(features, memory_layer, index):
+    """Aggiunge al layer della sessione le particelle non ancora presenti nell'indice"""
     if features:
         # Se è la prima feature, inizializza i campi del layer
         if memory_layer.fields().count() == 0:
@@ -118,25 +245,32 @@ def query_catasto_point(x, y, memory_layer):
         # Aggiungi le features al layer della sessione
         memory_layer.startEditing()
         features_to_add = []
-        existing_refs = set(feat['NATIONALCADASTRALREFERENCE'] for feat in memory_layer.getFeatures())
+        # L'indice si aggiorna al commit: i doppioni nello stesso clic si controllano a parte
+        added_refs = set()
+        refindex = get_refindex()
         
         for feat in features:
             ref_catastale = feat['NATIONALCADASTRALREFERENCE']
-            if ref_catastale not in existing_refs:
+            if ref_catastale not in index and ref_catastale not in added_refs:
                 new_feat = QgsFeature(memory_layer.fields())
                 # Copia e elabora il riferimento catastale
                 ref_catastale = feat['NATIONALCADASTRALREFERENCE']
                 new_feat['NATIONALCADASTRALREFERENCE'] = ref_catastale
                 
-                # Estrai i componenti usando la regex
-                new_feat['ADMIN'] = ref_catastale[:4]
-                new_feat['SEZIONE'] = ref_catastale[4:5]
-                new_feat['FOGLIO'] = ref_catastale[5:9]
-                new_feat['PARTICELLA'] = ref_catastale.split('.')[-1]
+                # Componenti del riferimento (comune, sezione, foglio, particella)
+                parts = parse_reference(ref_catastale)
+                if parts:
+                    new_feat['ADMIN'] = parts.belfiore
+                    new_feat['SEZIONE'] = parts.sezione
+                    new_feat['FOGLIO'] = parts.foglio
+                    new_feat['PARTICELLA'] = parts.particella
                 # Copia geometria
                 new_feat.setGeometry(feat.geometry())
                 features_to_add.append(new_feat)
-                existing_refs.add(ref_catastale)
+                added_refs.add(ref_catastale)
+                rect = feat.geometry().boundingBox()
+                refindex.add(ref_catastale, bbox=(rect.xMinimum(), rect.yMinimum(),
+                                                  rect.xMaximum(), rect.yMaximum()))
         
         # Aggiungi tutte le features in una volta
         if features_to_add: